@@ -1,10 +1,16 @@
 # main.py
-from fastapi import FastAPI, Request, HTTPException, Query
-from shapely.geometry import Point, Polygon
+from fastapi import Depends, FastAPI, Request, HTTPException, Path, Query, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
 from utils.database import supabase
+from utils.geofence import get_geocerca
+from utils.resilience import CircuitoAbierto, ejecutar, escribir
+from utils import deadband
+from utils.trips import stream_track
+from utils import admission, auth, device_state, export, geofence, geofence_audit, hub, lora_stats, mqtt_consumer, mqtt_publisher, nmea, occupancy, positions, profiling, registry, resilience, rollups, shards, spatial, teltonika, teltonika_tcp, trip_stats, ttn, vehicle_state
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import traceback
 import json
 import hashlib, hmac, base64, requests, os
@@ -16,6 +22,79 @@ load_dotenv()
 
 app = FastAPI()
 
+def admin_autorizado(request: Request):
+    # Los /admin/* exigen ADMIN_SECRET configurado y enviado en X-Admin-Secret
+    if not auth.admin(request.headers):
+        raise HTTPException(status_code=403, detail="Falta el header X-Admin-Secret")
+
+# ================== CONTROL DE ADMISIÓN ==================
+# Se registra antes que CORS para que las respuestas 429/503 también
+# lleven los headers CORS.
+
+@app.middleware("http")
+async def control_admision(request: Request, call_next):
+    ruta = admission.RUTAS.get(request.url.path)
+    if ruta is None or request.method != "POST":
+        return await call_next(request)
+
+    prioridad, limite = ruta
+    try:
+        with profiling.span("admision.espera"):
+            await admission.gobernador.adquirir(request.url.path, prioridad, limite)
+    except admission.Saturado as error:
+        # Que el origen reintente en vez de acumular trabajo aquí
+        return JSONResponse(
+            {"ok": False, "error": error.detail},
+            status_code=error.status_code,
+            headers={"Retry-After": str(admission.ADMISION_RETRY_AFTER)},
+        )
+
+    try:
+        return await call_next(request)
+    finally:
+        admission.gobernador.liberar(request.url.path)
+
+@app.get("/admin/admission", dependencies=[Depends(admin_autorizado)])
+def estado_admision():
+    return admission.gobernador.estado()
+
+# ================== PERFILADO ==================
+# Por fuera de la admisión para que la espera en cola quede en el perfil.
+# En respuestas streaming solo se mide hasta que salen los headers.
+
+async def perfilar(request: Request, call_next):
+    if request.url.path.startswith("/admin/") or not profiling.solicitado(request.headers):
+        return await call_next(request)
+
+    perfil, token = profiling.iniciar(request.method, request.url.path)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Profile-Id"] = str(perfil.id)
+        return response
+    finally:
+        profiling.terminar(perfil, token, status)
+
+if profiling.habilitado():
+    app.middleware("http")(perfilar)
+
+@app.get("/admin/profiles", dependencies=[Depends(admin_autorizado)])
+def listar_perfiles():
+    return {"habilitado": profiling.habilitado(), "perfiles": profiling.listar()}
+
+@app.get("/admin/profiles/{perfil_id}", dependencies=[Depends(admin_autorizado)])
+def ver_perfil(
+    perfil_id: int,
+    formato: str = Query("json", pattern="^(json|collapsed)$"),
+):
+    perfil = profiling.obtener(perfil_id)
+    if perfil is None:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    if formato == "collapsed":
+        return Response(perfil.collapsed(), media_type="text/plain")
+    return perfil.detalle()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "https://staging.d1pyeozqgfv4iy.amplifyapp.com", "https://staging.d7hc20uuc89gh.amplifyapp.com"],   # ajusta según tu frontend
@@ -29,64 +108,278 @@ app.add_middleware(
 def now_iso():
     return datetime.now(timezone.utc).isoformat()
 
-def get_geocerca(device_id):
-    datos = supabase.table("device").select("empresas(geocercas)").eq("device_id", device_id).single().execute()
-    geocerca_raw = datos.data["empresas"]["geocercas"]
-    poligono = Polygon(geocerca_raw)
-    return poligono
+def empresa_autenticada(conexion: HTTPConnection) -> str:
+    """Empresa del usuario del token (401 si falta o no es válido)."""
+    try:
+        return auth.empresa(auth.token_de(conexion.headers, conexion.query_params))
+    except auth.NoAutorizado as error:
+        raise HTTPException(status_code=401, detail=str(error))
+
+def respuesta_no_disponible(error: CircuitoAbierto):
+    return JSONResponse(
+        {"ok": False, "error": str(error)},
+        status_code=503,
+        headers={"Retry-After": str(error.reintentar_en)},
+    )
 
-# ================== TTN WEBHOOK ==================
+@app.exception_handler(CircuitoAbierto)
+async def circuito_abierto_handler(request: Request, error: CircuitoAbierto):
+    return respuesta_no_disponible(error)
 
-@app.post("/ttn-webhook")
-async def recibir_datos_ttn(request: Request):
+# ================== RESILIENCIA ==================
+
+async def ciclo_spool():
+    while True:
+        await asyncio.sleep(resilience.SPOOL_DRENAR_SEGUNDOS)
+        try:
+            aplicadas = await asyncio.to_thread(resilience.drenar)
+            if aplicadas:
+                print(f"[SPOOL] {aplicadas} escrituras pendientes aplicadas")
+        except Exception as error:
+            print(f"[ERR] drenado del spool: {error}")
+
+@app.on_event("startup")
+async def iniciar_spool():
+    app.state.spool = asyncio.create_task(ciclo_spool())
+
+@app.get("/admin/resilience", dependencies=[Depends(admin_autorizado)])
+def estado_resiliencia():
+    return resilience.estado()
+
+async def ciclo_registry():
+    while True:
+        await asyncio.sleep(registry.REGISTRY_REFRESH_SEGUNDOS)
+        try:
+            await asyncio.to_thread(registry.cargar)
+        except Exception as e:
+            print(f"[ERR] recarga del registro de dispositivos: {e}")
+
+@app.on_event("startup")
+async def iniciar_registry():
+    # Se carga antes de recibir tráfico para no tratar como nuevos a equipos ya conocidos
     try:
-        data = await request.json()
-        ahora_utc = datetime.now(timezone.utc)
-
-        device_id = data.get("end_device_ids", {}).get("device_id")
-        if not device_id:
-            raise HTTPException(status_code=400, detail="No se encontró device_id")
-
-        uplink = data.get("uplink_message", {}) or {}
-        decoded_payload = uplink.get("decoded_payload", {}) or {}
-
-        messages = decoded_payload.get("messages", [])
-        if messages and isinstance(messages[0], list):
-            messages = messages[0]
-
-        latitude = None
-        longitude = None
-        battery = None
-
-        for msg in messages:
-            tipo = msg.get("type")
-            valor = msg.get("measurementValue")
-            if tipo == "Latitude":
-                latitude = valor
-            elif tipo == "Longitude":
-                longitude = valor
-            elif tipo == "Battery":
-                battery = valor
-
-        rx_metadata = uplink.get("rx_metadata", []) or []
-        snr = rx_metadata[0].get("snr") if rx_metadata else None
-        rssi = rx_metadata[0].get("rssi") if rx_metadata else None
-
-        # ===== GNSS =====
-        if latitude is not None and longitude is not None:
-            try:
-                lon = float(longitude)
-                lat = float(latitude)
-            except:
-                raise HTTPException(status_code=400, detail="Coordenadas inválidas")
+        await asyncio.to_thread(registry.cargar)
+    except Exception as e:
+        print(f"[ERR] carga del registro de dispositivos: {e}")
+    app.state.registry = asyncio.create_task(ciclo_registry())
 
-            poligono = get_geocerca(device_id)
-            punto = Point(lon, lat)
+@app.on_event("startup")
+def cargar_estado_vehiculos():
+    try:
+        vehicle_state.cargar()
+    except Exception as e:
+        # Sin carga inicial el estado se consulta por IMEI la primera vez
+        print(f"[ERR] carga de vehicle_state: {e}")
+
+@app.on_event("startup")
+def cargar_posiciones():
+    try:
+        positions.cargar()
+        geofence.cargar(positions.posiciones)
+        spatial.cargar_dispositivos(positions.posiciones)
+    except Exception as e:
+        print(f"[ERR] carga de posiciones: {e}")
+
+# ================== POSICIONES (MAPA) ==================
+
+@app.get("/positions")
+def get_positions(
+    request: Request,
+    since: str = Query("", description="Cursor devuelto por la consulta anterior"),
+    empresa: str = Depends(empresa_autenticada),
+):
+    cursor, completo, cambios = positions.cambios_desde(since)
+    # Solo los equipos de la empresa del token; el cursor sigue siendo el global
+    cambios = [fila for fila in cambios if registry.pertenece(fila["device_id"], empresa)]
+    etag = f'"{empresa}.{cursor}"'
+
+    # 304 solo si el cliente ya tiene esta versión; si no, 200 (con delta vacío si nada cambió)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    return JSONResponse(
+        {"cursor": cursor, "full": completo, "positions": cambios},
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
+    )
+
+# ================== OCUPACIÓN POR BALIZA ==================
+
+# Solo los equipos de la empresa del token
+
+@app.get("/occupancy")
+def ocupacion_resumen(empresa: str = Depends(empresa_autenticada)):
+    return {"beacons": occupancy.resumen(empresa)}
+
+@app.get("/occupancy/beacons/{mac}")
+def ocupacion_beacon(mac: str, empresa: str = Depends(empresa_autenticada)):
+    return {"beacon_mac": mac.upper(), "devices": occupancy.ocupantes(mac, empresa)}
+
+@app.get("/occupancy/devices/{device_id}")
+def ocupacion_device(device_id: str, empresa: str = Depends(empresa_autenticada)):
+    ubicacion = occupancy.ubicacion(device_id, empresa)
+    if ubicacion is None:
+        raise HTTPException(status_code=404, detail="El dispositivo no está junto a ninguna baliza")
+    return ubicacion
+
+# ================== CONSULTAS ESPACIALES ==================
+
+SPATIAL_REFRESH_SEGUNDOS = float(os.getenv("SPATIAL_REFRESH_SEGUNDOS", "600"))
+
+async def ciclo_spatial():
+    # Balizas y torres casi no cambian: se recargan completas de vez en cuando
+    while True:
+        try:
+            await asyncio.to_thread(spatial.cargar_beacons)
+            await asyncio.to_thread(spatial.cargar_torres)
+        except Exception as e:
+            print(f"[ERR] carga de índices espaciales: {e}")
+        await asyncio.sleep(SPATIAL_REFRESH_SEGUNDOS)
+
+@app.on_event("startup")
+async def iniciar_spatial():
+    app.state.spatial = asyncio.create_task(ciclo_spatial())
+
+# Torres y dispositivos solo de la empresa del token; las balizas son compartidas
+
+def _origen(lat, lon, device_id, empresa):
+    if device_id:
+        punto = spatial.capa("devices", empresa).obtener(device_id)
+        if punto is None:
+            raise HTTPException(status_code=404, detail="Dispositivo sin posición conocida")
+        return punto[0], punto[1]
+    if lat is None or lon is None:
+        raise HTTPException(status_code=400, detail="lat/lon o device_id requerido")
+    return lat, lon
+
+@app.get("/spatial/{capa}/nearest")
+def spatial_nearest(
+    capa: str = Path(..., pattern="^(beacons|towers|devices)$"),
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lon: Optional[float] = Query(None, ge=-180, le=180),
+    device_id: Optional[str] = None,
+    k: int = Query(1, ge=1, le=100),
+    empresa: str = Depends(empresa_autenticada),
+):
+    lat, lon = _origen(lat, lon, device_id, empresa)
+    # Entre dispositivos, el de origen no cuenta como vecino de sí mismo
+    excluir = device_id if capa == "devices" else None
+    return {"lat": lat, "lon": lon, "resultados": spatial.capa(capa, empresa).vecinos(lat, lon, k, excluir=excluir)}
+
+@app.get("/spatial/{capa}/within")
+def spatial_within(
+    capa: str = Path(..., pattern="^(beacons|towers|devices)$"),
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lon: Optional[float] = Query(None, ge=-180, le=180),
+    device_id: Optional[str] = None,
+    radius: float = Query(50, gt=0, le=100_000, description="Radio en metros"),
+    limit: Optional[int] = Query(None, ge=1),
+    empresa: str = Depends(empresa_autenticada),
+):
+    lat, lon = _origen(lat, lon, device_id, empresa)
+    return {"lat": lat, "lon": lon, "resultados": spatial.capa(capa, empresa).en_radio(lat, lon, radius, limit)}
+
+@app.get("/admin/spatial", dependencies=[Depends(admin_autorizado)])
+def estado_spatial():
+    return {nombre: capa.estado() for nombre, capa in spatial.capas.items()}
+
+@app.get("/admin/device-state", dependencies=[Depends(admin_autorizado)])
+def estado_device_state():
+    return device_state.estado()
+
+# ================== AUDITORÍA DE GEOCERCA ==================
+
+@app.get("/geofence/audit")
+def auditar_geocerca(
+    device_id: Optional[str] = None,
+    desde: Optional[datetime] = Query(None, alias="from"),
+    hasta: Optional[datetime] = Query(None, alias="to"),
+    empresa: str = Depends(empresa_autenticada),
+):
+    # Fechas sin zona horaria se asumen UTC
+    desde = desde.replace(tzinfo=desde.tzinfo or timezone.utc) if desde else None
+    hasta = hasta.replace(tzinfo=hasta.tzinfo or timezone.utc) if hasta else None
+
+    try:
+        desde, hasta = geofence_audit.acotar(desde, hasta)
+    except geofence_audit.AuditoriaInvalida as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Solo la empresa del token (un device_id ajeno no devuelve nada)
+    return geofence_audit.auditar(device_id, empresa, desde, hasta)
+
+# ================== EN VIVO (WEBSOCKET / SSE) ==================
+
+@app.on_event("startup")
+async def iniciar_hub():
+    hub.iniciar()
+
+# Cada conexión recibe solo los eventos de la empresa de su token
+
+@app.websocket("/ws/live")
+async def live_ws(websocket: WebSocket):
+    try:
+        empresa = auth.empresa(auth.token_de(websocket.headers, websocket.query_params))
+    except auth.NoAutorizado:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    sub = hub.suscribir(empresa)
+    try:
+        while True:
+            evento = await sub.cola.get()
+            await websocket.send_json(evento)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        hub.desuscribir(sub)
+
+@app.get("/live")
+async def live_sse(request: Request, empresa: str = Depends(empresa_autenticada)):
+    sub = hub.suscribir(empresa)
+
+    async def eventos():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(sub.cola.get(), 15)
+                except asyncio.TimeoutError:
+                    # Mantiene viva la conexión a través de proxies
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {evento['type']}\ndata: {json.dumps(evento, default=str)}\n\n"
+        finally:
+            hub.desuscribir(sub)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ================== TTN WEBHOOK ==================
+
+def _ttn_uplink(uplink, ahora_utc):
+    device_id = uplink["device_id"]
+    battery = uplink["battery"]
+    rssi = uplink["rssi"]
+    snr = uplink["snr"]
+
+    # ===== GNSS =====
+    if uplink["gnss"] is not None:
+        lat, lon = uplink["gnss"]
+        occupancy.salir(device_id)
+
+        poligono = get_geocerca(device_id)
+        # Alerta solo al confirmar la salida (y recordatorios periódicos)
+        dentro, alerta = geofence.evaluar(device_id, poligono, lat, lon, ahora_utc.timestamp())
+        if alerta:
+            geofence.insertar_alerta(device_id, alerta, "GNSS", lat, lon, ahora_utc)
 
-            if poligono.contains(punto):
-                print(f"[POS] {device_id} dentro del perímetro ({lat}, {lon})")
+        if dentro:
+            print(f"[POS] {device_id} dentro del perímetro ({lat}, {lon})")
 
-                supabase.table('device_position_history').insert({
+            if deadband.debe_guardar(device_id, lat, lon, ahora_utc):
+                escribir('device_position_history', 'insert', {
                     "device_id": device_id,
                     "battery": battery,
                     "rssi": rssi,
@@ -94,60 +387,34 @@ async def recibir_datos_ttn(request: Request):
                     "lat": lat,
                     "lon": lon,
                     "observed_at": ahora_utc.isoformat()
-                }).execute()
+                })
 
-                existe = supabase.table('device_position').select("*").eq("device_id", device_id).execute()
-                data_pos = {
-                    "battery": battery,
-                    "last_seen": ahora_utc.isoformat(),
-                    "rssi": rssi,
-                    "snr": snr,
-                    "lat": lat,
-                    "lon": lon
-                }
-                if existe.data:
-                    supabase.table("device_position").update(data_pos).eq("device_id", device_id).execute()
-                else:
-                    data_pos.update({
-                        "device_id": device_id,
-                        "type": "Gps",
-                        "dev_eui": device_id.upper()
-                    })
-                    supabase.table("device_position").insert(data_pos).execute()
-            else:
-                print(f"[POS] {device_id} fuera del perímetro (GNSS)")
-                supabase.table('alertas').insert({
-                    "desc": f"El dispositivo {device_id} está fuera del perímetro (GNSS)",
-                    "type": "notify",
-                    "created_at": ahora_utc.isoformat(),
-                    "resumen": f"{device_id} fuera de perimetro",
-                    "guilty": "Tracker",
-                    "coords": [lat,lon]
-                }).execute()
-            return {"status": "ok"}
+            data_pos = {
+                "battery": battery,
+                "last_seen": ahora_utc.isoformat(),
+                "rssi": rssi,
+                "snr": snr,
+                "lat": lat,
+                "lon": lon
+            }
+            data_pos = registry.fila_posicion(device_id, data_pos, "Gps")
+            escribir("device_position", "upsert", data_pos, on_conflict="device_id")
+            positions.actualizar(device_id, data_pos)
+        else:
+            print(f"[POS] {device_id} fuera del perímetro (GNSS)")
+            # Al volver a entrar el primer punto se guarda siempre
+            deadband.invalidar(device_id)
+        return {"status": "ok"}
 
-        # ===== BLE =====
-        ble_hits = []
-        for msg in messages:
-            tipo = msg.get("type", "")
-            if "BLE" in tipo.upper():
-                valores = msg.get("measurementValue") or []
-                for v in valores:
-                    mac = v.get("mac") or v.get("id")
-                    if mac:
-                        try:
-                            rssi_ble = int(v.get("rssi")) if v.get("rssi") else None
-                        except:
-                            rssi_ble = None
-                        ble_hits.append({"mac": mac, "rssi": rssi_ble})
-
-        if ble_hits:
-            ble_hits.sort(key=lambda h: (h["rssi"] if h["rssi"] is not None else -9999), reverse=True)
-            lat_ble = lon_ble = beacon_mac = None
+    # ===== BLE =====
+    ble_hits = uplink["ble"]
+    if ble_hits:
+        lat_ble = lon_ble = beacon_mac = None
 
+        with profiling.span("beacons.lookup"):
             for hit in ble_hits:
                 mac = hit["mac"]
-                res = supabase.table("beacons").select("lat, lon").eq("mac", mac).limit(1).execute()
+                res = ejecutar(supabase.table("beacons").select("lat, lon").eq("mac", mac).limit(1))
                 row = res.data[0] if res.data else None
                 if row and row.get("lat") and row.get("lon"):
                     lat_ble = float(row["lat"])
@@ -155,14 +422,18 @@ async def recibir_datos_ttn(request: Request):
                     beacon_mac = mac
                     break
 
-            if lat_ble and lon_ble:
-                poligono = get_geocerca(device_id)
-                punto = Point(lon_ble, lat_ble)
+        if lat_ble and lon_ble:
+            occupancy.registrar(device_id, beacon_mac, ahora_utc.timestamp())
+            poligono = get_geocerca(device_id)
+            dentro, alerta = geofence.evaluar(device_id, poligono, lat_ble, lon_ble, ahora_utc.timestamp())
+            if alerta:
+                geofence.insertar_alerta(device_id, alerta, f"BLE→{beacon_mac}", lat_ble, lon_ble, ahora_utc)
 
-                if poligono.contains(punto):
-                    print(f"[POS] {device_id} dentro del perímetro (BLE→{beacon_mac}) ({lat_ble}, {lon_ble})")
+            if dentro:
+                print(f"[POS] {device_id} dentro del perímetro (BLE→{beacon_mac}) ({lat_ble}, {lon_ble})")
 
-                    supabase.table('device_position_history').insert({
+                if deadband.debe_guardar(device_id, lat_ble, lon_ble, ahora_utc):
+                    escribir('device_position_history', 'insert', {
                         "device_id": device_id,
                         "battery": battery,
                         "rssi": rssi,
@@ -170,58 +441,58 @@ async def recibir_datos_ttn(request: Request):
                         "lat": lat_ble,
                         "lon": lon_ble,
                         "observed_at": ahora_utc.isoformat()
-                    }).execute()
+                    })
 
-                    existe = supabase.table('device_position').select("*").eq("device_id", device_id).execute()
-                    data_pos = {
-                        "battery": battery,
-                        "last_seen": ahora_utc.isoformat(),
-                        "rssi": rssi,
-                        "snr": snr,
-                        "lat": lat_ble,
-                        "lon": lon_ble
-                    }
-                    if existe.data:
-                        supabase.table("device_position").update(data_pos).eq("device_id", device_id).execute()
-                    else:
-                        data_pos.update({
-                            "device_id": device_id,
-                            "type": "Gps",
-                            "dev_eui": device_id.upper()
-                        })
-                        supabase.table("device_position").insert(data_pos).execute()
-                else:
-                    print(f"[POS] {device_id} fuera del perímetro (BLE→{beacon_mac})")
-                    supabase.table('alertas').insert({
-                        "desc": f"El dispositivo {device_id} está fuera del perímetro (BLE→{beacon_mac})",
-                        "type": "notify",
-                        "created_at": ahora_utc.isoformat(),
-                        "resumen": f"{device_id} fuera de perimetro",
-                        "guilty": "Tracker",
-                        "coords": [lat,lon]
-                    }).execute()
-                return {"status": "ok"}
-
-            print(f"[BLE] {device_id} sin match en beacons, actualizando heartbeat.")
-            base = {
-                "battery": battery,
-                "last_seen": ahora_utc.isoformat(),
-                "rssi": rssi,
-                "snr": snr
-            }
-            existe = supabase.table('device_position').select("*").eq("device_id", device_id).execute()
-            if existe.data:
-                supabase.table("device_position").update(base).eq("device_id", device_id).execute()
+                data_pos = {
+                    "battery": battery,
+                    "last_seen": ahora_utc.isoformat(),
+                    "rssi": rssi,
+                    "snr": snr,
+                    "lat": lat_ble,
+                    "lon": lon_ble
+                }
+                data_pos = registry.fila_posicion(device_id, data_pos, "Gps")
+                escribir("device_position", "upsert", data_pos, on_conflict="device_id")
+                positions.actualizar(device_id, data_pos)
             else:
-                base.update({
-                    "device_id": device_id,
-                    "type": "Gps",
-                    "dev_eui": device_id.upper()
-                })
-                supabase.table("device_position").insert(base).execute()
+                print(f"[POS] {device_id} fuera del perímetro (BLE→{beacon_mac})")
+                deadband.invalidar(device_id)
             return {"status": "ok"}
 
-        raise HTTPException(status_code=400, detail="Faltan coordenadas o BLE en el payload")
+        print(f"[BLE] {device_id} sin match en beacons, actualizando heartbeat.")
+        base = {
+            "battery": battery,
+            "last_seen": ahora_utc.isoformat(),
+            "rssi": rssi,
+            "snr": snr
+        }
+        base = registry.fila_posicion(device_id, base, "Gps")
+        escribir("device_position", "upsert", base, on_conflict="device_id")
+        positions.actualizar(device_id, base)
+        return {"status": "ok"}
+
+    raise HTTPException(status_code=400, detail="Faltan coordenadas o BLE en el payload")
+
+@app.post("/ttn-webhook")
+async def recibir_datos_ttn(request: Request):
+    try:
+        with profiling.span("decode"):
+            data = await request.json()
+            ahora_utc = datetime.now(timezone.utc)
+            try:
+                uplink = ttn.decodificar_ttn(data)
+            except ttn.PayloadInvalido as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        lora_stats.registrar(uplink, ahora_utc.timestamp())
+
+        # Geocerca, beacons y escrituras usan el cliente síncrono (con
+        # reintentos): van fuera del event loop
+        return await asyncio.to_thread(_ttn_uplink, uplink, ahora_utc)
+
+    except CircuitoAbierto as e:
+        # Solo las lecturas (geocerca, beacons) llegan aquí, antes de
+        # escribir nada: las escrituras van enteras al spool. Que TTN reintente.
+        return respuesta_no_disponible(e)
 
     except Exception as e:
         print(f"[ERR] /ttn-webhook: {e}")
@@ -230,66 +501,28 @@ async def recibir_datos_ttn(request: Request):
 
 # ================== ABEE TTN ==================
 
-@app.post("/abee-ttn")
-async def abee_ttn(request: Request):
-    try:
-        data = await request.json()
-        ahora_utc = datetime.now(timezone.utc)
-
-        # === Identificadores ===
-        end_ids = data.get("end_device_ids") or data.get("data", {}).get("end_device_ids") or {}
-        device_id = end_ids.get("device_id")
-        dev_eui = end_ids.get("dev_eui") or end_ids.get("devEui")
-
-        if not device_id:
-            raise HTTPException(status_code=400, detail="No se encontró device_id")
-
-        # === Uplink y payload ===
-        uplink = data.get("uplink_message") or data.get("data", {}).get("uplink_message") or {}
-        decoded = uplink.get("decoded_payload") or {}
-
-        # === BLE primero (prioridad) ===
-        ble_list = decoded.get("ble") or []
-        battery_percent = decoded.get("battery_percent")
-
-        # Señal LoRaWAN
-        rx_metadata = uplink.get("rx_metadata") or []
-        rssi = rx_metadata[0].get("rssi") if rx_metadata else None
-        snr = rx_metadata[0].get("snr") if rx_metadata else None
-
-        # ---------------------------------------------------
-        # 1) Si trae BLE, ignoramos GNSS
-        # ---------------------------------------------------
-        if ble_list:
-            print(f"[BLE] {device_id} detectó {len(ble_list)} balizas")
-
-            ble_hits = []
-            for b in ble_list:
-                mac = b.get("id")
-                if mac:
-                    try:
-                        rssi_val = int(b.get("rssi"))
-                    except Exception:
-                        rssi_val = None
-
-                    ble_hits.append({
-                        "mac": mac,
-                        "rssi": rssi_val
-                    })
-
-            # Ordenar por RSSI descendente
-            ble_hits.sort(
-                key=lambda h: h["rssi"] if h["rssi"] is not None else -9999,
-                reverse=True
-            )
-
-            lat_ble = None
-            lon_ble = None
-            beacon_mac = None
-
+def _abee_uplink(uplink, ahora_utc):
+    device_id = uplink["device_id"]
+    dev_eui = uplink["dev_eui"]
+    battery_percent = uplink["battery"]
+    rssi = uplink["rssi"]
+    snr = uplink["snr"]
+
+    # ---------------------------------------------------
+    # 1) Si trae BLE, ignoramos GNSS
+    # ---------------------------------------------------
+    ble_hits = uplink["ble"]
+    if ble_hits is not None:
+        print(f"[BLE] {device_id} detectó {len(ble_hits)} balizas")
+
+        lat_ble = None
+        lon_ble = None
+        beacon_mac = None
+
+        with profiling.span("beacons.lookup"):
             for hit in ble_hits:
                 mac = hit["mac"]
-                res = supabase.table("beacons").select("lat, lon").eq("mac", mac).limit(1).execute()
+                res = ejecutar(supabase.table("beacons").select("lat, lon").eq("mac", mac).limit(1))
                 row = res.data[0] if res.data else None
 
                 if row and row.get("lat") is not None and row.get("lon") is not None:
@@ -298,10 +531,12 @@ async def abee_ttn(request: Request):
                     beacon_mac = mac
                     break
 
-            if lat_ble is not None and lon_ble is not None:
-                print(f"[POS] {device_id} posición por BLE→{beacon_mac} ({lat_ble}, {lon_ble})")
+        if lat_ble is not None and lon_ble is not None:
+            occupancy.registrar(device_id, beacon_mac, ahora_utc.timestamp())
+            print(f"[POS] {device_id} posición por BLE→{beacon_mac} ({lat_ble}, {lon_ble})")
 
-                supabase.table("device_position_history").insert({
+            if deadband.debe_guardar(device_id, lat_ble, lon_ble, ahora_utc):
+                escribir("device_position_history", "insert", {
                     "device_id": device_id,
                     "battery": battery_percent,
                     "rssi": rssi,
@@ -309,48 +544,37 @@ async def abee_ttn(request: Request):
                     "lat": lat_ble,
                     "lon": lon_ble,
                     "observed_at": ahora_utc.isoformat()
-                }).execute()
-
-                data_pos = {
-                    "battery": battery_percent,
-                    "last_seen": ahora_utc.isoformat(),
-                    "rssi": rssi,
-                    "snr": snr,
-                    "lat": lat_ble,
-                    "lon": lon_ble
-                }
-
-                existe = supabase.table("device_position").select("device_id").eq("device_id", device_id).execute()
+                })
 
-                if existe.data:
-                    supabase.table("device_position").update(data_pos).eq("device_id", device_id).execute()
-                else:
-                    data_pos.update({
-                        "device_id": device_id,
-                        "type": "Gps",
-                        "dev_eui": (dev_eui or device_id).upper()
-                    })
-                    supabase.table("device_position").insert(data_pos).execute()
+            data_pos = {
+                "battery": battery_percent,
+                "last_seen": ahora_utc.isoformat(),
+                "rssi": rssi,
+                "snr": snr,
+                "lat": lat_ble,
+                "lon": lon_ble
+            }
 
-                return {"status": "ok"}
+            data_pos = registry.fila_posicion(device_id, data_pos, "Gps", dev_eui)
+            escribir("device_position", "upsert", data_pos, on_conflict="device_id")
+            positions.actualizar(device_id, data_pos)
 
-            print(f"[BLE] {device_id} sin coincidencias válidas en tabla beacons")
             return {"status": "ok"}
 
-        # ---------------------------------------------------
-        # 2) Si NO hay BLE, usar GNSS
-        # ---------------------------------------------------
-        loc = (uplink.get("locations") or {}).get("frm-payload") or {}
-        lat = loc.get("latitude")
-        lon = loc.get("longitude")
+        print(f"[BLE] {device_id} sin coincidencias válidas en tabla beacons")
+        return {"status": "ok"}
 
-        if lat is not None and lon is not None:
-            lat = float(lat)
-            lon = float(lon)
+    # ---------------------------------------------------
+    # 2) Si NO hay BLE, usar GNSS
+    # ---------------------------------------------------
+    if uplink["gnss"] is not None:
+        lat, lon = uplink["gnss"]
+        occupancy.salir(device_id)
 
-            print(f"[POS] {device_id} posición por GNSS ({lat}, {lon})")
+        print(f"[POS] {device_id} posición por GNSS ({lat}, {lon})")
 
-            supabase.table("device_position_history").insert({
+        if deadband.debe_guardar(device_id, lat, lon, ahora_utc):
+            escribir("device_position_history", "insert", {
                 "device_id": device_id,
                 "battery": battery_percent,
                 "rssi": rssi,
@@ -358,169 +582,140 @@ async def abee_ttn(request: Request):
                 "lat": lat,
                 "lon": lon,
                 "observed_at": ahora_utc.isoformat()
-            }).execute()
+            })
 
-            data_pos = {
-                "battery": battery_percent,
-                "last_seen": ahora_utc.isoformat(),
-                "rssi": rssi,
-                "snr": snr,
-                "lat": lat,
-                "lon": lon
-            }
+        data_pos = {
+            "battery": battery_percent,
+            "last_seen": ahora_utc.isoformat(),
+            "rssi": rssi,
+            "snr": snr,
+            "lat": lat,
+            "lon": lon
+        }
 
-            existe = supabase.table("device_position").select("device_id").eq("device_id", device_id).execute()
+        data_pos = registry.fila_posicion(device_id, data_pos, "Gps", dev_eui)
+        escribir("device_position", "upsert", data_pos, on_conflict="device_id")
+        positions.actualizar(device_id, data_pos)
 
-            if existe.data:
-                supabase.table("device_position").update(data_pos).eq("device_id", device_id).execute()
-            else:
-                data_pos.update({
-                    "device_id": device_id,
-                    "type": "Gps",
-                    "dev_eui": (dev_eui or device_id).upper()
-                })
-                supabase.table("device_position").insert(data_pos).execute()
+        return {"status": "ok"}
 
-            return {"status": "ok"}
+    # ---------------------------------------------------
+    # 3) Sin BLE ni GNSS
+    # ---------------------------------------------------
+    raise HTTPException(status_code=400, detail="Faltan coordenadas BLE y GNSS en el payload")
 
-        # ---------------------------------------------------
-        # 3) Sin BLE ni GNSS
-        # ---------------------------------------------------
-        raise HTTPException(status_code=400, detail="Faltan coordenadas BLE y GNSS en el payload")
+@app.post("/abee-ttn")
+async def abee_ttn(request: Request):
+    try:
+        with profiling.span("decode"):
+            data = await request.json()
+            ahora_utc = datetime.now(timezone.utc)
+            try:
+                uplink = ttn.decodificar_abee(data)
+            except ttn.PayloadInvalido as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        lora_stats.registrar(uplink, ahora_utc.timestamp())
+
+        # Geocerca, beacons y escrituras usan el cliente síncrono (con
+        # reintentos): van fuera del event loop
+        return await asyncio.to_thread(_abee_uplink, uplink, ahora_utc)
+
+    except CircuitoAbierto as e:
+        return respuesta_no_disponible(e)
 
     except Exception as e:
         print(f"[ERR] /abee-ttn: {e}")
         traceback.print_exc()
         return {"mensaje": "Error interno, pero recibido"}
 
-# ================== EMQX WEBHOOK ==================
-import asyncio
-import uuid
-import requests
-
-from fastapi import BackgroundTasks, Request
-def normalize_emqx_topic(topic: str) -> str:
-    topic = str(topic or "").strip()
-
-    # Por si EMQX Cloud agrega $tenants/TENANT_ID/
-    if topic.startswith("$tenants/"):
-        parts = topic.split("/", 2)
-
-        if len(parts) == 3:
-            topic = parts[2]
-
-    return topic.strip("/")
-
-
-def parse_mqtt_payload(raw_payload):
-    if isinstance(raw_payload, dict):
-        return raw_payload
-
-    if isinstance(raw_payload, str):
-        return json.loads(raw_payload)
+# ================== ESTADÍSTICAS LORAWAN ==================
 
-    raise ValueError("Payload MQTT inválido")
-
-
-def normalize_on_off(value):
-    state = str(value or "").strip().upper()
-
-    if state in {"ON", "OFF"}:
-        return state
-
-    return None
+async def ciclo_lora_stats():
+    while True:
+        await asyncio.sleep(lora_stats.LORA_FLUSH_SEGUNDOS)
+        try:
+            await asyncio.to_thread(lora_stats.flush)
+        except Exception as error:
+            print(f"[ERR] flush de estadísticas LoRaWAN: {error}")
 
+@app.on_event("startup")
+async def iniciar_lora_stats():
+    try:
+        await asyncio.to_thread(lora_stats.cargar)
+    except Exception as error:
+        print(f"[ERR] carga de estadísticas LoRaWAN: {error}")
+    app.state.lora_stats = asyncio.create_task(ciclo_lora_stats())
 
-async def publish_emqx_message(
-    topic: str,
-    payload: dict,
-    retain: bool = False,
+@app.on_event("shutdown")
+def cerrar_lora_stats():
+    try:
+        lora_stats.flush()
+    except Exception as error:
+        print(f"[ERR] flush final de estadísticas LoRaWAN: {error}")
+
+# Solo lo generado por los equipos de la empresa del token
+
+@app.get("/lora/gateways")
+def lora_gateways(empresa: str = Depends(empresa_autenticada)):
+    return {"gateways": lora_stats.lista_gateways(empresa)}
+
+@app.get("/lora/devices/{device_id}")
+def lora_device(device_id: str, empresa: str = Depends(empresa_autenticada)):
+    datos = lora_stats.dispositivo(device_id, empresa)
+    if datos is None:
+        raise HTTPException(status_code=404, detail="Sin uplinks de este dispositivo")
+    return datos
+
+@app.get("/lora/coverage")
+def lora_coverage(
+    lat_min: float = Query(-90, ge=-90, le=90),
+    lat_max: float = Query(90, ge=-90, le=90),
+    lon_min: float = Query(-180, ge=-180, le=180),
+    lon_max: float = Query(180, ge=-180, le=180),
+    empresa: str = Depends(empresa_autenticada),
 ):
-    body = {
-        "payload_encoding": "plain",
-        "topic": topic,
-        "payload": json.dumps(payload),
-        "qos": 1,
-        "retain": retain,
+    return {
+        "cell_degrees": lora_stats.LORA_CELDA_GRADOS,
+        "cells": lora_stats.cobertura(empresa, lat_min, lat_max, lon_min, lon_max),
     }
 
-    response = await asyncio.to_thread(
-        requests.post,
-        IOT_URL,
-        json=body,
-        auth=(IOT_USER, IOT_PASS),
-        headers={"Content-Type": "application/json"},
-        timeout=10,
-    )
-
-    if response.status_code not in (200, 202):
-        raise RuntimeError(
-            f"EMQX respondió {response.status_code}: {response.text}"
-        )
-
-    print(
-        "EMQX MESSAGE PUBLISHED:",
-        {
-            "topic": topic,
-            "status": response.status_code,
-        },
-    )
-
-
-async def request_ha_states_after_connect(
-    client_id: str,
-    mqtt_clientid: str,
+@app.get("/lora/battery")
+def lora_battery(
+    limite: int = Query(50, alias="limit", ge=1, le=1000),
+    empresa: str = Depends(empresa_autenticada),
 ):
-    # Le damos tiempo a Node-RED y Home Assistant para quedar disponibles.
-    await asyncio.sleep(10)
-
-    request_id = str(uuid.uuid4())
-
-    try:
-        await publish_emqx_message(
-            topic=f"{client_id}/state/request",
-            payload={
-                "request_id": request_id,
-                "client_id": client_id,
-                "mqtt_clientid": mqtt_clientid,
-            },
-            retain=False,
-        )
-
-        print(
-            "HA STATE REQUEST SENT:",
-            {
-                "client_id": client_id,
-                "request_id": request_id,
-            },
-        )
+    return {"devices": lora_stats.descarga(empresa, limite)}
 
-    except Exception as error:
-        print(
-            f"Error solicitando estados de {client_id}: {error}"
-        )
-
-def clean_device_topic(topic: str) -> str:
-    """
-    Elimina cualquier cantidad de segmentos /set al final.
-
-    Ejemplos:
-    homeassistant-3/pertiga/set -> homeassistant-3/pertiga
-    homeassistant-3/pertiga/set/set/set -> homeassistant-3/pertiga
-    torre-001/luz -> torre-001/luz
-    """
-    normalized_topic = normalize_emqx_topic(topic)
+# ================== EMQX WEBHOOK ==================
+import asyncio
+import requests
 
-    parts = [
-        part.strip()
-        for part in normalized_topic.split("/")
-        if part.strip()
-    ]
+from fastapi import BackgroundTasks, Request
+from utils.emqx import (
+    IOT_URL,
+    IOT_USER,
+    IOT_PASS,
+    normalize_emqx_topic,
+    parse_mqtt_payload,
+    publish_emqx_message,
+    request_ha_states_after_connect,
+    clean_device_topic,
+    post_emqx,
+    update_desde_estados,
+    update_desde_mensaje,
+    actualizar_conexion,
+)
 
-    while parts and parts[-1].lower() == "set":
-        parts.pop()
+@app.on_event("startup")
+async def iniciar_mqtt_consumer():
+    # Con MQTT_SUBSCRIBE=1 los mensajes llegan por suscripción y no por webhook
+    if mqtt_consumer.MQTT_SUBSCRIBE:
+        app.state.mqtt_consumer = asyncio.create_task(mqtt_consumer.consumir())
 
-    return "/".join(parts)
+@app.on_event("startup")
+async def iniciar_mqtt_publisher():
+    if mqtt_publisher.MQTT_PUBLISHER:
+        app.state.mqtt_publisher = await mqtt_publisher.iniciar()
 
 @app.post("/emqx-webhook")
 async def emqx_webhook(req: Request):
@@ -594,27 +789,7 @@ async def emqx_webhook(req: Request):
                     "error": "La respuesta no contiene states",
                 }
 
-            update_data = {
-                "online": True,
-                "mqtt_clientid": mqtt_clientid,
-                "mqtt_reason": None,
-            }
-
-            for field in ("luz", "pertiga", "enchufe"):
-                value = states.get(field)
-
-                if isinstance(value, dict):
-                    state = normalize_on_off(
-                        value.get("estado") or value.get("state")
-                    )
-                else:
-                    state = normalize_on_off(value)
-
-                if state:
-                    update_data[field] = {
-                        "estado": state,
-                        "id": f"{client_id}/{field}",
-                    }
+            update_data = update_desde_estados(client_id, mqtt_clientid, states)
 
             # online, mqtt_clientid y mqtt_reason son las
             # tres propiedades iniciales.
@@ -631,6 +806,7 @@ async def emqx_webhook(req: Request):
                 .eq("client_id", client_id)
                 .execute()
             )
+            hub.publicar_torre(client_id, update_data)
 
             return {
                 "ok": True,
@@ -641,72 +817,8 @@ async def emqx_webhook(req: Request):
             }
 
         # Mensajes normales y comandos recibidos por EMQX.
-        update_data = {
-            "online": True,
-            "mqtt_clientid": mqtt_clientid,
-            "mqtt_reason": None,
-        }
-
-        state = normalize_on_off(
-            datos.get("state") or datos.get("estado")
-        )
-
-        # Usamos segmentos exactos para evitar coincidencias
-        # accidentales dentro de otros nombres.
-        topic_segments = set(topic_parts)
-
-        if "pertiga" in topic_segments and state:
-            update_data["pertiga"] = {
-                "estado": state,
-                "id": topic_sin_set,
-            }
-
-        if "enchufe" in topic_segments and state:
-            update_data["enchufe"] = {
-                "estado": state,
-                "id": topic_sin_set,
-            }
-
-        if "luz" in topic_segments and state:
-            update_data["luz"] = {
-                "estado": state,
-                "id": topic_sin_set,
-            }
-
-        if "tablero" in topic_segments and "contact" in datos:
-            update_data["sensor_apertura"] = {
-                "estado": (
-                    "Cerrado"
-                    if datos["contact"]
-                    else "Abierto"
-                ),
-                "battery": datos.get("battery"),
-            }
-
-        if "domotica" in topic_segments and "contact" in datos:
-            update_data["domotica"] = {
-                "estado": (
-                    "Cerrado"
-                    if datos["contact"]
-                    else "Abierto"
-                ),
-                "battery": datos.get("battery"),
-            }
-
-        if "illuminance" in datos:
-            update_data["sensor_luz"] = {
-                "iluminancia": datos["illuminance"],
-            }
-
-        if "temperature" in datos:
-            update_data["temperature"] = {
-                "temperature": datos["temperature"],
-            }
-
-        if "humidity" in datos:
-            update_data["humidity"] = {
-                "humidity": datos["humidity"],
-            }
+        update_data = update_desde_mensaje(topic_sin_set, mqtt_clientid, datos)
+        rollups.registrar(topic_id, datos)
 
         result = (
             supabase.table("tower_value")
@@ -714,6 +826,7 @@ async def emqx_webhook(req: Request):
             .eq("client_id", topic_id)
             .execute()
         )
+        hub.publicar_torre(topic_id, update_data)
 
         return {
             "ok": True,
@@ -742,6 +855,66 @@ async def emqx_webhook(req: Request):
             "error": str(error),
         }
 
+# ================== ROLLUPS SENSORES ==================
+
+async def ciclo_rollups():
+    while True:
+        await asyncio.sleep(rollups.ROLLUP_FLUSH_SEGUNDOS)
+        try:
+            await asyncio.to_thread(rollups.flush)
+        except Exception as error:
+            print(f"[ERR] flush de rollups: {error}")
+
+@app.on_event("startup")
+async def iniciar_rollups():
+    app.state.rollups = asyncio.create_task(ciclo_rollups())
+
+@app.on_event("shutdown")
+def cerrar_rollups():
+    try:
+        rollups.flush(todo=True)
+    except Exception as error:
+        print(f"[ERR] flush final de rollups: {error}")
+
+@app.get("/towers/{client_id}/rollups")
+def tower_rollups(
+    client_id: str,
+    metric: str = Query("temperature", pattern="^(temperature|humidity|sensor_luz)$"),
+    ventana: str = Query("1m", alias="window", pattern="^(1m|1h)$"),
+    desde: Optional[datetime] = Query(None, alias="from"),
+    hasta: Optional[datetime] = Query(None, alias="to"),
+    empresa: str = Depends(empresa_autenticada),
+):
+    # Solo torres de la empresa del token (dueña vía tower_value, con cache)
+    duena = hub.empresa_de("tower_value", "client_id", client_id)
+    if duena is None or str(duena) != empresa:
+        raise HTTPException(status_code=404, detail="Torre no encontrada")
+
+    # Fechas sin zona horaria se asumen UTC
+    desde = desde.replace(tzinfo=desde.tzinfo or timezone.utc) if desde else None
+    hasta = hasta.replace(tzinfo=hasta.tzinfo or timezone.utc) if hasta else None
+
+    query = (
+        supabase.table(rollups.ROLLUP_TABLE)
+        .select("bucket_start, min_value, max_value, mean_value, count, last_value")
+        .eq("client_id", client_id)
+        .eq("metric", metric)
+        .eq("ventana", ventana)
+    )
+    if desde:
+        query = query.gte("bucket_start", desde.isoformat())
+    if hasta:
+        query = query.lte("bucket_start", hasta.isoformat())
+
+    filas = query.order("bucket_start").limit(5000).execute().data or []
+    # Ventanas abiertas que todavía no se escriben
+    filas += [
+        {k: v for k, v in f.items() if k not in ("client_id", "metric", "ventana", "sum_value")}
+        for f in rollups.abiertas(client_id, metric, ventana, desde, hasta)
+    ]
+
+    return {"client_id": client_id, "metric": metric, "window": ventana, "rollups": filas}
+
 @app.post("/emqx-client-disconnected")
 async def emqx_client_status(
     req: Request,
@@ -767,55 +940,26 @@ async def emqx_client_status(
                 "error": "No viene clientid",
             }
 
-        if event == "client.connected":
-            online = True
-            mqtt_reason = None
-
-        elif event == "client.disconnected":
-            online = False
-            mqtt_reason = reason
+        conexion = actualizar_conexion(mqtt_clientid, event, reason)
 
-        else:
+        if conexion is None:
             return {
                 "ok": False,
                 "error": "Evento desconocido",
                 "event": event,
             }
 
-        result = (
-            supabase.table("tower_value")
-            .update({
-                "online": online,
-                "mqtt_reason": mqtt_reason,
-            })
-            .eq("mqtt_clientid", mqtt_clientid)
-            .execute()
-        )
-
+        online, mqtt_reason, updated, client_ids = conexion
         requested_clients = []
 
-        if event == "client.connected":
-            towers_result = (
-                supabase.table("tower_value")
-                .select("client_id")
-                .eq("mqtt_clientid", mqtt_clientid)
-                .execute()
+        for client_id in client_ids:
+            background_tasks.add_task(
+                request_ha_states_after_connect,
+                client_id,
+                mqtt_clientid,
             )
 
-            client_ids = {
-                str(row.get("client_id") or "").strip("/")
-                for row in (towers_result.data or [])
-                if row.get("client_id")
-            }
-
-            for client_id in client_ids:
-                background_tasks.add_task(
-                    request_ha_states_after_connect,
-                    client_id,
-                    mqtt_clientid,
-                )
-
-                requested_clients.append(client_id)
+            requested_clients.append(client_id)
 
         return {
             "ok": True,
@@ -823,7 +967,7 @@ async def emqx_client_status(
             "clientid": mqtt_clientid,
             "online": online,
             "reason": mqtt_reason,
-            "updated": result.data,
+            "updated": updated,
             "state_requests": requested_clients,
         }
 
@@ -851,9 +995,15 @@ def sign_headers(path: str, body_str: str):
 
 def post(path: str, body: dict):
     body_str = json.dumps(body, separators=(',', ':'))
-    r = requests.post(f"{BASE}{path}", headers=sign_headers(path, body_str), data=body_str, timeout=20)
-    r.raise_for_status()
-    return r.json()
+
+    def enviar():
+        # Se firma en cada intento porque la firma incluye la fecha
+        r = requests.post(f"{BASE}{path}", headers=sign_headers(path, body_str), data=body_str, timeout=20)
+        r.raise_for_status()
+        return r.json()
+
+    # Las consultas a SolisCloud son de solo lectura: se pueden reintentar
+    return resilience.llamar("solis", enviar, reintentos=2)
 
 @app.get("/api/inverter")
 def inverter(sn: str = Query(INV_ID, description="Número de serie del inversor")):
@@ -875,10 +1025,6 @@ def inverter(sn: str = Query(INV_ID, description="Número de serie del inversor"
 
 # ================== HANDLE LIGHT ==================
 
-IOT_URL = os.getenv("IOT_URL")
-IOT_USER = os.getenv("IOT_USER")
-IOT_PASS = os.getenv("IOT_PASS")
-
 
 def build_set_topic(topic: str) -> str:
     """
@@ -948,6 +1094,28 @@ async def handle_light(request: Request):
             detail=str(error)
         )
 
+    if mqtt_publisher.activo():
+        try:
+            await mqtt_publisher.publicar(publish_topic, json.dumps({"state": state}))
+        except mqtt_publisher.ColaLlena as error:
+            raise HTTPException(
+                status_code=503,
+                detail=str(error)
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=504,
+                detail="Timeout esperando confirmación del broker"
+            )
+
+        return {
+            "ok": True,
+            "state": state,
+            "topic_received": topic,
+            "topic_published": publish_topic,
+            "broker_status": "puback",
+        }
+
     payload = {
         "payload_encoding": "plain",
         "topic": publish_topic,
@@ -960,13 +1128,12 @@ async def handle_light(request: Request):
 
     try:
         # Se ejecuta fuera del event loop porque requests es síncrono.
-        res = await asyncio.to_thread(
-            requests.post,
-            IOT_URL,
-            json=payload,
-            auth=(IOT_USER, IOT_PASS),
-            headers={"Content-Type": "application/json"},
+        res = await resilience.llamar_async(
+            "emqx",
+            post_emqx,
+            payload,
             timeout=5,
+            reintentos=1,
         )
 
         if res.status_code >= 400:
@@ -983,6 +1150,16 @@ async def handle_light(request: Request):
             "broker_status": res.status_code,
         }
 
+    except CircuitoAbierto:
+        raise
+
+    except requests.exceptions.HTTPError as error:
+        # post_emqx levanta los 5xx (para el circuito); siguen siendo 502
+        raise HTTPException(
+            status_code=502,
+            detail=f"Error IoT broker: {error.response.text if error.response is not None else error}"
+        )
+
     except requests.exceptions.Timeout:
         raise HTTPException(
             status_code=504,
@@ -998,18 +1175,30 @@ async def handle_light(request: Request):
 
 # ================== GPS ==================
 
-def normalize_ignition(raw: Any) -> Optional[bool]:
-    """Normaliza ignition a True/False/None."""
-    if raw in (True, "true", "TRUE", 1, "1", "on", "ON"):
-        return True
-    if raw in (False, "false", "FALSE", 0, "0", "off", "OFF"):
-        return False
-    return None
+@app.on_event("startup")
+def iniciar_shards():
+    # Ingesta Teltonika en procesos con afinidad por IMEI (uvicorn con un solo worker)
+    if shards.INGEST_WORKERS:
+        shards.iniciar()
+
+@app.on_event("shutdown")
+def detener_shards():
+    if shards.activo():
+        shards.detener()
+
+@app.get("/admin/shards", dependencies=[Depends(admin_autorizado)])
+def estado_shards():
+    return shards.estado()
+
+@app.on_event("startup")
+async def iniciar_teltonika_tcp():
+    # Recepción directa desde los equipos, sin pasar por el forwarder
+    if teltonika_tcp.TELTONIKA_TCP_PORT:
+        app.state.teltonika_tcp = await teltonika_tcp.iniciar_servidor()
 
 @app.post("/teltonika-hook")
 async def teltonikaHook(request: Request):
     data: Any = await request.json()
-    ahora_utc = datetime.now(timezone.utc)
 
     # Normaliza a lista de mensajes
     if isinstance(data, dict) and "messages" in data and isinstance(data["messages"], list):
@@ -1019,197 +1208,133 @@ async def teltonikaHook(request: Request):
     else:
         return {"ok": False, "reason": "payload format not recognized", "sample": data}
 
-    received = 0
-
-    for msg in messages:
-        lat = msg.get("position.latitude")
-        lon = msg.get("position.longitude")
-        speed = msg.get("position.speed")
-        imei = msg.get("ident")
-
-        if imei is None or lat is None or lon is None:
-            continue
-
-        # Normaliza coordenadas
+    if shards.activo():
         try:
-            lat_f = float(lat)
-            lon_f = float(lon)
-        except (TypeError, ValueError):
-            continue
-
-
-        # Ignition normalizado
-        ignition = normalize_ignition(msg.get("engine.ignition.status"))
+            resultado = await shards.enviar_teltonika(messages)
+        except (shards.ColaLlena, shards.LoteFallido) as error:
+            return JSONResponse(
+                {"ok": False, "error": str(error)},
+                status_code=503,
+                headers={"Retry-After": str(shards.INGEST_RETRY_AFTER)},
+            )
+        return {"ok": True, **resultado}
 
-        # Extra payload (puedes agregar más campos si quieres)
-        extra_payload = {
-            "battery_voltage": msg.get("external.powersource.voltage"),
-            "mileage": msg.get("vehicle.mileage"),
-            "speed":speed,
-            "raw_ignition": msg.get("engine.ignition.status"),
-        }
+    # El lote completo se procesa fuera del event loop (cliente de Supabase síncrono)
+    resultado = await asyncio.to_thread(teltonika.procesar_lote, messages)
 
-        observed_at = ahora_utc.isoformat()
+    return {"ok": True, **resultado}
 
-        if str(imei) == "864292048971244":
-            supabase.table("tower_value").update({"lat":lat_f,"lon":lon_f,"extra":extra_payload}).eq("device_id","Primera Torre").execute()
-            supabase.table("tower_position_history").insert({
-                "lat":lat_f,
-                "lon":lon_f,
-                "imei": str(imei),
-                "extra": extra_payload
-            }).execute()
+def _trip_de_empresa(trip_id, empresa, columnas="id, device_id"):
+    """Fila del viaje si su vehículo es de la empresa; 404 si no existe o es ajeno."""
+    res = ejecutar(supabase.table("trips").select(columnas).eq("id", trip_id))
+    if not res.data or not registry.pertenece(res.data[0]["device_id"], empresa):
+        raise HTTPException(status_code=404, detail="Viaje no encontrado")
+    return res.data[0]
 
-            return
+@app.get("/trips/{trip_id}/summary")
+def trip_summary(trip_id: str, empresa: str = Depends(empresa_autenticada)):
+    trip = _trip_de_empresa(
+        trip_id, empresa,
+        f"id, device_id, started_at, ended_at, status, close_reason, avg_speed_kmh, {trip_stats.STATS_COLUMNS}",
+    )
+    # Si el viaje sigue abierto, lo acumulado en memoria es más reciente
+    en_vivo = trip_stats.resumen_activo(trip["id"])
+    if en_vivo:
+        trip.update(en_vivo)
+    return trip
+
+@app.get("/trips/{trip_id}/track")
+def trip_track(
+    trip_id: str,
+    formato: str = Query("ndjson", alias="format", pattern="^(ndjson|geojson)$"),
+    tolerancia: Optional[float] = Query(None, alias="tolerance", gt=0, description="Tolerancia de simplificación en metros"),
+    empresa: str = Depends(empresa_autenticada),
+):
+    _trip_de_empresa(trip_id, empresa)
+
+    media_type = "application/x-ndjson" if formato == "ndjson" else "application/geo+json"
+    return StreamingResponse(stream_track(trip_id, formato, tolerancia), media_type=media_type)
+
+# ================== EXPORTACIÓN DE HISTORIAL ==================
+
+@app.get("/export/{tabla}")
+def exportar_historial(
+    tabla: str = Path(..., pattern="^(device|vehicle)$"),
+    formato: str = Query("csv", alias="format", pattern="^(csv|ndjson|parquet|arrow)$"),
+    device_id: Optional[str] = None,
+    trip_id: Optional[str] = None,
+    desde: Optional[datetime] = Query(None, alias="from"),
+    hasta: Optional[datetime] = Query(None, alias="to"),
+    bbox: Optional[str] = Query(None, description="lon_min,lat_min,lon_max,lat_max"),
+    empresa: str = Depends(empresa_autenticada),
+):
+    if not export.disponible(formato):
+        raise HTTPException(status_code=501, detail=f"El formato {formato} requiere pyarrow instalado")
+
+    # Fechas sin zona horaria se asumen UTC
+    desde = desde.replace(tzinfo=desde.tzinfo or timezone.utc) if desde else None
+    hasta = hasta.replace(tzinfo=hasta.tzinfo or timezone.utc) if hasta else None
+    caja = None
+    if bbox:
+        try:
+            caja = [float(v) for v in bbox.split(",")]
+        except ValueError:
+            caja = []
+        if len(caja) != 4:
+            raise HTTPException(status_code=400, detail="bbox debe ser lon_min,lat_min,lon_max,lat_max")
 
-        # 1) Leer estado actual del vehículo (device_state)
-        state_res = (
-            supabase.table("vehicle_state")
-            .select("device_id, ignition, current_trip_id")
-            .eq("device_id", imei)
-            .execute()
+    try:
+        # Solo equipos de la empresa del token
+        contenido = export.stream(
+            tabla, formato, registry.de_empresa(empresa),
+            device_id=device_id, trip_id=trip_id, desde=desde, hasta=hasta, bbox=caja,
         )
-        device_state = state_res.data[0] if state_res.data else None
-        current_trip_id = device_state["current_trip_id"] if device_state else None
-
-        # 2) Lógica: crear/cerrar viaje según ignition
-        # Caso A: motor encendido
-        if ignition is True:
-            # Si no hay trip activo, crear uno
-            if current_trip_id is None:
-                trip_res = (
-                    supabase.table("trips")
-                    .insert(
-                        {
-                            "device_id": imei,
-                            "started_at": observed_at,
-                            "status": "active",
-                        }
-                    )
-                    .execute()
-                )
-                current_trip_id = trip_res.data[0]["id"]
-
-            # Upsert device_state (1 fila por IMEI)
-            supabase.table("vehicle_state").upsert(
-                {
-                    "device_id": imei,
-                    "ignition": True,
-                    "current_trip_id": current_trip_id,
-                    "last_seen": observed_at,
-                    "last_lat": lat_f,
-                    "last_lon": lon_f,
-                }
-            ).execute()
-
-        # Caso B: motor apagado
-        elif ignition is False:
-            # Si hay trip activo, cerrarlo
-            if current_trip_id is not None:
-                supabase.table("trips").update(
-                    {
-                        "ended_at": observed_at,
-                        "status": "closed",
-                        "close_reason": "ignition_off",
-                    }
-                ).eq("id", current_trip_id).execute()
-
-            # Actualizar estado y limpiar trip activo
-            supabase.table("vehicle_state").upsert(
-                {
-                    "device_id": imei,
-                    "ignition": False,
-                    "current_trip_id": None,
-                    "last_seen": observed_at,
-                    "last_lat": lat_f,
-                    "last_lon": lon_f,
-                }
-            ).execute()
-
-            # Para guardar el último punto asociado al viaje que se cerró,
-            # usamos una variable auxiliar:
-            # (guardamos el trip_id anterior en history)
-            # OJO: current_trip_id lo vamos a dejar como el anterior solo para history.
-            # Después de insertar history, lo dejamos "null" para el resto.
-            trip_id_for_history = current_trip_id
-            current_trip_id = None  # ya no hay viaje activo
+    except export.ExportInvalido as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except export.DispositivoAjeno:
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+
+    nombre = f"{tabla}_position_history.{formato}"
+    return StreamingResponse(
+        contenido,
+        media_type=export.FORMATOS[formato],
+        headers={"Content-Disposition": f'attachment; filename="{nombre}"'},
+    )
 
-        # Caso C: ignition no viene (None)
-        else:
-            # No cambiamos el estado; si existe trip activo, lo usamos para history
-            trip_id_for_history = current_trip_id
-
-        # Determinar trip_id para guardar en history
-        if ignition is False:
-            # en apagado, usamos el trip anterior (si existía)
-            history_trip_id = trip_id_for_history
-        elif ignition is None:
-            history_trip_id = trip_id_for_history
-        else:
-            # ignition True
-            history_trip_id = current_trip_id
-
-        # 3) Insertar coordenada en vehicle_position_history (tu tabla nueva)
-        supabase.table("vehicle_position_history").insert(
-            {
-                "device_id": imei,
-                "trip_id": history_trip_id,  # puede ser NULL si no hay viaje
-                "lat": lat_f,
-                "lon": lon_f,
-                "observed_at": observed_at,
-                "ignition": ignition,
-                "extra": extra_payload,
-            }
-        ).execute()
-
-        # 4) Actualizar posición actual (device_position) como ya lo hacías
-        payload_current = {
-            "device_id": imei,
-            "lat": lat_f,
-            "lon": lon_f,
-            "last_seen": observed_at,
-            "extra": {**extra_payload, "ignition": ignition, "trip_id": history_trip_id},
-        }
+from fastapi.responses import PlainTextResponse
 
-        existe = (
-            supabase.table("device_position")
-            .select("device_id")
-            .eq("device_id", imei)
-            .execute()
-        )
+def _guardar_trama(device_id, lat, lon, extra, ahora_utc):
+    registro = {
+        "lat": lat,                                  # grados decimales, listo para Maps
+        "lon": lon,
+        "last_seen": ahora_utc.isoformat(),
+        "extra": extra,
+    }
 
-        if existe.data:
-            supabase.table("device_position").update(payload_current).eq("device_id", imei).execute()
-        else:
-            payload_current.update(
+    # Las tramas por evento (motivo != periodico) se guardan siempre
+    if deadband.debe_guardar(
+        device_id, lat, lon, ahora_utc,
+        estado=registro["extra"]["ignicion"],
+        forzar=registro["extra"]["motivo"] != "periodico",
+    ):
+        escribir(
+                "vehicle_position_history",
+                "insert",
                 {
-                    "type": "Vehicle",
-                    "dev_eui": str(imei).upper(),
+                    "device_id": device_id,
+                    "trip_id": None,  # puede ser NULL si no hay viaje
+                    "lat": lat,
+                    "lon": lon,
+                    "observed_at": ahora_utc.isoformat(),
+                    "ignition": False,
+                    "extra": registro["extra"],
                 }
             )
-            supabase.table("device_position").insert(payload_current).execute()
-
-        received += 1
-
-    return {"ok": True, "received": received}
-
-from fastapi.responses import PlainTextResponse
-
-def nmea_a_grados(valor, direccion):
-    """Convierte NMEA (ddmm.mmmm) a grados decimales para Google Maps."""
-    if not valor:
-        return None
-    try:
-        punto = valor.find(".")
-        grados = int(valor[:punto - 2])      # dd o ddd
-        minutos = float(valor[punto - 2:])   # mm.mmmm
-        decimal = grados + minutos / 60
-        if direccion in ("S", "W"):
-            decimal = -decimal
-        return round(decimal, 6)
-    except (ValueError, IndexError):
-        return None
 
+    registro = registry.fila_posicion(device_id, registro, "Train")
+    escribir("device_position", "upsert", registro, on_conflict="device_id")
+    positions.actualizar(device_id, registro)
+    return {"status": "ok"}
 
 @app.post("/rut956-nmea")
 async def recibir_nmea(request: Request):
@@ -1219,56 +1344,38 @@ async def recibir_nmea(request: Request):
     except Exception:
         return {"ok": False}                 # trama corrupta, ignorar
 
-    if data.get("estado") != "A":            # sin fix, no procesar
+    trama = nmea.decodificar_trama(data)
+    if trama is None:
         return {"ok": True}
+    device_id, lat, lon, extra = trama
 
-    lat = nmea_a_grados(data.get("lat"), data.get("lat_d"))
-    lon = nmea_a_grados(data.get("lon"), data.get("lon_d"))
+    # Escrituras con el cliente síncrono (y reintentos): fuera del event loop
+    return await asyncio.to_thread(_guardar_trama, device_id, lat, lon, extra, ahora_utc)
 
-    try:
-        vel_kmh = round(float(data.get("vel_nudos") or 0) * 1.852, 1)
-    except (ValueError, TypeError):
-        return {"ok": True}                  # velocidad inválida, ignorar trama
-
-    device_id = data.get("device_id")
-
-    if lat is None or lon is None:
-        return {"ok": True}
-
-    registro = {
-        "lat": lat,                                  # grados decimales, listo para Maps
-        "lon": lon,
-        "last_seen": ahora_utc.isoformat(),
-        "extra": {
-            "vel_kmh": vel_kmh,                          # km/h
-            "ignicion": data.get("ignicion") == "1",     # True = prendida, False = apagada
-            "motivo": data.get("motivo", "periodico"),
-
-        }
-         
-    }
 
-    supabase.table("vehicle_position_history").insert(
-            {
-                "device_id": device_id,
-                "trip_id": None,  # puede ser NULL si no hay viaje
-                "lat": lat,
-                "lon": lon,
-                "observed_at": ahora_utc.isoformat(),
-                "ignition": False,
-                "extra": registro["extra"],
-            }
-        ).execute()
+@app.post("/rut956-nmea/batch")
+async def recibir_nmea_lote(request: Request, device_id: Optional[str] = Query(None)):
+    """
+    Tramas NMEA crudas ($GPRMC/$GPGGA) acumuladas por el router.
+    Acepta texto plano (una trama por línea, device_id en la query)
+    o JSON {"device_id": ..., "sentences": [...]}.
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            data = await request.json()
+        except Exception:
+            raise HTTPException(status_code=400, detail="JSON inválido")
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=400, detail='Se esperaba un objeto {"device_id", "sentences"}')
+        device_id = data.get("device_id") or device_id
+        lineas = data.get("sentences") or []
+        if not isinstance(lineas, list) or not all(isinstance(l, str) for l in lineas):
+            raise HTTPException(status_code=400, detail="sentences debe ser una lista de tramas")
+    else:
+        lineas = (await request.body()).decode("ascii", "replace").splitlines()
 
-    existe = supabase.table("device_position").select("device_id").eq("device_id", device_id).execute()
+    if not device_id:
+        raise HTTPException(status_code=400, detail="device_id requerido")
 
-    if existe.data:
-        supabase.table("device_position").update(registro).eq("device_id", device_id).execute()
-    else:
-        registro.update({
-            "device_id": device_id,
-            "type": "Train",
-            "dev_eui": (device_id).upper()
-        })
-        supabase.table("device_position").insert(registro).execute()
-    return {"status": "ok"}
\ No newline at end of file
+    resultado = await asyncio.to_thread(nmea.procesar_lote, device_id, lineas)
+    return {"ok": True, **resultado}
@@ -0,0 +1,105 @@
+"""
+Benchmark del estado por dispositivo: un dict por equipo (como hoy en los
+handlers) contra las columnas de utils.device_state. Mide memoria por
+dispositivo y actualizaciones por segundo.
+
+Uso:
+    python -m scripts.bench_device_state --dispositivos 100000 --updates 500000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from utils import device_state
+
+COLUMNAS = {
+    "ignition": "bool",
+    "current_trip_id": "obj",
+    "last_seen": "float",
+    "last_lat": "float",
+    "last_lon": "float",
+    "dentro": "bool",
+    "battery": "float",
+    "rssi": "float",
+}
+
+
+def _fila(device_id, i):
+    return {
+        "device_id": device_id,
+        "ignition": bool(i % 2),
+        "current_trip_id": i if i % 2 else None,
+        "last_seen": 1_700_000_000.0 + i,
+        "last_lat": -33.45 + i * 1e-6,
+        "last_lon": -70.66 - i * 1e-6,
+        "dentro": True,
+        "battery": 87.5,
+        "rssi": -97.0,
+    }
+
+
+def _memoria(llenar):
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    contenedor = llenar()
+    usado = tracemalloc.get_traced_memory()[0] - antes
+    tracemalloc.stop()
+    return contenedor, usado
+
+
+def _updates(actualizar, ids, n):
+    rng = random.Random(1)
+    muestra = [rng.choice(ids) for _ in range(n)]
+    inicio = time.perf_counter()
+    for i, device_id in enumerate(muestra):
+        actualizar(device_id, i)
+    return n / (time.perf_counter() - inicio)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dispositivos", type=int, default=100_000)
+    parser.add_argument("--updates", type=int, default=500_000)
+    args = parser.parse_args()
+
+    # Los device_id existen igual en ambos casos (vienen en cada mensaje)
+    ids = [f"{864000000000000 + i}" for i in range(args.dispositivos)]
+
+    def llenar_dicts():
+        return {device_id: _fila(device_id, i) for i, device_id in enumerate(ids)}
+
+    def llenar_tabla():
+        tabla = device_state.tabla("bench", **COLUMNAS)
+        for i, device_id in enumerate(ids):
+            fila = _fila(device_id, i)
+            del fila["device_id"]
+            tabla.poner(device_id, **fila)
+        return tabla
+
+    dicts, mem_dicts = _memoria(llenar_dicts)
+    tabla, mem_tabla = _memoria(llenar_tabla)
+
+    def actualizar_dict(device_id, i):
+        fila = dicts[device_id]
+        fila["last_seen"] = 1_700_000_000.0 + i
+        fila["last_lat"] = -33.45
+        fila["last_lon"] = -70.66
+        fila["ignition"] = True
+
+    def actualizar_tabla(device_id, i):
+        tabla.poner(device_id, last_seen=1_700_000_000.0 + i, last_lat=-33.45, last_lon=-70.66, ignition=True)
+
+    ups_dicts = _updates(actualizar_dict, ids, args.updates)
+    ups_tabla = _updates(actualizar_tabla, ids, args.updates)
+
+    n = args.dispositivos
+    print(f"dispositivos: {n}, columnas: {len(COLUMNAS)}")
+    print(f"{'':14}{'bytes/disp':>12}{'total MB':>10}{'updates/s':>12}")
+    print(f"{'dict':14}{mem_dicts / n:>12.0f}{mem_dicts / 1e6:>10.1f}{ups_dicts:>12,.0f}")
+    print(f"{'device_state':14}{mem_tabla / n:>12.0f}{mem_tabla / 1e6:>10.1f}{ups_tabla:>12,.0f}")
+    print(f"arreglos: {tabla.bytes() / n:.0f} bytes/disp (el resto es el índice de slots)")
+
+
+if __name__ == "__main__":
+    main()
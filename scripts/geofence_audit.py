@@ -0,0 +1,41 @@
+"""
+Auditoría de geocerca en batch: reevalúa el historial contra el polígono
+actual y escribe los intervalos fuera del perímetro como JSON.
+
+Uso:
+    python -m scripts.geofence_audit --empresa 12 --desde 2024-01-01 > excursiones.json
+"""
+import argparse
+import json
+import sys
+from datetime import datetime, timezone
+
+from utils.geofence_audit import auditar
+
+
+def _fecha(valor):
+    fecha = datetime.fromisoformat(valor)
+    return fecha if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device-id")
+    parser.add_argument("--empresa")
+    parser.add_argument("--desde", type=_fecha)
+    parser.add_argument("--hasta", type=_fecha)
+    args = parser.parse_args()
+    if not args.device_id and not args.empresa:
+        parser.error("--device-id o --empresa requerido")
+
+    resultado = auditar(args.device_id, args.empresa, args.desde, args.hasta)
+    print(
+        f"[AUDIT] {resultado['puntos']} puntos, {resultado['fuera']} fuera, "
+        f"{len(resultado['intervalos'])} intervalos",
+        file=sys.stderr,
+    )
+    json.dump(resultado, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
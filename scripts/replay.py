@@ -0,0 +1,484 @@
+"""
+Reingesta offline de webhooks capturados en JSONL (backfill tras una caída
+o reproceso tras corregir lógica), sin pasar por HTTP.
+
+Cada línea es el body crudo de un webhook (con --tipo) o un sobre:
+    {"path": "/ttn-webhook", "received_at": "...", "query": {...}, "body": {...}}
+
+El JSONL se lee por bloques que se decodifican en un pool de procesos con
+las mismas funciones que los handlers (utils.ttn, utils.teltonika,
+utils.nmea); el proceso principal aplica en orden geocerca y deadband y
+escribe en inserts grandes. Tras cada escritura se guarda el offset en
+<archivo>.checkpoint y al relanzar se sigue desde ahí.
+
+Solo se inserta historial: no se abren ni cierran viajes ni se toca
+vehicle_state o tower_value. Las filas que ya existen (mismo device_id y
+observed_at) se omiten, así relanzar o repetir una captura no duplica.
+device_position se actualiza solo con --posicion y solo si el punto es
+más nuevo que el guardado. Los fixes de GPS de torre se omiten
+(tower_position_history no tiene hora con la cual deduplicar).
+
+Uso:
+    python -m scripts.replay capturas/ttn.jsonl --tipo ttn --procesos 8
+    python -m scripts.replay capturas/mixto.jsonl --posicion
+"""
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import shapely
+
+from utils import deadband, geofence, nmea, registry, teltonika, ttn
+from utils.database import iter_keyset, supabase
+from utils.resilience import ejecutar
+
+RUTAS = {
+    "/ttn-webhook": "ttn",
+    "/abee-ttn": "abee",
+    "/teltonika-hook": "teltonika",
+    "/rut956-nmea": "nmea",
+    "/rut956-nmea/batch": "nmea-lote",
+}
+
+# mac -> (lat, lon), cargado una vez por worker
+_beacons = {}
+
+
+def _iniciar_worker(beacons):
+    global _beacons
+    _beacons = beacons
+
+
+def _hora(valor):
+    if not valor:
+        return None
+    try:
+        hora = datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return hora if hora.tzinfo else hora.replace(tzinfo=timezone.utc)
+
+
+def _beacon(hits):
+    for hit in hits:
+        pos = _beacons.get(hit["mac"])
+        if pos is not None:
+            return hit["mac"], pos
+    return None, None
+
+
+def _lora(tipo, body, recibido):
+    decod = ttn.decodificar_ttn(body) if tipo == "ttn" else ttn.decodificar_abee(body)
+    recibido = recibido or ttn.recibido_en(body)
+    if recibido is None:
+        raise ValueError("sin hora de recepción")
+
+    # Mismo orden que los handlers: TTN prioriza GNSS, Abeeway prioriza BLE
+    if tipo == "ttn" and decod["gnss"] is not None:
+        lat, lon = decod["gnss"]
+        via = "GNSS"
+    elif decod["ble"]:
+        mac, pos = _beacon(decod["ble"])
+        if pos is None:
+            return []
+        lat, lon = pos
+        via = f"BLE→{mac}"
+    elif decod["gnss"] is not None:
+        lat, lon = decod["gnss"]
+        via = "GNSS"
+    else:
+        return []
+
+    return [(
+        "lora", decod["device_id"], decod["dev_eui"], recibido, lat, lon,
+        decod["battery"], decod["rssi"], decod["snr"], tipo == "ttn", via,
+    )]
+
+
+def _decodificar(linea, tipo_fijo):
+    obj = json.loads(linea)
+    if isinstance(obj, dict) and "body" in obj:
+        tipo = tipo_fijo or RUTAS.get(obj.get("path"))
+        body = obj["body"]
+        recibido = _hora(obj.get("received_at"))
+        query = obj.get("query") or {}
+    else:
+        tipo, body, recibido, query = tipo_fijo, obj, None, {}
+
+    if tipo in ("ttn", "abee"):
+        return _lora(tipo, body, recibido)
+
+    if tipo == "teltonika":
+        messages = body.get("messages") if isinstance(body, dict) else body
+        ahora = recibido or datetime.now(timezone.utc)
+        fixes = (teltonika.parsear(m, ahora) for m in messages or [])
+        return [("teltonika", f) for f in fixes if f is not None]
+
+    if tipo == "nmea":
+        if recibido is None:
+            raise ValueError("sin hora de recepción")
+        trama = nmea.decodificar_trama(body)
+        if trama is None:
+            return []
+        device_id, lat, lon, extra = trama
+        forzar = extra["motivo"] != "periodico"
+        return [("nmea", device_id, recibido, lat, lon, extra, extra["ignicion"], forzar)]
+
+    if tipo == "nmea-lote":
+        if isinstance(body, dict):
+            device_id = body.get("device_id") or query.get("device_id")
+            lineas = body.get("sentences") or []
+        else:
+            device_id = query.get("device_id")
+            lineas = str(body).splitlines()
+        if not device_id:
+            raise ValueError("device_id requerido")
+        fixes, _ = nmea.parsear_lote(lineas, recibido or datetime.now(timezone.utc))
+        return [
+            ("nmea", device_id, f["observed"], f["lat"], f["lon"], {
+                "vel_kmh": f["vel_kmh"],
+                "motivo": "periodico",
+                "satelites": f["satelites"],
+                "altitud": f["altitud"],
+            }, None, False)
+            for f in fixes
+        ]
+
+    raise ValueError(f"tipo de captura desconocido: {tipo}")
+
+
+def decodificar_bloque(lineas, tipo_fijo):
+    """Corre en el pool: devuelve (eventos, descartadas, primeros errores)."""
+    eventos = []
+    descartadas = 0
+    errores = []
+    for linea in lineas:
+        try:
+            eventos.extend(_decodificar(linea, tipo_fijo))
+        except Exception as error:
+            descartadas += 1
+            if len(errores) < 3:
+                errores.append(f"{type(error).__name__}: {error}")
+    return eventos, descartadas, errores
+
+
+def leer_bloques(path, offset, lineas_por_bloque):
+    """Genera (líneas, offset al final del bloque) desde offset."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            lineas = []
+            for _ in range(lineas_por_bloque):
+                linea = f.readline()
+                if not linea:
+                    break
+                if linea.strip():
+                    lineas.append(linea)
+            if not lineas:
+                return
+            yield lineas, f.tell()
+
+
+class Escritor:
+    """Acumula filas de varios bloques y las escribe en pocos inserts grandes."""
+
+    def __init__(self, lote, posicion, geocerca):
+        self.lote = lote
+        self.posicion = posicion
+        self.geocerca = geocerca
+        self.lora_rows = []
+        self.vehicle_rows = []
+        self.ultimas = {}
+        self.poligonos = {}
+        self.totales = {"history": 0, "fuera": 0, "omitidos": 0, "duplicados": 0, "torre": 0, "posiciones": 0}
+
+    def pendientes(self):
+        return len(self.lora_rows) + len(self.vehicle_rows)
+
+    def _dentro(self, lora):
+        """Geocerca vectorizada por dispositivo para los eventos TTN del bloque."""
+        dentro = np.ones(len(lora), dtype=bool)
+        if not self.geocerca:
+            return dentro
+        por_device = {}
+        for i, ev in enumerate(lora):
+            if ev[9]:
+                por_device.setdefault(ev[1], []).append(i)
+        for device_id, idx in por_device.items():
+            if device_id not in self.poligonos:
+                try:
+                    self.poligonos[device_id] = geofence.get_geocerca(device_id)
+                except Exception as error:
+                    print(f"[ERR] geocerca de {device_id}: {error}")
+                    self.poligonos[device_id] = None
+            poligono = self.poligonos[device_id]
+            if poligono is None:
+                continue
+            idx = np.array(idx)
+            lats = np.array([lora[i][4] for i in idx])
+            lons = np.array([lora[i][5] for i in idx])
+            dentro[idx] = shapely.contains_xy(poligono, lons, lats)
+        return dentro
+
+    def agregar(self, eventos):
+        lora = [ev for ev in eventos if ev[0] == "lora"]
+        dentro = self._dentro(lora)
+
+        for ev, adentro in zip(lora, dentro):
+            _, device_id, dev_eui, observed, lat, lon, battery, rssi, snr, _, _ = ev
+            if not adentro:
+                # Igual que /ttn-webhook: fuera no se guarda y al volver se guarda el primero
+                deadband.invalidar(device_id)
+                self.totales["fuera"] += 1
+                continue
+            if deadband.debe_guardar(device_id, lat, lon, observed):
+                self.lora_rows.append({
+                    "device_id": device_id,
+                    "battery": battery,
+                    "rssi": rssi,
+                    "snr": snr,
+                    "lat": lat,
+                    "lon": lon,
+                    "observed_at": observed.isoformat(),
+                })
+            else:
+                self.totales["omitidos"] += 1
+            tipo, dev_eui, _ = registry.identidad(device_id, "Gps", dev_eui)
+            self.ultimas[device_id] = {
+                "device_id": device_id,
+                "battery": battery,
+                "last_seen": observed.isoformat(),
+                "rssi": rssi,
+                "snr": snr,
+                "lat": lat,
+                "lon": lon,
+                "type": tipo,
+                "dev_eui": dev_eui,
+            }
+
+        # Teltonika en orden de hora del equipo, como aplicar_fixes
+        fixes = sorted((ev[1] for ev in eventos if ev[0] == "teltonika"), key=lambda f: (f["imei"], f["ts"]))
+        for f in fixes:
+            imei = f["imei"]
+            if registry.torre_de(imei) is not None:
+                self.totales["torre"] += 1
+                continue
+            observed_at = f["observed"].isoformat()
+            if deadband.debe_guardar(imei, f["lat"], f["lon"], f["observed"], estado=f["ignition"]):
+                self.vehicle_rows.append({
+                    "device_id": imei,
+                    "trip_id": None,
+                    "lat": f["lat"],
+                    "lon": f["lon"],
+                    "observed_at": observed_at,
+                    "ignition": f["ignition"],
+                    "extra": f["extra"],
+                })
+            else:
+                self.totales["omitidos"] += 1
+            tipo, dev_eui, _ = registry.identidad(imei, "Vehicle")
+            self.ultimas[imei] = {
+                "device_id": imei,
+                "lat": f["lat"],
+                "lon": f["lon"],
+                "last_seen": observed_at,
+                "extra": {**f["extra"], "ignition": f["ignition"]},
+                "type": tipo,
+                "dev_eui": dev_eui,
+            }
+
+        for ev in eventos:
+            if ev[0] == "nmea":
+                _, device_id, observed, lat, lon, extra, estado, forzar = ev
+                if deadband.debe_guardar(device_id, lat, lon, observed, estado=estado, forzar=forzar):
+                    self.vehicle_rows.append({
+                        "device_id": device_id,
+                        "trip_id": None,
+                        "lat": lat,
+                        "lon": lon,
+                        "observed_at": observed.isoformat(),
+                        "ignition": False,
+                        "extra": extra,
+                    })
+                else:
+                    self.totales["omitidos"] += 1
+                tipo, dev_eui, _ = registry.identidad(device_id, "Train")
+                self.ultimas[device_id] = {
+                    "device_id": device_id,
+                    "lat": lat,
+                    "lon": lon,
+                    "last_seen": observed.isoformat(),
+                    "extra": extra,
+                    "type": tipo,
+                    "dev_eui": dev_eui,
+                }
+
+    def _insertar(self, tabla, filas):
+        vistos = _existentes(tabla, filas)
+        nuevas = []
+        for fila in filas:
+            clave = (fila["device_id"], _hora(fila["observed_at"]).timestamp())
+            if clave in vistos:
+                self.totales["duplicados"] += 1
+                continue
+            vistos.add(clave)
+            nuevas.append(fila)
+
+        for i in range(0, len(nuevas), self.lote):
+            ejecutar(supabase.table(tabla).insert(nuevas[i:i + self.lote]))
+        self.totales["history"] += len(nuevas)
+
+    def escribir(self):
+        if self.lora_rows:
+            self._insertar("device_position_history", self.lora_rows)
+        if self.vehicle_rows:
+            self._insertar("vehicle_position_history", self.vehicle_rows)
+        if self.posicion and self.ultimas:
+            filas = _mas_nuevas(list(self.ultimas.values()))
+            # Lora y vehículos llevan columnas distintas: un upsert por forma de fila
+            por_forma = {}
+            for fila in filas:
+                por_forma.setdefault(tuple(sorted(fila)), []).append(fila)
+            for grupo in por_forma.values():
+                ejecutar(supabase.table("device_position").upsert(grupo, on_conflict="device_id"), reintentos=2)
+            self.totales["posiciones"] += len(filas)
+        self.lora_rows = []
+        self.vehicle_rows = []
+        self.ultimas = {}
+
+
+def _existentes(tabla, filas):
+    """(device_id, epoch) ya guardados en el rango de horas de las filas."""
+    rangos = {}
+    for fila in filas:
+        hora = _hora(fila["observed_at"])
+        desde, hasta = rangos.get(fila["device_id"], (hora, hora))
+        rangos[fila["device_id"]] = (min(desde, hora), max(hasta, hora))
+
+    vistos = set()
+    for device_id, (desde, hasta) in rangos.items():
+        for fila in iter_keyset(
+            tabla,
+            "id, observed_at",
+            filtros={"device_id": device_id},
+            rangos=[("observed_at", "gte", desde.isoformat()), ("observed_at", "lte", hasta.isoformat())],
+        ):
+            vistos.add((device_id, _hora(fila["observed_at"]).timestamp()))
+    return vistos
+
+
+def _mas_nuevas(filas):
+    """Las filas de device_position cuyo last_seen es posterior al guardado."""
+    ids = [fila["device_id"] for fila in filas]
+    actuales = {}
+    for i in range(0, len(ids), 500):
+        res = ejecutar(supabase.table("device_position").select("device_id, last_seen").in_("device_id", ids[i:i + 500]))
+        for fila in res.data or []:
+            actuales[fila["device_id"]] = _hora(fila["last_seen"])
+    return [
+        fila for fila in filas
+        if actuales.get(fila["device_id"]) is None or _hora(fila["last_seen"]) > actuales[fila["device_id"]]
+    ]
+
+
+def leer_checkpoint(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"offset": 0, "registros": 0}
+
+
+def guardar_checkpoint(path, offset, registros):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({
+            "offset": offset,
+            "registros": registros,
+            "actualizado": datetime.now(timezone.utc).isoformat(),
+        }, f)
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reingesta de webhooks capturados en JSONL")
+    parser.add_argument("archivo")
+    parser.add_argument("--tipo", choices=sorted(set(RUTAS.values())),
+                        help="Tipo de todas las líneas (si no, se toma del path del sobre)")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--bloque", type=int, default=2000, help="Líneas por bloque del pool")
+    parser.add_argument("--lote", type=int, default=5000, help="Filas por insert")
+    parser.add_argument("--posicion", action="store_true",
+                        help="Actualizar device_position con el último punto de cada equipo si es más nuevo")
+    parser.add_argument("--sin-geocerca", action="store_true",
+                        help="No filtrar los puntos TTN fuera del perímetro")
+    parser.add_argument("--desde-cero", action="store_true", help="Ignorar el checkpoint")
+    args = parser.parse_args()
+
+    checkpoint_path = args.archivo + ".checkpoint"
+    checkpoint = {"offset": 0, "registros": 0} if args.desde_cero else leer_checkpoint(checkpoint_path)
+    offset, registros = checkpoint["offset"], checkpoint["registros"]
+    if offset:
+        print(f"[REPLAY] retomando desde el byte {offset} ({registros} registros ya aplicados)")
+
+    beacons = {
+        row["mac"]: (float(row["lat"]), float(row["lon"]))
+        for row in iter_keyset("beacons", "mac, lat, lon", key="mac")
+        if row.get("lat") is not None and row.get("lon") is not None
+    }
+    registry.cargar()
+
+    escritor = Escritor(args.lote, args.posicion, not args.sin_geocerca)
+    descartadas = 0
+    inicio = time.monotonic()
+    procesados = 0
+    en_sesion = 0
+
+    with ProcessPoolExecutor(args.procesos, initializer=_iniciar_worker, initargs=(beacons,)) as pool:
+        en_vuelo = deque()
+        bloques = leer_bloques(args.archivo, offset, args.bloque)
+
+        def llenar():
+            # Pocos bloques por delante: no se carga el archivo entero en memoria
+            while len(en_vuelo) < args.procesos * 2:
+                siguiente = next(bloques, None)
+                if siguiente is None:
+                    return
+                lineas, fin = siguiente
+                en_vuelo.append((pool.submit(decodificar_bloque, lineas, args.tipo), fin, len(lineas)))
+
+        llenar()
+        while en_vuelo:
+            futuro, fin, n = en_vuelo.popleft()
+            eventos, malas, errores = futuro.result()
+            llenar()
+
+            for error in errores:
+                print(f"[ERR] línea descartada: {error}")
+            descartadas += malas
+            escritor.agregar(eventos)
+            procesados += n
+
+            if escritor.pendientes() >= args.lote or not en_vuelo:
+                escritor.escribir()
+                registros += procesados
+                en_sesion += procesados
+                procesados = 0
+                guardar_checkpoint(checkpoint_path, fin, registros)
+
+                horas = (time.monotonic() - inicio) / 3600
+                print(
+                    f"[REPLAY] byte {fin}: {registros} registros, {escritor.totales}, "
+                    f"{descartadas} descartados, {en_sesion / max(horas, 1e-9):,.0f}/h"
+                )
+
+    print(f"[REPLAY] listo: {registros} registros, {escritor.totales}, {descartadas} descartados")
+
+
+if __name__ == "__main__":
+    main()
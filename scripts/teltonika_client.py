@@ -0,0 +1,78 @@
+"""
+Cliente de prueba que se hace pasar por un equipo Teltonika (Codec 8E).
+
+Uso:
+    python -m scripts.teltonika_client --imei 356307042441013 --lat -33.45 --lon -70.66 --ignition 1
+"""
+import argparse
+import socket
+import struct
+import time
+
+CODEC_8E = 0x8E
+
+
+def crc16_ibm(data) -> int:
+    # Implementación independiente de la del servidor a propósito
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def registro_8e(ts_ms, lat, lon, speed, ignition, voltage_mv, odometer_m):
+    gps = struct.pack(">iihHBH", int(lon * 1e7), int(lat * 1e7), 500, 90, 9, speed)
+    io = struct.pack(">HH", 239, 3)
+    io += struct.pack(">H", 1) + struct.pack(">HB", 239, ignition)
+    io += struct.pack(">H", 1) + struct.pack(">HH", 66, voltage_mv)
+    io += struct.pack(">H", 1) + struct.pack(">HI", 16, odometer_m)
+    io += struct.pack(">H", 0)  # N8
+    io += struct.pack(">H", 0)  # NX
+    return struct.pack(">QB", ts_ms, 0) + gps + io
+
+
+def paquete_avl(registros):
+    data = bytes([CODEC_8E, len(registros)]) + b"".join(registros) + bytes([len(registros)])
+    return struct.pack(">II", 0, len(data)) + data + struct.pack(">I", crc16_ibm(data))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5027)
+    parser.add_argument("--imei", default="356307042441013")
+    parser.add_argument("--lat", type=float, default=-33.45)
+    parser.add_argument("--lon", type=float, default=-70.66)
+    parser.add_argument("--speed", type=int, default=40)
+    parser.add_argument("--ignition", type=int, default=1)
+    parser.add_argument("--records", type=int, default=5)
+    args = parser.parse_args()
+
+    ahora_ms = int(time.time() * 1000)
+    registros = [
+        registro_8e(
+            ahora_ms - (args.records - i) * 10_000,
+            args.lat + i * 0.0005,
+            args.lon,
+            args.speed,
+            args.ignition,
+            12_600,
+            1_000_000 + i * 55,
+        )
+        for i in range(args.records)
+    ]
+
+    with socket.create_connection((args.host, args.port), timeout=10) as sock:
+        imei = args.imei.encode()
+        sock.sendall(struct.pack(">H", len(imei)) + imei)
+        print("handshake:", sock.recv(1))
+
+        sock.sendall(paquete_avl(registros))
+        (ack,) = struct.unpack(">I", sock.recv(4))
+        print(f"ACK: {ack} registros (enviados {args.records})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import asyncio
+import heapq
+import itertools
+import os
+from collections import Counter
+
+# Control de admisión para los webhooks: límite de concurrencia global y
+# por ruta, con prioridad para los comandos sobre la telemetría y una
+# cola de espera acotada. Saturado responde 429/503 con Retry-After.
+ADMISION_TOTAL = int(os.getenv("ADMISION_TOTAL", "64"))
+# Cupos que la telemetría nunca puede ocupar
+ADMISION_RESERVA_COMANDOS = int(os.getenv("ADMISION_RESERVA_COMANDOS", "8"))
+ADMISION_COLA_MAX = int(os.getenv("ADMISION_COLA_MAX", "256"))
+ADMISION_ESPERA_SEGUNDOS = float(os.getenv("ADMISION_ESPERA_SEGUNDOS", "5"))
+ADMISION_RETRY_AFTER = int(os.getenv("ADMISION_RETRY_AFTER", "5"))
+
+COMANDO = 0
+TELEMETRIA = 1
+
+# ruta -> (prioridad, límite de concurrencia de la ruta)
+RUTAS = {
+    "/handle-light": (COMANDO, 16),
+    "/emqx-client-disconnected": (COMANDO, 16),
+    "/ttn-webhook": (TELEMETRIA, 24),
+    "/abee-ttn": (TELEMETRIA, 24),
+    "/teltonika-hook": (TELEMETRIA, 16),
+    "/rut956-nmea": (TELEMETRIA, 16),
+    "/rut956-nmea/batch": (TELEMETRIA, 8),
+    "/emqx-webhook": (TELEMETRIA, 24),
+}
+
+
+class Saturado(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class Gobernador:
+    def __init__(self, total=ADMISION_TOTAL, reserva=ADMISION_RESERVA_COMANDOS,
+                 cola_max=ADMISION_COLA_MAX, espera=ADMISION_ESPERA_SEGUNDOS):
+        self.total = total
+        self.reserva = reserva
+        self.cola_max = cola_max
+        self.espera = espera
+        self.en_uso = 0
+        self.por_ruta = Counter()
+        # (prioridad, orden de llegada, ruta, límite, future)
+        self._cola = []
+        self._orden = itertools.count()
+        self.rechazados = Counter()
+
+    def _puede(self, ruta, prioridad, limite):
+        tope = self.total if prioridad == COMANDO else self.total - self.reserva
+        return self.en_uso < tope and self.por_ruta[ruta] < limite
+
+    def _tomar(self, ruta):
+        self.en_uso += 1
+        self.por_ruta[ruta] += 1
+
+    async def adquirir(self, ruta, prioridad, limite):
+        # Sin nadie esperando y con cupo, entra directo
+        if not self._cola and self._puede(ruta, prioridad, limite):
+            self._tomar(ruta)
+            return
+
+        if len(self._cola) >= self.cola_max:
+            self.rechazados[429] += 1
+            raise Saturado(429, "Demasiadas solicitudes en espera")
+
+        futuro = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._cola, (prioridad, next(self._orden), ruta, limite, futuro))
+        self._despertar()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(futuro), self.espera)
+        except asyncio.TimeoutError:
+            if futuro.done():
+                return  # el cupo llegó justo al vencer la espera
+            futuro.cancel()
+            self.rechazados[503] += 1
+            raise Saturado(503, "Servidor saturado")
+        except BaseException:
+            # Cancelada (cliente desconectado, apagado): si el cupo ya se
+            # entregó se devuelve; si no, se retira de la cola
+            if futuro.done() and not futuro.cancelled():
+                self.liberar(ruta)
+            else:
+                futuro.cancel()
+            raise
+
+    def liberar(self, ruta):
+        self.en_uso -= 1
+        self.por_ruta[ruta] -= 1
+        self._despertar()
+
+    def _despertar(self):
+        """Entrega cupos en orden de prioridad; una ruta llena no bloquea a las demás."""
+        pendientes = []
+        while self._cola:
+            item = heapq.heappop(self._cola)
+            prioridad, _, ruta, limite, futuro = item
+            if futuro.done():
+                continue
+            if self._puede(ruta, prioridad, limite):
+                self._tomar(ruta)
+                futuro.set_result(True)
+            else:
+                pendientes.append(item)
+        for item in pendientes:
+            heapq.heappush(self._cola, item)
+
+    def estado(self):
+        return {
+            "en_uso": self.en_uso,
+            "esperando": sum(1 for item in self._cola if not item[4].done()),
+            "por_ruta": dict(+self.por_ruta),
+            "rechazados": dict(self.rechazados),
+        }
+
+
+gobernador = Gobernador()
@@ -0,0 +1,50 @@
+import hmac
+import os
+
+import jwt
+
+# Autenticación de los dashboards: access token de Supabase Auth en
+# Authorization: Bearer (o ?token= en WebSocket/SSE, donde el navegador
+# no deja poner headers). Se verifica localmente con el secreto JWT del
+# proyecto. La empresa del usuario sale de app_metadata.empresa_id, que
+# solo se puede fijar con la service key. Sin SUPABASE_JWT_SECRET no se
+# acepta ningún token.
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET", "")
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+# Endpoints /admin/*: header X-Admin-Secret igual a ADMIN_SECRET. Sin
+# ADMIN_SECRET configurado se rechazan todos.
+ADMIN_SECRET = os.getenv("ADMIN_SECRET", "")
+ADMIN_HEADER = "x-admin-secret"
+
+
+class NoAutorizado(Exception):
+    pass
+
+
+def admin(headers) -> bool:
+    enviado = headers.get(ADMIN_HEADER, "").encode()
+    return bool(ADMIN_SECRET) and hmac.compare_digest(enviado, ADMIN_SECRET.encode())
+
+
+def token_de(headers, query_params):
+    autorizacion = headers.get("authorization", "")
+    if autorizacion.lower().startswith("bearer "):
+        return autorizacion[7:].strip()
+    return query_params.get("token")
+
+
+def empresa(token) -> str:
+    """Empresa del usuario dueño del token; NoAutorizado si no es válido."""
+    if not SUPABASE_JWT_SECRET:
+        raise NoAutorizado("autenticación no configurada")
+    if not token:
+        raise NoAutorizado("token requerido")
+    try:
+        claims = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], audience=SUPABASE_JWT_AUDIENCE)
+    except jwt.InvalidTokenError as error:
+        raise NoAutorizado(f"token inválido: {error}")
+
+    empresa_id = (claims.get("app_metadata") or {}).get("empresa_id")
+    if empresa_id is None:
+        raise NoAutorizado("usuario sin empresa")
+    return str(empresa_id)
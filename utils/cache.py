@@ -1,4 +1,4 @@
 from shapely.geometry import Polygon
 
-# key: device_id, value: Polygon de su geocerca
+# key: device_id, value: (Polygon de su geocerca, expira en time.monotonic())
 device_perimeter_cache = {}
@@ -11,3 +11,39 @@ if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Faltan SUPABASE_URL o SUPABASE_KEY en el .env")
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+
+def iter_keyset(table, columns, filtros=None, key="id", page_size=1000, rangos=None, desempate=None):
+    """
+    Recorre una tabla por páginas usando keyset (key > último visto),
+    así cada página cuesta lo mismo sin importar cuánto se haya avanzado.
+    filtros son igualdades {columna: valor}; rangos es una lista de
+    (columna, operador, valor) con operador gt, gte, lt, lte o in_.
+    Si key no es única, desempate (única, p. ej. "id") la completa:
+    se ordena y se avanza por (key, desempate).
+    """
+    ultimo = None
+    while True:
+        query = supabase.table(table).select(columns)
+        for col, valor in (filtros or {}).items():
+            query = query.eq(col, valor)
+        for col, operador, valor in rangos or ():
+            query = getattr(query, operador)(col, valor)
+        if ultimo is not None:
+            if desempate is None:
+                query = query.gt(key, ultimo)
+            else:
+                valor, extra = ultimo
+                query = query.or_(
+                    f'{key}.gt."{valor}",and({key}.eq."{valor}",{desempate}.gt."{extra}")'
+                )
+
+        query = query.order(key)
+        if desempate is not None:
+            query = query.order(desempate)
+        rows = query.limit(page_size).execute().data or []
+        yield from rows
+
+        if len(rows) < page_size:
+            return
+        ultimo = rows[-1][key] if desempate is None else (rows[-1][key], rows[-1][desempate])
@@ -0,0 +1,52 @@
+import os
+import threading
+from datetime import datetime
+
+from utils.geo import haversine_m
+
+# Un punto se guarda en history solo si se movió al menos DEADBAND_METROS
+# o pasaron DEADBAND_MAX_SEGUNDOS desde el último punto guardado.
+# DEADBAND_METROS=0 desactiva el filtro.
+DEADBAND_METROS = float(os.getenv("DEADBAND_METROS", "15"))
+DEADBAND_MAX_SEGUNDOS = float(os.getenv("DEADBAND_MAX_SEGUNDOS", "300"))
+
+# key: device_id, value: (lat, lon, epoch, estado) del último punto guardado
+ultimo_guardado = {}
+_lock = threading.Lock()
+
+
+def debe_guardar(device_id, lat, lon, observed_at: datetime, estado=None, forzar=False) -> bool:
+    """
+    Decide si el punto va a la tabla de history.
+
+    Siempre se guarda el primer punto del dispositivo, los cambios de
+    estado (ignition, geocerca, etc.) y los puntos marcados con forzar.
+    """
+    ts = observed_at.timestamp()
+
+    with _lock:
+        previo = ultimo_guardado.get(device_id)
+
+        guardar = forzar or previo is None or DEADBAND_METROS <= 0
+        if not guardar:
+            lat_p, lon_p, ts_p, estado_p = previo
+            transcurrido = ts - ts_p
+            guardar = (
+                (estado is not None and estado != estado_p)
+                or transcurrido < 0
+                or transcurrido >= DEADBAND_MAX_SEGUNDOS
+                or haversine_m(lat_p, lon_p, lat, lon) >= DEADBAND_METROS
+            )
+
+        if guardar:
+            if estado is None and previo is not None:
+                estado = previo[3]
+            ultimo_guardado[device_id] = (lat, lon, ts, estado)
+
+    return guardar
+
+
+def invalidar(device_id):
+    """Obliga a guardar el próximo punto del dispositivo (p. ej. al volver a la geocerca)."""
+    with _lock:
+        ultimo_guardado.pop(device_id, None)
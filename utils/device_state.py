@@ -0,0 +1,162 @@
+import math
+import threading
+from array import array
+
+import numpy as np
+
+# Estado por dispositivo en columnas (array) en vez de un dict por equipo.
+# Cada device_id se interna una sola vez en un slot (entero) compartido por
+# todas las tablas; cada tabla guarda sus campos en arreglos indexados
+# por ese slot. Un campo vacío (None) se guarda como NaN en los float y
+# como el mínimo del tipo en bool/int. "obj" guarda referencias (p. ej.
+# ids que pueden ser texto) a 8 bytes por slot.
+CAPACIDAD_INICIAL = 1024
+
+# tipo -> (typecode de array, vacío); "obj" va en una lista
+_TIPOS = {
+    "bool": ("b", -(2 ** 7)),
+    "int": ("q", -(2 ** 63)),
+    "float": ("d", math.nan),
+    "obj": (None, None),
+}
+
+# device_id -> slot, y slot -> device_id
+slots = {}
+ids = []
+_lock = threading.Lock()
+
+
+def slot(device_id, crear=True):
+    """Slot del dispositivo; con crear=False devuelve None si no tiene."""
+    s = slots.get(device_id)
+    if s is not None or not crear:
+        return s
+    with _lock:
+        s = slots.get(device_id)
+        if s is None:
+            s = slots[device_id] = len(ids)
+            ids.append(device_id)
+        return s
+
+
+def _columna(tipo, n):
+    codigo, vacio = _TIPOS[tipo]
+    if codigo is None:
+        return [None] * n
+    return array(codigo, [vacio]) * n
+
+
+class Tabla:
+    def __init__(self, nombre, **columnas):
+        self.nombre = nombre
+        self.tipos = dict(columnas)
+        self.vacios = {col: _TIPOS[tipo][1] for col, tipo in columnas.items()}
+        self.columnas = {col: _columna(tipo, CAPACIDAD_INICIAL) for col, tipo in columnas.items()}
+        # Qué slots tienen fila en esta tabla
+        self.presente = bytearray(CAPACIDAD_INICIAL)
+        self.filas = 0
+        self._lock = threading.Lock()
+
+    def _crecer(self, s):
+        capacidad = len(self.presente)
+        extra = capacidad
+        while capacidad + extra <= s:
+            extra *= 2
+        for col, arr in self.columnas.items():
+            arr.extend(_columna(self.tipos[col], extra))
+        self.presente.extend(bytes(extra))
+
+    def _a_python(self, col, valor):
+        tipo = self.tipos[col]
+        if tipo == "obj":
+            return valor
+        if tipo == "float":
+            return None if valor != valor else valor
+        if valor == self.vacios[col]:
+            return None
+        return bool(valor) if tipo == "bool" else valor
+
+    def poner(self, device_id, **valores):
+        """Escribe los campos dados; los que no vienen quedan como estaban."""
+        s = slots.get(device_id)
+        if s is None:
+            s = slot(device_id)
+        with self._lock:
+            if s >= len(self.presente):
+                self._crecer(s)
+            if not self.presente[s]:
+                self.presente[s] = 1
+                self.filas += 1
+            columnas = self.columnas
+            for col, valor in valores.items():
+                columnas[col][s] = self.vacios[col] if valor is None else valor
+
+    def obtener(self, device_id):
+        """Fila como dict, o None si el dispositivo no tiene estado en esta tabla."""
+        s = slots.get(device_id)
+        with self._lock:
+            if s is None or s >= len(self.presente) or not self.presente[s]:
+                return None
+            return {col: self._a_python(col, arr[s]) for col, arr in self.columnas.items()}
+
+    def valor(self, device_id, col):
+        s = slots.get(device_id)
+        with self._lock:
+            if s is None or s >= len(self.presente) or not self.presente[s]:
+                return None
+            return self._a_python(col, self.columnas[col][s])
+
+    def quitar(self, device_id):
+        s = slots.get(device_id)
+        with self._lock:
+            if s is None or s >= len(self.presente) or not self.presente[s]:
+                return
+            self.presente[s] = 0
+            self.filas -= 1
+            for col, arr in self.columnas.items():
+                arr[s] = self.vacios[col]
+
+    def limpiar(self):
+        with self._lock:
+            self.columnas = {col: _columna(tipo, CAPACIDAD_INICIAL) for col, tipo in self.tipos.items()}
+            self.presente = bytearray(CAPACIDAD_INICIAL)
+            self.filas = 0
+
+    def dispositivos(self):
+        with self._lock:
+            presente = np.frombuffer(self.presente, dtype=np.uint8)
+            return [ids[s] for s in np.flatnonzero(presente)]
+
+    def __contains__(self, device_id):
+        s = slots.get(device_id)
+        return s is not None and s < len(self.presente) and bool(self.presente[s])
+
+    def __len__(self):
+        return self.filas
+
+    def bytes(self):
+        total = len(self.presente)
+        for col, arr in self.columnas.items():
+            total += len(arr) * (arr.itemsize if self.tipos[col] != "obj" else 8)
+        return total
+
+
+tablas = {}
+
+
+def tabla(nombre, **columnas):
+    """Crea (o devuelve) la tabla `nombre` con columnas nombre=tipo ("bool", "int", "float", "obj")."""
+    with _lock:
+        if nombre not in tablas:
+            tablas[nombre] = Tabla(nombre, **columnas)
+        return tablas[nombre]
+
+
+def estado():
+    return {
+        "dispositivos": len(ids),
+        "tablas": {
+            nombre: {"filas": len(t), "capacidad": len(t.presente), "bytes": t.bytes()}
+            for nombre, t in tablas.items()
+        },
+    }
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import os
+import uuid
+
+import requests
+
+from utils import hub, mqtt_publisher, profiling, resilience
+from utils.database import supabase
+
+IOT_URL = os.getenv("IOT_URL")
+IOT_USER = os.getenv("IOT_USER")
+IOT_PASS = os.getenv("IOT_PASS")
+
+
+def normalize_emqx_topic(topic: str) -> str:
+    topic = str(topic or "").strip()
+
+    # Por si EMQX Cloud agrega $tenants/TENANT_ID/
+    if topic.startswith("$tenants/"):
+        parts = topic.split("/", 2)
+
+        if len(parts) == 3:
+            topic = parts[2]
+
+    return topic.strip("/")
+
+
+def parse_mqtt_payload(raw_payload):
+    if isinstance(raw_payload, dict):
+        return raw_payload
+
+    if isinstance(raw_payload, str):
+        return json.loads(raw_payload)
+
+    raise ValueError("Payload MQTT inválido")
+
+
+def normalize_on_off(value):
+    state = str(value or "").strip().upper()
+
+    if state in {"ON", "OFF"}:
+        return state
+
+    return None
+
+
+def post_emqx(body: dict, timeout=10):
+    """POST a la API REST de EMQX; los 5xx se levantan para el circuito."""
+    response = requests.post(
+        IOT_URL,
+        json=body,
+        auth=(IOT_USER, IOT_PASS),
+        headers={"Content-Type": "application/json"},
+        timeout=timeout,
+    )
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
+
+@profiling.trazar("emqx.publicar")
+async def publish_emqx_message(
+    topic: str,
+    payload: dict,
+    retain: bool = False,
+):
+    # Con el publicador persistente basta el PUBACK del broker
+    if mqtt_publisher.activo():
+        await mqtt_publisher.publicar(topic, json.dumps(payload), retain=retain)
+        print("EMQX MESSAGE PUBLISHED:", {"topic": topic, "via": "mqtt"})
+        return
+
+    body = {
+        "payload_encoding": "plain",
+        "topic": topic,
+        "payload": json.dumps(payload),
+        "qos": 1,
+        "retain": retain,
+    }
+
+    response = await resilience.llamar_async("emqx", post_emqx, body, reintentos=2)
+
+    if response.status_code not in (200, 202):
+        raise RuntimeError(
+            f"EMQX respondió {response.status_code}: {response.text}"
+        )
+
+    print(
+        "EMQX MESSAGE PUBLISHED:",
+        {
+            "topic": topic,
+            "status": response.status_code,
+        },
+    )
+
+
+async def request_ha_states_after_connect(
+    client_id: str,
+    mqtt_clientid: str,
+):
+    # Le damos tiempo a Node-RED y Home Assistant para quedar disponibles.
+    await asyncio.sleep(10)
+
+    request_id = str(uuid.uuid4())
+
+    try:
+        await publish_emqx_message(
+            topic=f"{client_id}/state/request",
+            payload={
+                "request_id": request_id,
+                "client_id": client_id,
+                "mqtt_clientid": mqtt_clientid,
+            },
+            retain=False,
+        )
+
+        print(
+            "HA STATE REQUEST SENT:",
+            {
+                "client_id": client_id,
+                "request_id": request_id,
+            },
+        )
+
+    except Exception as error:
+        print(
+            f"Error solicitando estados de {client_id}: {error}"
+        )
+
+def clean_device_topic(topic: str) -> str:
+    """
+    Elimina cualquier cantidad de segmentos /set al final.
+
+    Ejemplos:
+    homeassistant-3/pertiga/set -> homeassistant-3/pertiga
+    homeassistant-3/pertiga/set/set/set -> homeassistant-3/pertiga
+    torre-001/luz -> torre-001/luz
+    """
+    normalized_topic = normalize_emqx_topic(topic)
+
+    parts = [
+        part.strip()
+        for part in normalized_topic.split("/")
+        if part.strip()
+    ]
+
+    while parts and parts[-1].lower() == "set":
+        parts.pop()
+
+    return "/".join(parts)
+
+
+def update_desde_estados(client_id: str, mqtt_clientid, states: dict) -> dict:
+    """
+    Arma el update de tower_value desde la respuesta de Node-RED con los
+    estados reales existentes en Home Assistant.
+    """
+    update_data = {
+        "online": True,
+        "mqtt_clientid": mqtt_clientid,
+        "mqtt_reason": None,
+    }
+
+    for field in ("luz", "pertiga", "enchufe"):
+        value = states.get(field)
+
+        if isinstance(value, dict):
+            state = normalize_on_off(
+                value.get("estado") or value.get("state")
+            )
+        else:
+            state = normalize_on_off(value)
+
+        if state:
+            update_data[field] = {
+                "estado": state,
+                "id": f"{client_id}/{field}",
+            }
+
+    return update_data
+
+
+def update_desde_mensaje(topic_sin_set: str, mqtt_clientid, datos: dict) -> dict:
+    """Arma el update de tower_value para mensajes normales y comandos."""
+    update_data = {
+        "online": True,
+        "mqtt_clientid": mqtt_clientid,
+        "mqtt_reason": None,
+    }
+
+    state = normalize_on_off(
+        datos.get("state") or datos.get("estado")
+    )
+
+    # Usamos segmentos exactos para evitar coincidencias
+    # accidentales dentro de otros nombres.
+    topic_segments = set(topic_sin_set.split("/"))
+
+    if "pertiga" in topic_segments and state:
+        update_data["pertiga"] = {
+            "estado": state,
+            "id": topic_sin_set,
+        }
+
+    if "enchufe" in topic_segments and state:
+        update_data["enchufe"] = {
+            "estado": state,
+            "id": topic_sin_set,
+        }
+
+    if "luz" in topic_segments and state:
+        update_data["luz"] = {
+            "estado": state,
+            "id": topic_sin_set,
+        }
+
+    if "tablero" in topic_segments and "contact" in datos:
+        update_data["sensor_apertura"] = {
+            "estado": (
+                "Cerrado"
+                if datos["contact"]
+                else "Abierto"
+            ),
+            "battery": datos.get("battery"),
+        }
+
+    if "domotica" in topic_segments and "contact" in datos:
+        update_data["domotica"] = {
+            "estado": (
+                "Cerrado"
+                if datos["contact"]
+                else "Abierto"
+            ),
+            "battery": datos.get("battery"),
+        }
+
+    if "illuminance" in datos:
+        update_data["sensor_luz"] = {
+            "iluminancia": datos["illuminance"],
+        }
+
+    if "temperature" in datos:
+        update_data["temperature"] = {
+            "temperature": datos["temperature"],
+        }
+
+    if "humidity" in datos:
+        update_data["humidity"] = {
+            "humidity": datos["humidity"],
+        }
+
+    return update_data
+
+
+def actualizar_conexion(mqtt_clientid: str, event: str, reason=None):
+    """
+    Marca online/offline las torres de un cliente MQTT.
+    Devuelve (online, mqtt_reason, filas actualizadas, client_ids a los
+    que hay que pedir estados) o None si el evento no se conoce.
+    """
+    if event == "client.connected":
+        online = True
+        mqtt_reason = None
+
+    elif event == "client.disconnected":
+        online = False
+        mqtt_reason = reason
+
+    else:
+        return None
+
+    result = (
+        supabase.table("tower_value")
+        .update({
+            "online": online,
+            "mqtt_reason": mqtt_reason,
+        })
+        .eq("mqtt_clientid", mqtt_clientid)
+        .execute()
+    )
+    hub.publicar_torre(mqtt_clientid, {"online": online, "mqtt_reason": mqtt_reason}, columna="mqtt_clientid")
+
+    client_ids = set()
+
+    if event == "client.connected":
+        towers_result = (
+            supabase.table("tower_value")
+            .select("client_id")
+            .eq("mqtt_clientid", mqtt_clientid)
+            .execute()
+        )
+
+        client_ids = {
+            str(row.get("client_id") or "").strip("/")
+            for row in (towers_result.data or [])
+            if row.get("client_id")
+        }
+
+    return online, mqtt_reason, result.data, sorted(client_ids)
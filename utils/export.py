@@ -0,0 +1,242 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from itertools import islice
+
+from utils.database import iter_keyset
+
+# Exportación masiva del historial de posiciones. Las filas se leen por
+# keyset (páginas de EXPORT_PAGINA) y se codifican página a página, así
+# la memoria no depende del tamaño de la exportación. Parquet y Arrow
+# usan pyarrow, que es opcional: sin él solo hay CSV y NDJSON.
+# Solo se exportan equipos de la empresa de quien pide: sin device_id se
+# recorren sus equipos de a EXPORT_DISPOSITIVOS_LOTE con un filtro in.
+EXPORT_PAGINA = int(os.getenv("EXPORT_PAGINA", "5000"))
+EXPORT_DISPOSITIVOS_LOTE = int(os.getenv("EXPORT_DISPOSITIVOS_LOTE", "200"))
+# Filas por row group de Parquet (lo que se junta en memoria antes de escribir)
+EXPORT_FILAS_GRUPO = int(os.getenv("EXPORT_FILAS_GRUPO", "50000"))
+
+# nombre -> (tabla, [(columna, tipo)])
+TABLAS = {
+    "device": ("device_position_history", [
+        ("id", "int"),
+        ("device_id", "str"),
+        ("lat", "float"),
+        ("lon", "float"),
+        ("observed_at", "timestamp"),
+        ("battery", "float"),
+        ("rssi", "float"),
+        ("snr", "float"),
+    ]),
+    "vehicle": ("vehicle_position_history", [
+        ("id", "int"),
+        ("device_id", "str"),
+        ("trip_id", "str"),
+        ("lat", "float"),
+        ("lon", "float"),
+        ("observed_at", "timestamp"),
+        ("ignition", "bool"),
+        ("extra", "json"),
+    ]),
+}
+
+FORMATOS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+class ExportInvalido(ValueError):
+    pass
+
+
+class DispositivoAjeno(LookupError):
+    pass
+
+
+def disponible(formato) -> bool:
+    if formato in ("csv", "ndjson"):
+        return True
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _consulta(nombre, dispositivos, device_id=None, trip_id=None, desde=None, hasta=None, bbox=None):
+    """(filtros, rangos, grupos de device_id) para iter_keyset; todos los filtros van a la base."""
+    filtros = {}
+    rangos = []
+    if device_id:
+        if device_id not in dispositivos:
+            raise DispositivoAjeno(device_id)
+        grupos = [None]
+        filtros["device_id"] = device_id
+    else:
+        grupos = [dispositivos[i:i + EXPORT_DISPOSITIVOS_LOTE] for i in range(0, len(dispositivos), EXPORT_DISPOSITIVOS_LOTE)]
+    if trip_id:
+        if nombre != "vehicle":
+            raise ExportInvalido("trip_id solo aplica al historial de vehículos")
+        filtros["trip_id"] = trip_id
+    if desde:
+        rangos.append(("observed_at", "gte", desde.isoformat()))
+    if hasta:
+        rangos.append(("observed_at", "lt", hasta.isoformat()))
+    if bbox:
+        lon_min, lat_min, lon_max, lat_max = bbox
+        rangos += [("lat", "gte", lat_min), ("lat", "lte", lat_max), ("lon", "gte", lon_min), ("lon", "lte", lon_max)]
+    return filtros, rangos, grupos
+
+
+def paginas(nombre, filtros, rangos, grupos):
+    """Listas de filas en orden de id (dentro de cada grupo de equipos)."""
+    tabla, columnas = TABLAS[nombre]
+    for grupo in grupos:
+        filas = iter_keyset(
+            tabla,
+            ", ".join(col for col, _ in columnas),
+            filtros=filtros,
+            rangos=rangos if grupo is None else [("device_id", "in_", grupo), *rangos],
+            page_size=EXPORT_PAGINA,
+        )
+        while True:
+            pagina = list(islice(filas, EXPORT_PAGINA))
+            if not pagina:
+                break
+            yield pagina
+
+
+# ================== CODIFICADORES ==================
+
+def _csv(columnas, lotes):
+    nombres = [col for col, _ in columnas]
+    json_cols = [col for col, tipo in columnas if tipo == "json"]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, nombres, extrasaction="ignore")
+    writer.writeheader()
+    for pagina in lotes:
+        for fila in pagina:
+            if json_cols:
+                fila = {**fila, **{c: json.dumps(fila.get(c)) if fila.get(c) is not None else None for c in json_cols}}
+            writer.writerow(fila)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson(columnas, lotes):
+    for pagina in lotes:
+        yield "".join(json.dumps(fila, default=str) + "\n" for fila in pagina).encode()
+
+
+class _Sumidero(io.RawIOBase):
+    """Archivo de solo escritura que acumula lo escrito hasta que se vacía."""
+
+    def __init__(self):
+        self.partes = []
+        self.posicion = 0
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        datos = bytes(datos)
+        self.partes.append(datos)
+        self.posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self.posicion
+
+    def vaciar(self):
+        datos = b"".join(self.partes)
+        self.partes = []
+        return datos
+
+
+def _esquema(pa, columnas):
+    tipos = {
+        "int": pa.int64(),
+        "str": pa.string(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "json": pa.string(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+    }
+    return pa.schema([(col, tipos[tipo]) for col, tipo in columnas])
+
+
+def _valor(tipo, valor):
+    if valor is None:
+        return None
+    if tipo == "timestamp":
+        return datetime.fromisoformat(valor)
+    if tipo == "json":
+        return json.dumps(valor)
+    if tipo == "str":
+        return str(valor)
+    return valor
+
+
+def _lote(pa, esquema, columnas, filas):
+    return pa.RecordBatch.from_arrays(
+        [pa.array([_valor(tipo, f.get(col)) for f in filas], type=esquema.field(col).type) for col, tipo in columnas],
+        schema=esquema,
+    )
+
+
+def _parquet(columnas, lotes):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    esquema = _esquema(pa, columnas)
+    sumidero = _Sumidero()
+    writer = pq.ParquetWriter(sumidero, esquema, compression="zstd")
+    # Las páginas se juntan ya en columnas hasta completar un row group
+    pendientes = []
+    filas = 0
+    for pagina in lotes:
+        pendientes.append(_lote(pa, esquema, columnas, pagina))
+        filas += len(pagina)
+        if filas >= EXPORT_FILAS_GRUPO:
+            writer.write_table(pa.Table.from_batches(pendientes, esquema), row_group_size=filas)
+            pendientes = []
+            filas = 0
+            yield sumidero.vaciar()
+    if pendientes:
+        writer.write_table(pa.Table.from_batches(pendientes, esquema), row_group_size=filas)
+    writer.close()
+    yield sumidero.vaciar()
+
+
+def _arrow(columnas, lotes):
+    import pyarrow as pa
+
+    esquema = _esquema(pa, columnas)
+    sumidero = _Sumidero()
+    with pa.ipc.new_stream(sumidero, esquema) as writer:
+        for pagina in lotes:
+            writer.write_batch(_lote(pa, esquema, columnas, pagina))
+            yield sumidero.vaciar()
+    yield sumidero.vaciar()
+
+
+_CODIFICADORES = {"csv": _csv, "ndjson": _ndjson, "parquet": _parquet, "arrow": _arrow}
+
+
+def stream(nombre, formato, dispositivos, **filtros):
+    """
+    Genera la exportación en bytes, página a página, limitada a los equipos
+    de `dispositivos`. Los filtros se validan antes de empezar
+    (ExportInvalido -> 400, DispositivoAjeno -> 404).
+    """
+    _, columnas = TABLAS[nombre]
+    filtros, rangos, grupos = _consulta(nombre, dispositivos, **filtros)
+    return _CODIFICADORES[formato](columnas, paginas(nombre, filtros, rangos, grupos))
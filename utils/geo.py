@@ -0,0 +1,25 @@
+import math
+
+import numpy as np
+
+RADIO_TIERRA_M = 6371008.8
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Distancia en metros entre dos coordenadas (grados decimales)."""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_m_vec(lat, lon, lats, lons):
+    """haversine_m de un punto contra arrays de coordenadas (numpy)."""
+    p1 = np.radians(lat)
+    p2 = np.radians(lats)
+    dp = p2 - p1
+    dl = np.radians(np.asarray(lons) - lon)
+    a = np.sin(dp / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))
@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from shapely.geometry import Point, Polygon
+
+from utils import device_state, profiling
+from utils.cache import device_perimeter_cache
+from utils.database import supabase, iter_keyset
+from utils.resilience import ejecutar, escribir
+
+# Alertas de geocerca por transición (dentro -> fuera) en vez de una
+# alerta por cada uplink fuera del perímetro. Cada transición o alerta
+# se guarda en geofence_state para retomar el estado al reiniciar
+# (device_position solo se actualiza dentro del perímetro, no sirve para
+# saber si un equipo estaba fuera):
+#
+#   create table geofence_state (
+#     device_id text primary key,
+#     dentro boolean not null,
+#     desde timestamptz,
+#     ultima_alerta timestamptz,
+#     last_seen timestamptz
+#   );
+GEOCERCA_CACHE_SEGUNDOS = float(os.getenv("GEOCERCA_CACHE_SEGUNDOS", "300"))
+# Margen alrededor del borde para no alternar dentro/fuera por ruido GPS
+GEOCERCA_HISTERESIS_METROS = float(os.getenv("GEOCERCA_HISTERESIS_METROS", "20"))
+# Tiempo mínimo en el nuevo lado antes de confirmar la transición
+GEOCERCA_PERMANENCIA_SEGUNDOS = float(os.getenv("GEOCERCA_PERMANENCIA_SEGUNDOS", "60"))
+# Cada cuánto se recuerda que un dispositivo sigue fuera (0 = nunca)
+GEOCERCA_RECORDATORIO_SEGUNDOS = float(os.getenv("GEOCERCA_RECORDATORIO_SEGUNDOS", "3600"))
+
+METROS_POR_GRADO = 111_320
+ESTADO_TABLE = "geofence_state"
+
+# Estado dentro/fuera por dispositivo
+estados = device_state.tabla("geofence", dentro="bool", candidato="float", desde="float", ultima_alerta="float")
+_lock = threading.Lock()
+
+
+@profiling.trazar("geofence.geocerca")
+def get_geocerca(device_id):
+    cache = device_perimeter_cache.get(device_id)
+    if cache and cache[1] > time.monotonic():
+        return cache[0]
+
+    datos = ejecutar(supabase.table("device").select("empresas(geocercas)").eq("device_id", device_id).single())
+    geocerca_raw = datos.data["empresas"]["geocercas"]
+    poligono = Polygon(geocerca_raw)
+    device_perimeter_cache[device_id] = (poligono, time.monotonic() + GEOCERCA_CACHE_SEGUNDOS)
+    return poligono
+
+
+@profiling.trazar("geofence.evaluar")
+def evaluar(device_id, poligono, lat, lon, ts):
+    """
+    Actualiza el estado dentro/fuera del dispositivo.
+    Devuelve (dentro, alerta): `dentro` es la contención del punto tal
+    cual y `alerta` es "salida", "recordatorio" o None.
+    """
+    punto = Point(lon, lat)
+    dentro = poligono.contains(punto)
+    distancia_m = poligono.exterior.distance(punto) * METROS_POR_GRADO
+    alerta = None
+
+    with _lock:
+        est = estados.obtener(device_id)
+        if est is None:
+            # Equipo sin estado: se asume dentro, así una primera posición
+            # fuera también tiene que cumplir la permanencia antes de alertar
+            est = {"dentro": True, "candidato": None, "desde": ts, "ultima_alerta": None}
+        transicion = False
+
+        # Solo cuenta como cambio si pasó el margen de histéresis
+        cambio = dentro != est["dentro"] and distancia_m > GEOCERCA_HISTERESIS_METROS
+
+        if not cambio:
+            est["candidato"] = None
+        else:
+            if est["candidato"] is None:
+                est["candidato"] = ts
+            if ts - est["candidato"] >= GEOCERCA_PERMANENCIA_SEGUNDOS:
+                est["dentro"] = dentro
+                est["candidato"] = None
+                est["desde"] = ts
+                transicion = True
+                if not dentro:
+                    alerta = "salida"
+                else:
+                    print(f"[GEO] {device_id} volvió al perímetro")
+
+        if (
+            alerta is None
+            and not est["dentro"]
+            and GEOCERCA_RECORDATORIO_SEGUNDOS > 0
+            and est["ultima_alerta"] is not None
+            and ts - est["ultima_alerta"] >= GEOCERCA_RECORDATORIO_SEGUNDOS
+        ):
+            alerta = "recordatorio"
+
+        if alerta:
+            est["ultima_alerta"] = ts
+        estados.poner(device_id, **est)
+
+    if transicion or alerta:
+        _persistir(device_id, est, ts)
+    return dentro, alerta
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts is not None else None
+
+
+def _epoch(valor):
+    return datetime.fromisoformat(valor).timestamp() if valor else None
+
+
+def _persistir(device_id, est, ts):
+    # last_seen deja que el spool no pise un estado más nuevo
+    try:
+        escribir(ESTADO_TABLE, "upsert", {
+            "device_id": device_id,
+            "dentro": est["dentro"],
+            "desde": _iso(est["desde"]),
+            "ultima_alerta": _iso(est["ultima_alerta"]),
+            "last_seen": _iso(ts),
+        }, on_conflict="device_id")
+    except Exception as e:
+        print(f"[ERR] estado de geocerca de {device_id}: {e}")
+
+
+@profiling.trazar("geofence.alerta")
+def insertar_alerta(device_id, alerta, via, lat, lon, ahora_utc):
+    if alerta == "recordatorio":
+        desc = f"El dispositivo {device_id} sigue fuera del perímetro ({via})"
+    else:
+        desc = f"El dispositivo {device_id} está fuera del perímetro ({via})"
+
+    escribir('alertas', 'insert', {
+        "desc": desc,
+        "type": "notify",
+        "created_at": ahora_utc.isoformat(),
+        "resumen": f"{device_id} fuera de perimetro",
+        "guilty": "Tracker",
+        "coords": [lat, lon]
+    })
+
+
+def cargar(posiciones):
+    """
+    Reconstruye el estado al iniciar, sin generar alertas: el guardado en
+    geofence_state y, para equipos que nunca cambiaron de lado, la última
+    posición conocida. Trae todas las geocercas en una sola consulta.
+    """
+    ahora = time.time()
+    expira = time.monotonic() + GEOCERCA_CACHE_SEGUNDOS
+
+    for fila in iter_keyset("device", "device_id, empresas(geocercas)", key="device_id"):
+        geocerca_raw = (fila.get("empresas") or {}).get("geocercas")
+        if geocerca_raw:
+            device_perimeter_cache[fila["device_id"]] = (Polygon(geocerca_raw), expira)
+
+    guardados = {
+        fila["device_id"]: fila
+        for fila in iter_keyset(ESTADO_TABLE, "device_id, dentro, desde, ultima_alerta", key="device_id")
+    }
+
+    n = 0
+    with _lock:
+        for device_id, fila in guardados.items():
+            estados.poner(
+                device_id,
+                dentro=fila["dentro"],
+                candidato=None,
+                desde=_epoch(fila.get("desde")) or ahora,
+                ultima_alerta=_epoch(fila.get("ultima_alerta")),
+            )
+            n += 1
+
+        for device_id, pos in posiciones.items():
+            if device_id in guardados:
+                continue
+            cache = device_perimeter_cache.get(device_id)
+            if cache is None or pos.get("lat") is None or pos.get("lon") is None:
+                continue
+            dentro = cache[0].contains(Point(float(pos["lon"]), float(pos["lat"])))
+            # Si ya estaba fuera, los recordatorios siguen desde ahora
+            estados.poner(
+                device_id,
+                dentro=dentro,
+                candidato=None,
+                desde=ahora,
+                ultima_alerta=None if dentro else ahora,
+            )
+            n += 1
+    print(f"[GEO] estado de geocercas reconstruido: {n} dispositivos")
@@ -0,0 +1,171 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from utils.database import iter_keyset
+from utils.export import EXPORT_DISPOSITIVOS_LOTE
+
+# Auditoría de geocerca sobre el historial: reevalúa todas las posiciones
+# guardadas contra el polígono actual de la empresa (p. ej. después de
+# editarlo) y devuelve los intervalos fuera del perímetro.
+AUDITORIA_PAGINA = int(os.getenv("AUDITORIA_PAGINA", "1000"))
+# Filas que se evalúan juntas con contains_xy
+AUDITORIA_BLOQUE = int(os.getenv("AUDITORIA_BLOQUE", "50000"))
+# Rango máximo de una auditoría pedida por la API (el script no tiene límite)
+AUDITORIA_MAX_DIAS = float(os.getenv("AUDITORIA_MAX_DIAS", "31"))
+
+HISTORY_TABLE = "device_position_history"
+
+
+class AuditoriaInvalida(ValueError):
+    pass
+
+
+def _epoch(valor):
+    return datetime.fromisoformat(valor.replace("Z", "+00:00")).timestamp()
+
+
+def _iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+def dispositivos(device_id=None, empresa=None):
+    """device_id -> Polygon de su empresa (los que no tienen geocerca quedan fuera)."""
+    filtros = {}
+    if device_id:
+        filtros["device_id"] = device_id
+    if empresa:
+        filtros["empresas.id"] = empresa
+
+    resultado = {}
+    poligonos = {}
+    for fila in iter_keyset("device", "device_id, empresas!inner(id, geocercas)", filtros=filtros, key="device_id"):
+        emp = fila.get("empresas") or {}
+        if not emp.get("geocercas"):
+            continue
+        # Un solo Polygon por empresa, compartido por sus dispositivos
+        if emp["id"] not in poligonos:
+            poligono = Polygon(emp["geocercas"])
+            shapely.prepare(poligono)
+            poligonos[emp["id"]] = poligono
+        resultado[fila["device_id"]] = poligonos[emp["id"]]
+    return resultado
+
+
+def _evaluar(filas, codigos, poligonos):
+    """Contención vectorizada de un bloque; devuelve (códigos, epochs, dentro)."""
+    n = len(filas)
+    dev = np.fromiter((codigos[f["device_id"]] for f in filas), dtype=np.int32, count=n)
+    lats = np.fromiter((f["lat"] if f["lat"] is not None else np.nan for f in filas), dtype=np.float64, count=n)
+    lons = np.fromiter((f["lon"] if f["lon"] is not None else np.nan for f in filas), dtype=np.float64, count=n)
+    ts = np.fromiter((_epoch(f["observed_at"]) for f in filas), dtype=np.float64, count=n)
+
+    validos = np.isfinite(lats) & np.isfinite(lons)
+    dev, lats, lons, ts = dev[validos], lats[validos], lons[validos], ts[validos]
+
+    dentro = np.empty(len(dev), dtype=bool)
+    for codigo in np.unique(dev):
+        mascara = dev == codigo
+        dentro[mascara] = shapely.contains_xy(poligonos[codigo], lons[mascara], lats[mascara])
+    return dev, ts, dentro
+
+
+def _intervalos(dev, ts, dentro):
+    """Rachas fuera del perímetro por dispositivo, con hora de salida y de vuelta."""
+    orden = np.lexsort((ts, dev))
+    dev, ts, fuera = dev[orden], ts[orden], ~dentro[orden]
+    if not len(dev):
+        return []
+
+    mismo_prev = np.r_[False, dev[1:] == dev[:-1]]
+    mismo_sig = np.r_[dev[1:] == dev[:-1], False]
+    fuera_prev = np.r_[False, fuera[:-1]] & mismo_prev
+    fuera_sig = np.r_[fuera[1:], False] & mismo_sig
+
+    inicios = np.flatnonzero(fuera & ~fuera_prev)
+    fines = np.flatnonzero(fuera & ~fuera_sig)
+    # El punto siguiente al último fuera (si es del mismo equipo) marca la vuelta
+    vuelve = mismo_sig[fines]
+
+    return [
+        (int(dev[i]), ts[i], ts[j + 1] if v else None, ts[j], int(j - i + 1))
+        for i, j, v in zip(inicios, fines, vuelve)
+    ]
+
+
+def acotar(desde, hasta):
+    """
+    (desde, hasta) de una auditoría de la API: sin desde se toman los
+    últimos AUDITORIA_MAX_DIAS; un rango mayor levanta AuditoriaInvalida.
+    """
+    hasta = hasta or datetime.now(timezone.utc)
+    maximo = timedelta(days=AUDITORIA_MAX_DIAS)
+    desde = desde or hasta - maximo
+    if hasta - desde > maximo:
+        raise AuditoriaInvalida(f"el rango no puede superar {AUDITORIA_MAX_DIAS:g} días")
+    return desde, hasta
+
+
+def auditar(device_id=None, empresa=None, desde=None, hasta=None):
+    """
+    Reevalúa device_position_history de un dispositivo o de una empresa
+    entre desde y hasta (datetimes, opcionales) contra la geocerca actual.
+    """
+    poligonos_por_device = dispositivos(device_id, empresa)
+    if not poligonos_por_device:
+        return {"puntos": 0, "fuera": 0, "dispositivos": 0, "intervalos": []}
+
+    nombres = list(poligonos_por_device)
+    codigos = {d: i for i, d in enumerate(nombres)}
+    poligonos = [poligonos_por_device[d] for d in nombres]
+
+    rangos = []
+    if desde:
+        rangos.append(("observed_at", "gte", desde.isoformat()))
+    if hasta:
+        rangos.append(("observed_at", "lt", hasta.isoformat()))
+
+    partes = []
+    bloque = []
+    # De a EXPORT_DISPOSITIVOS_LOTE equipos por consulta, para no pasarse del largo de URL
+    for i in range(0, len(nombres), EXPORT_DISPOSITIVOS_LOTE):
+        grupo = nombres[i:i + EXPORT_DISPOSITIVOS_LOTE]
+        filas = iter_keyset(
+            HISTORY_TABLE, "id, device_id, lat, lon, observed_at",
+            rangos=[("device_id", "in_", grupo), *rangos], page_size=AUDITORIA_PAGINA,
+        )
+        for fila in filas:
+            bloque.append(fila)
+            if len(bloque) >= AUDITORIA_BLOQUE:
+                partes.append(_evaluar(bloque, codigos, poligonos))
+                bloque = []
+    if bloque:
+        partes.append(_evaluar(bloque, codigos, poligonos))
+
+    if not partes:
+        return {"puntos": 0, "fuera": 0, "dispositivos": len(nombres), "intervalos": []}
+
+    dev = np.concatenate([p[0] for p in partes])
+    ts = np.concatenate([p[1] for p in partes])
+    dentro = np.concatenate([p[2] for p in partes])
+
+    intervalos = [
+        {
+            "device_id": nombres[codigo],
+            "salida": _iso(salida),
+            "entrada": _iso(entrada) if entrada is not None else None,
+            "ultimo_fuera": _iso(ultimo),
+            "puntos": puntos,
+            "duracion_s": round((entrada if entrada is not None else ultimo) - salida, 3),
+        }
+        for codigo, salida, entrada, ultimo, puntos in _intervalos(dev, ts, dentro)
+    ]
+    return {
+        "puntos": int(len(dev)),
+        "fuera": int((~dentro).sum()),
+        "dispositivos": len(nombres),
+        "intervalos": intervalos,
+    }
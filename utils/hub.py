@@ -0,0 +1,143 @@
+import asyncio
+import os
+import threading
+import time
+
+from utils import profiling, registry
+from utils.database import supabase
+
+# Pub/sub en proceso para empujar posiciones y estados de torres a los
+# dashboards (WebSocket / SSE). Cada cliente tiene una cola acotada; si
+# no alcanza a leer, se descartan los eventos más antiguos. Cada evento
+# va solo a los suscriptores de la empresa dueña del equipo o torre.
+HUB_QUEUE_MAX = int(os.getenv("HUB_QUEUE_MAX", "256"))
+EMPRESA_CACHE_SEGUNDOS = float(os.getenv("EMPRESA_CACHE_SEGUNDOS", "600"))
+
+_loop = None
+suscriptores = set()
+# Referencias a las tareas en curso (el loop solo guarda referencias débiles)
+_tareas = set()
+
+# key: (tabla, id), value: (empresa_id, expira)
+_empresas = {}
+_lock = threading.Lock()
+
+
+class Suscriptor:
+    def __init__(self, empresa=None):
+        self.empresa = empresa
+        self.cola = asyncio.Queue(maxsize=HUB_QUEUE_MAX)
+        self.descartados = 0
+
+    def entregar(self, evento):
+        if self.cola.full():
+            # drop-oldest: el evento nuevo siempre entra
+            self.cola.get_nowait()
+            self.descartados += 1
+        self.cola.put_nowait(evento)
+
+
+def iniciar():
+    """Registra el event loop donde viven las colas (se llama al iniciar)."""
+    global _loop
+    _loop = asyncio.get_running_loop()
+
+
+def suscribir(empresa) -> Suscriptor:
+    sub = Suscriptor(str(empresa))
+    suscriptores.add(sub)
+    return sub
+
+
+def desuscribir(sub: Suscriptor):
+    suscriptores.discard(sub)
+
+
+def _repartir(evento, empresa):
+    if empresa is None:
+        return  # sin dueño conocido no se muestra a nadie
+    for sub in list(suscriptores):
+        if sub.empresa == empresa:
+            sub.entregar(evento)
+
+
+@profiling.trazar("hub.publicar")
+def publicar(evento: dict, empresa=None):
+    """Publica un evento; se puede llamar desde el loop o desde un thread."""
+    if _loop is None or not suscriptores:
+        return
+    empresa = str(empresa) if empresa is not None else None
+
+    if _en_loop():
+        _repartir(evento, empresa)
+    else:
+        _loop.call_soon_threadsafe(_repartir, evento, empresa)
+
+
+def _en_loop():
+    try:
+        return asyncio.get_running_loop() is _loop
+    except RuntimeError:
+        return False
+
+
+def _cacheada(tabla, valor):
+    """(True, empresa) si está en cache y vigente; (False, None) si no."""
+    with _lock:
+        cache = _empresas.get((tabla, valor))
+    if cache and cache[1] > time.monotonic():
+        return True, cache[0]
+    return False, None
+
+
+def empresa_de(tabla, columna, valor):
+    """Empresa dueña de un dispositivo/torre (vía la relación empresas), con cache. Bloquea."""
+    ahora = time.monotonic()
+    encontrada, empresa = _cacheada(tabla, valor)
+    if encontrada:
+        return empresa
+
+    try:
+        res = supabase.table(tabla).select("empresas(id)").eq(columna, valor).limit(1).execute()
+        fila = res.data[0] if res.data else {}
+        empresa = (fila.get("empresas") or {}).get("id")
+    except Exception:
+        empresa = None
+
+    with _lock:
+        _empresas[(tabla, valor)] = (empresa, ahora + EMPRESA_CACHE_SEGUNDOS)
+    return empresa
+
+
+async def _resolver_y_publicar(evento, tabla, columna, valor):
+    publicar(evento, await asyncio.to_thread(empresa_de, tabla, columna, valor))
+
+
+def _publicar_de(evento, tabla, columna, valor):
+    """Publica para la empresa dueña; desde el loop la consulta a la base va a un thread."""
+    encontrada, empresa = _cacheada(tabla, valor)
+    if encontrada:
+        publicar(evento, empresa)
+    elif _en_loop():
+        tarea = _loop.create_task(_resolver_y_publicar(evento, tabla, columna, valor))
+        _tareas.add(tarea)
+        tarea.add_done_callback(_tareas.discard)
+    else:
+        publicar(evento, empresa_de(tabla, columna, valor))
+
+
+def publicar_posicion(device_id, fila: dict):
+    if _loop is None or not suscriptores:
+        return
+    evento = {"type": "position", "device_id": device_id, "data": fila}
+    empresa = registry.empresa_de(device_id)
+    if empresa is not None:
+        publicar(evento, empresa)
+    else:
+        _publicar_de(evento, "device", "device_id", device_id)
+
+
+def publicar_torre(client_id, update_data: dict, columna="client_id"):
+    if _loop is None or not suscriptores:
+        return
+    _publicar_de({"type": "tower", columna: client_id, "data": update_data}, "tower_value", columna, client_id)
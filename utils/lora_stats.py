@@ -0,0 +1,400 @@
+import math
+import os
+import threading
+from datetime import datetime, timezone
+
+from utils import registry
+from utils.database import iter_keyset
+from utils.resilience import escribir
+
+# Estadísticas LoRaWAN acumuladas al recibir cada uplink de TTN/Abeeway:
+# señal por gateway (todas las entradas de rx_metadata), por dispositivo
+# (mejor gateway de cada uplink), cobertura por celda de grilla y
+# tendencia de batería por dispositivo. Se guardan los acumulados (no
+# los promedios) para poder seguir sumando; cada LORA_FLUSH_SEGUNDOS se
+# envía en bloque lo acumulado desde el flush anterior y la base lo suma
+# (varias instancias o un reintento no pisan lo que escribió otra):
+#
+#   create function merge_lora_device_stats(filas jsonb) returns void language sql as $$
+#     insert into lora_device_stats as t
+#     select * from jsonb_populate_recordset(null::lora_device_stats, filas)
+#     on conflict (device_id) do update set
+#       uplinks = t.uplinks + excluded.uplinks,
+#       recepciones = t.recepciones + excluded.recepciones,
+#       rssi_n = t.rssi_n + excluded.rssi_n,
+#       rssi_sum = t.rssi_sum + excluded.rssi_sum,
+#       rssi_min = least(t.rssi_min, excluded.rssi_min),
+#       rssi_max = greatest(t.rssi_max, excluded.rssi_max),
+#       rssi_avg = (t.rssi_sum + excluded.rssi_sum) / nullif(t.rssi_n + excluded.rssi_n, 0),
+#       snr_n = t.snr_n + excluded.snr_n,
+#       snr_sum = t.snr_sum + excluded.snr_sum,
+#       snr_min = least(t.snr_min, excluded.snr_min),
+#       snr_max = greatest(t.snr_max, excluded.snr_max),
+#       snr_avg = (t.snr_sum + excluded.snr_sum) / nullif(t.snr_n + excluded.snr_n, 0),
+#       last_seen = greatest(t.last_seen, excluded.last_seen)
+#   $$;
+#
+# merge_lora_gateway_stats (empresa_id, gateway_id) y merge_lora_coverage
+# (empresa_id, cell) son iguales. Gateways y celdas se acumulan por
+# empresa del dispositivo (cada empresa ve solo lo que generaron sus
+# equipos; los de equipos sin empresa no se acumulan), así que su clave
+# única incluye empresa_id:
+#
+#   alter table lora_gateway_stats add column empresa_id bigint;
+#   create unique index on lora_gateway_stats (empresa_id, gateway_id);
+#   (lo mismo en lora_coverage con (empresa_id, cell))
+#
+# La tendencia de batería no se suma: merge_lora_battery_trend
+# reemplaza la fila solo si excluded.last_seen > t.last_seen.
+LORA_FLUSH_SEGUNDOS = float(os.getenv("LORA_FLUSH_SEGUNDOS", "60"))
+# Lado de la celda de cobertura (0.005° ≈ 550 m)
+LORA_CELDA_GRADOS = float(os.getenv("LORA_CELDA_GRADOS", "0.005"))
+# La regresión de batería pesa la mitad a las muestras de hace esta cantidad de horas
+LORA_BATERIA_VIDA_MEDIA_HORAS = float(os.getenv("LORA_BATERIA_VIDA_MEDIA_HORAS", "72"))
+
+GATEWAYS_TABLE = "lora_gateway_stats"
+DEVICES_TABLE = "lora_device_stats"
+COVERAGE_TABLE = "lora_coverage"
+BATTERY_TABLE = "lora_battery_trend"
+
+_SENAL_COLUMNAS = (
+    "uplinks", "recepciones", "rssi_n", "rssi_sum", "rssi_min", "rssi_max",
+    "snr_n", "snr_sum", "snr_min", "snr_max", "last_seen",
+)
+_BATERIA_COLUMNAS = ("t0", "t", "w", "st", "sb", "stt", "stb", "battery", "last_seen")
+
+
+def _menor(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _mayor(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def _num(valor):
+    try:
+        valor = float(valor)
+    except (TypeError, ValueError):
+        return None
+    return valor if math.isfinite(valor) else None
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts is not None else None
+
+
+def _epoch(valor):
+    return datetime.fromisoformat(valor).timestamp() if valor else None
+
+
+class Senal:
+    """Acumulado de RSSI/SNR: conteos, sumas y extremos."""
+
+    __slots__ = _SENAL_COLUMNAS
+
+    def __init__(self):
+        self.uplinks = 0
+        self.recepciones = 0
+        self.rssi_n = 0
+        self.rssi_sum = 0.0
+        self.rssi_min = None
+        self.rssi_max = None
+        self.snr_n = 0
+        self.snr_sum = 0.0
+        self.snr_min = None
+        self.snr_max = None
+        self.last_seen = None
+
+    def agregar(self, rssi, snr, ts, recepciones=1):
+        self.uplinks += 1
+        self.recepciones += recepciones
+        if rssi is not None:
+            self.rssi_n += 1
+            self.rssi_sum += rssi
+            self.rssi_min = _menor(self.rssi_min, rssi)
+            self.rssi_max = _mayor(self.rssi_max, rssi)
+        if snr is not None:
+            self.snr_n += 1
+            self.snr_sum += snr
+            self.snr_min = _menor(self.snr_min, snr)
+            self.snr_max = _mayor(self.snr_max, snr)
+        self.last_seen = ts
+
+    def combinar(self, otro):
+        """Suma otro acumulado a este (mismo criterio que las funciones merge_*)."""
+        for col in ("uplinks", "recepciones", "rssi_n", "rssi_sum", "snr_n", "snr_sum"):
+            setattr(self, col, getattr(self, col) + getattr(otro, col))
+        self.rssi_min = _menor(self.rssi_min, otro.rssi_min)
+        self.rssi_max = _mayor(self.rssi_max, otro.rssi_max)
+        self.snr_min = _menor(self.snr_min, otro.snr_min)
+        self.snr_max = _mayor(self.snr_max, otro.snr_max)
+        self.last_seen = _mayor(self.last_seen, otro.last_seen)
+        return self
+
+    def fila(self):
+        fila = {col: getattr(self, col) for col in _SENAL_COLUMNAS}
+        fila["last_seen"] = _iso(self.last_seen)
+        fila["rssi_avg"] = round(self.rssi_sum / self.rssi_n, 2) if self.rssi_n else None
+        fila["snr_avg"] = round(self.snr_sum / self.snr_n, 2) if self.snr_n else None
+        return fila
+
+    @classmethod
+    def desde_fila(cls, fila):
+        senal = cls()
+        for col in _SENAL_COLUMNAS:
+            if fila.get(col) is not None:
+                setattr(senal, col, fila[col])
+        senal.last_seen = _epoch(fila.get("last_seen"))
+        return senal
+
+
+class Bateria:
+    """
+    Regresión lineal batería ~ tiempo con sumas ponderadas que decaen
+    con LORA_BATERIA_VIDA_MEDIA_HORAS: sigue la tendencia reciente sin
+    guardar las muestras. t en horas desde t0.
+    """
+
+    __slots__ = _BATERIA_COLUMNAS
+
+    def __init__(self, ts):
+        self.t0 = ts
+        self.t = 0.0
+        self.w = self.st = self.sb = self.stt = self.stb = 0.0
+        self.battery = None
+        self.last_seen = None
+
+    def agregar(self, ts, valor):
+        t = (ts - self.t0) / 3600
+        if self.w:
+            factor = 0.5 ** (max(t - self.t, 0.0) / LORA_BATERIA_VIDA_MEDIA_HORAS)
+            self.w *= factor
+            self.st *= factor
+            self.sb *= factor
+            self.stt *= factor
+            self.stb *= factor
+        self.w += 1
+        self.st += t
+        self.sb += valor
+        self.stt += t * t
+        self.stb += t * valor
+        self.t = max(self.t, t)
+        self.battery = valor
+        self.last_seen = ts
+
+    def pendiente_dia(self):
+        """Variación de batería por día (negativa = descarga), o None si no alcanza."""
+        varianza = self.w * self.stt - self.st * self.st
+        if self.w < 2 or varianza <= 1e-9 * max(self.w * self.stt, 1):
+            return None
+        return (self.w * self.stb - self.st * self.sb) / varianza * 24
+
+    def fila(self):
+        fila = {col: getattr(self, col) for col in _BATERIA_COLUMNAS}
+        fila["t0"] = _iso(self.t0)
+        fila["last_seen"] = _iso(self.last_seen)
+        pendiente = self.pendiente_dia()
+        fila["slope_per_day"] = round(pendiente, 4) if pendiente is not None else None
+        fila["days_to_empty"] = (
+            round(self.battery / -pendiente, 1)
+            if pendiente is not None and pendiente < 0 and self.battery is not None
+            else None
+        )
+        return fila
+
+    @classmethod
+    def desde_fila(cls, fila):
+        bateria = cls(_epoch(fila["t0"]))
+        for col in ("t", "w", "st", "sb", "stt", "stb", "battery"):
+            if fila.get(col) is not None:
+                setattr(bateria, col, fila[col])
+        bateria.last_seen = _epoch(fila.get("last_seen"))
+        return bateria
+
+
+# (empresa_id, gateway_id) -> Senal
+gateways = {}
+dispositivos = {}
+# (empresa_id, "i:j" índices de la grilla) -> Senal
+celdas = {}
+baterias = {}
+# Lo sumado desde el último flush (clave -> Senal), por tabla de señal
+_deltas = {GATEWAYS_TABLE: {}, DEVICES_TABLE: {}, COVERAGE_TABLE: {}}
+# Baterías con cambios sin escribir
+_baterias_sucias = set()
+_lock = threading.Lock()
+
+
+def _celda(lat, lon):
+    return f"{math.floor(lat / LORA_CELDA_GRADOS)}:{math.floor(lon / LORA_CELDA_GRADOS)}"
+
+
+def _centro(celda):
+    i, j = (int(x) for x in celda.split(":"))
+    return {"lat": (i + 0.5) * LORA_CELDA_GRADOS, "lon": (j + 0.5) * LORA_CELDA_GRADOS}
+
+
+def registrar(uplink: dict, ts: float):
+    """Suma un uplink decodificado (utils.ttn) a todos los agregados."""
+    device_id = uplink["device_id"]
+    recepciones = [(g["gateway_id"], _num(g["rssi"]), _num(g["snr"])) for g in uplink.get("gateways") or []]
+    if recepciones:
+        # El enlace del dispositivo es el del mejor gateway de cada uplink
+        _, rssi, snr = max(recepciones, key=lambda r: r[1] if r[1] is not None else -math.inf)
+    else:
+        rssi, snr = _num(uplink.get("rssi")), _num(uplink.get("snr"))
+    battery = _num(uplink.get("battery"))
+    gnss = uplink.get("gnss")
+    empresa = registry.empresa_de(device_id)
+
+    def sumar(tabla, totales, clave, *args):
+        totales.setdefault(clave, Senal()).agregar(*args)
+        _deltas[tabla].setdefault(clave, Senal()).agregar(*args)
+
+    with _lock:
+        if empresa is not None:
+            for gateway_id, g_rssi, g_snr in recepciones:
+                sumar(GATEWAYS_TABLE, gateways, (empresa, gateway_id), g_rssi, g_snr, ts)
+
+        sumar(DEVICES_TABLE, dispositivos, device_id, rssi, snr, ts, len(recepciones))
+
+        if gnss is not None and empresa is not None:
+            sumar(COVERAGE_TABLE, celdas, (empresa, _celda(*gnss)), rssi, snr, ts, len(recepciones))
+
+        if battery is not None:
+            bateria = baterias.get(device_id)
+            if bateria is None:
+                bateria = baterias[device_id] = Bateria(ts)
+            bateria.agregar(ts, battery)
+            _baterias_sucias.add(device_id)
+
+
+_CLAVES = {
+    GATEWAYS_TABLE: "gateway_id",
+    DEVICES_TABLE: "device_id",
+    COVERAGE_TABLE: "cell",
+    BATTERY_TABLE: "device_id",
+}
+
+
+def _filas(tabla, acumulados):
+    """Filas de la tabla para un dict clave -> Senal/Bateria."""
+    clave = _CLAVES[tabla]
+    if tabla == COVERAGE_TABLE:
+        return [{"empresa_id": e, clave: k, **_centro(k), **v.fila()} for (e, k), v in acumulados.items()]
+    if tabla == GATEWAYS_TABLE:
+        return [{"empresa_id": e, clave: k, **v.fila()} for (e, k), v in acumulados.items()]
+    return [{clave: k, **v.fila()} for k, v in acumulados.items()]
+
+
+def flush():
+    """Una llamada merge_<tabla> por tabla con lo acumulado desde el último flush."""
+    total = 0
+    for tabla in (GATEWAYS_TABLE, DEVICES_TABLE, COVERAGE_TABLE):
+        with _lock:
+            deltas = _deltas[tabla]
+            if not deltas:
+                continue
+            _deltas[tabla] = {}
+            filas = _filas(tabla, deltas)
+        try:
+            escribir(f"merge_{tabla}", "rpc", filas)
+        except Exception:
+            # Lo no escrito vuelve a sumarse a lo que llegó mientras tanto
+            with _lock:
+                pendientes = _deltas[tabla]
+                for clave, delta in deltas.items():
+                    if clave in pendientes:
+                        delta.combinar(pendientes[clave])
+                    pendientes[clave] = delta
+            raise
+        total += len(filas)
+
+    with _lock:
+        claves = _baterias_sucias.copy()
+        _baterias_sucias.clear()
+        filas = _filas(BATTERY_TABLE, {k: baterias[k] for k in claves})
+    if filas:
+        try:
+            escribir(f"merge_{BATTERY_TABLE}", "rpc", filas)
+        except Exception:
+            with _lock:
+                _baterias_sucias.update(claves)
+            raise
+        total += len(filas)
+    return total
+
+
+def cargar():
+    """
+    Recupera los acumulados escritos para las consultas (se llama al
+    iniciar). Lo que llegó antes de cargar se suma a lo leído; la base no
+    cambia porque solo recibe deltas.
+    """
+    nuevos = {
+        GATEWAYS_TABLE: {
+            (f["empresa_id"], f["gateway_id"]): Senal.desde_fila(f)
+            for f in iter_keyset(GATEWAYS_TABLE, "*", key="gateway_id", desempate="empresa_id")
+        },
+        DEVICES_TABLE: {f["device_id"]: Senal.desde_fila(f) for f in iter_keyset(DEVICES_TABLE, "*", key="device_id")},
+        COVERAGE_TABLE: {
+            (f["empresa_id"], f["cell"]): Senal.desde_fila(f)
+            for f in iter_keyset(COVERAGE_TABLE, "*", key="cell", desempate="empresa_id")
+        },
+        BATTERY_TABLE: {f["device_id"]: Bateria.desde_fila(f) for f in iter_keyset(BATTERY_TABLE, "*", key="device_id")},
+    }
+    with _lock:
+        for tabla, destino in ((GATEWAYS_TABLE, gateways), (DEVICES_TABLE, dispositivos), (COVERAGE_TABLE, celdas)):
+            for clave, valor in nuevos[tabla].items():
+                actual = destino.get(clave)
+                destino[clave] = valor.combinar(actual) if actual is not None else valor
+        for clave, valor in nuevos[BATTERY_TABLE].items():
+            baterias.setdefault(clave, valor)
+    print(
+        f"[LORA] agregados cargados: {len(gateways)} gateways, {len(dispositivos)} dispositivos, "
+        f"{len(celdas)} celdas"
+    )
+
+
+# ================== CONSULTAS ==================
+
+def _de_empresa(acumulados, empresa):
+    return {clave: v for clave, v in acumulados.items() if str(clave[0]) == str(empresa)}
+
+
+def lista_gateways(empresa):
+    """Gateways vistos por los equipos de la empresa (solo sus uplinks)."""
+    with _lock:
+        filas = _filas(GATEWAYS_TABLE, _de_empresa(gateways, empresa))
+    return sorted(filas, key=lambda f: f["uplinks"], reverse=True)
+
+
+def dispositivo(device_id, empresa):
+    if not registry.pertenece(device_id, empresa):
+        return None
+    with _lock:
+        enlace = dispositivos.get(device_id)
+        bateria = baterias.get(device_id)
+        if enlace is None and bateria is None:
+            return None
+        return {
+            "device_id": device_id,
+            "link": enlace.fila() if enlace else None,
+            "battery": bateria.fila() if bateria else None,
+        }
+
+
+def cobertura(empresa, lat_min=-90, lat_max=90, lon_min=-180, lon_max=180):
+    with _lock:
+        filas = _filas(COVERAGE_TABLE, _de_empresa(celdas, empresa))
+    return [f for f in filas if lat_min <= f["lat"] <= lat_max and lon_min <= f["lon"] <= lon_max]
+
+
+def descarga(empresa, limite=50):
+    """Dispositivos de la empresa con la batería bajando más rápido."""
+    with _lock:
+        propias = {k: v for k, v in baterias.items() if registry.pertenece(k, empresa)}
+        filas = [f for f in _filas(BATTERY_TABLE, propias) if f["slope_per_day"] is not None]
+    filas.sort(key=lambda f: f["slope_per_day"])
+    return filas[:limite]
@@ -0,0 +1,27 @@
+import os
+import socket
+import ssl
+
+import aiomqtt
+
+# Conexión directa al broker (EMQX). Suscriptor (MQTT_SUBSCRIBE) y
+# publicador (MQTT_PUBLISHER) se activan por separado; sin ellos se sigue
+# usando el webhook y la API REST de EMQX.
+MQTT_HOST = os.getenv("MQTT_HOST")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+MQTT_USER = os.getenv("MQTT_USER")
+MQTT_PASS = os.getenv("MQTT_PASS")
+MQTT_TLS = os.getenv("MQTT_TLS", "0") == "1"
+
+
+def nuevo_cliente(rol: str, **kwargs) -> aiomqtt.Client:
+    """Cliente con identificador único por proceso y rol (sub/pub)."""
+    return aiomqtt.Client(
+        MQTT_HOST,
+        MQTT_PORT,
+        username=MQTT_USER,
+        password=MQTT_PASS,
+        identifier=f"skyconnect-{rol}-{socket.gethostname()}-{os.getpid()}",
+        tls_context=ssl.create_default_context() if MQTT_TLS else None,
+        **kwargs,
+    )
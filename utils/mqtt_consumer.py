@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+
+import aiomqtt
+
+from utils import hub, rollups
+from utils.database import supabase
+from utils.resilience import ejecutar
+from utils.mqtt import MQTT_HOST, MQTT_PORT, nuevo_cliente
+from utils.emqx import (
+    normalize_emqx_topic,
+    parse_mqtt_payload,
+    clean_device_topic,
+    update_desde_estados,
+    update_desde_mensaje,
+    actualizar_conexion,
+    request_ha_states_after_connect,
+)
+
+# Suscriptor MQTT nativo; reemplaza al webhook HTTP de EMQX. Se activa con
+# MQTT_SUBSCRIBE=1 (requiere MQTT_HOST, ver utils/mqtt.py): con el webhook
+# todavía configurado en EMQX cada mensaje se procesaría dos veces. Varias
+# instancias con el mismo MQTT_SHARE_GROUP se reparten los mensajes
+# (suscripción compartida $share).
+MQTT_SUBSCRIBE = os.getenv("MQTT_SUBSCRIBE", "0") == "1" and bool(MQTT_HOST)
+MQTT_SHARE_GROUP = os.getenv("MQTT_SHARE_GROUP", "skyconnect")
+# Por defecto solo los topics que arma update_desde_mensaje (con sus /set)
+# y las respuestas de estados; "#" traería también lo que no se usa.
+MQTT_TOPICS_DEFECTO = ",".join([
+    "+/state/response",
+    "+/pertiga/#",
+    "+/enchufe/#",
+    "+/luz/#",
+    "+/tablero/#",
+    "+/domotica/#",
+])
+MQTT_TOPICS = [t.strip() for t in os.getenv("MQTT_TOPICS", MQTT_TOPICS_DEFECTO).split(",") if t.strip()]
+# Eventos de conexión que publica EMQX
+MQTT_SYS_TOPICS = [
+    "$SYS/brokers/+/clients/+/connected",
+    "$SYS/brokers/+/clients/+/disconnected",
+]
+
+# Micro-lotes: se procesa al juntar MQTT_BATCH_MAX mensajes o al pasar MQTT_BATCH_MS
+MQTT_BATCH_MAX = int(os.getenv("MQTT_BATCH_MAX", "200"))
+MQTT_BATCH_MS = float(os.getenv("MQTT_BATCH_MS", "200"))
+MQTT_QUEUE_MAX = int(os.getenv("MQTT_QUEUE_MAX", "10000"))
+
+# Referencias a las tareas en curso (el loop solo guarda referencias débiles)
+_tareas = set()
+
+
+def _suscripciones():
+    return [f"$share/{MQTT_SHARE_GROUP}/{t}" for t in MQTT_TOPICS + MQTT_SYS_TOPICS]
+
+
+def _evento_conexion(topic: str, payload: bytes):
+    """$SYS/brokers/<nodo>/clients/<clientid>/<connected|disconnected>"""
+    partes = topic.split("/")
+    datos = json.loads(payload) if payload else {}
+    if not isinstance(datos, dict):
+        raise ValueError("el evento no es un objeto JSON")
+    mqtt_clientid = str(datos.get("clientid") or partes[-2]).strip()
+    return mqtt_clientid, f"client.{partes[-1]}", datos.get("reason")
+
+
+def _update_mensaje(topic: str, payload: bytes):
+    """
+    Mismo armado que /emqx-webhook para un mensaje.
+    Devuelve (client_id, update_data) o None si se ignora.
+    """
+    topic = normalize_emqx_topic(topic)
+    topic_sin_set = clean_device_topic(topic)
+
+    if not topic_sin_set or not payload:
+        return None
+
+    # El backend publica esta solicitud; no modifica la base de datos.
+    if topic.endswith("/state/request"):
+        return None
+
+    datos = parse_mqtt_payload(payload.decode("utf-8"))
+    if not isinstance(datos, dict):
+        raise ValueError("el payload no es un objeto JSON")
+    topic_id = topic_sin_set.split("/")[0]
+
+    if topic.endswith("/state/response"):
+        client_id = str(datos.get("client_id") or topic_id).strip().strip("/")
+        states = datos.get("states")
+        if not isinstance(states, dict):
+            return None
+        update_data = update_desde_estados(client_id, None, states)
+        # Solo las tres propiedades iniciales: sin estados válidos
+        if len(update_data) == 3:
+            return None
+    else:
+        client_id = topic_id
+        update_data = update_desde_mensaje(topic_sin_set, None, datos)
+        rollups.registrar(client_id, datos)
+
+    # Por MQTT no conocemos el clientid del que publicó; no lo pisamos.
+    update_data.pop("mqtt_clientid")
+    return client_id, update_data
+
+
+def procesar_lote(mensajes):
+    """
+    Procesa un micro-lote de (topic, payload). Los updates de una misma
+    torre se combinan en uno solo, respetando el orden de llegada.
+    Devuelve [(client_id, mqtt_clientid)] a los que hay que pedir estados.
+    """
+    updates = {}
+    pedir_estados = []
+
+    def volcar():
+        # El broker ya confirmó estos mensajes: una torre que falla no
+        # arrastra a las demás del lote
+        for client_id, update_data in updates.items():
+            try:
+                ejecutar(supabase.table("tower_value").update(update_data).eq("client_id", client_id), reintentos=2)
+            except Exception as error:
+                print(f"[ERR] update de tower_value {client_id}: {error}")
+                continue
+            hub.publicar_torre(client_id, update_data)
+        updates.clear()
+
+    for topic, payload in mensajes:
+        try:
+            if topic.startswith("$SYS/"):
+                mqtt_clientid, event, reason = _evento_conexion(topic, payload)
+                # Lo anterior al evento se escribe antes para no pisar online
+                volcar()
+                conexion = actualizar_conexion(mqtt_clientid, event, reason)
+                if conexion:
+                    pedir_estados.extend((client_id, mqtt_clientid) for client_id in conexion[3])
+                continue
+
+            resultado = _update_mensaje(topic, payload)
+            if resultado:
+                client_id, update_data = resultado
+                updates.setdefault(client_id, {}).update(update_data)
+
+        except (ValueError, UnicodeDecodeError) as error:
+            print(f"[MQTT] mensaje inválido en {topic}: {error}")
+        except Exception as error:
+            print(f"[ERR] mensaje MQTT en {topic}: {error}")
+
+    volcar()
+    return pedir_estados
+
+
+async def _procesar(cola: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        lote = [await cola.get()]
+        limite = loop.time() + MQTT_BATCH_MS / 1000
+
+        while len(lote) < MQTT_BATCH_MAX:
+            restante = limite - loop.time()
+            if restante <= 0:
+                break
+            try:
+                lote.append(await asyncio.wait_for(cola.get(), restante))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            pedir_estados = await asyncio.to_thread(procesar_lote, lote)
+        except Exception as error:
+            print(f"[ERR] lote MQTT ({len(lote)} mensajes): {error}")
+            continue
+
+        for client_id, mqtt_clientid in pedir_estados:
+            tarea = asyncio.create_task(request_ha_states_after_connect(client_id, mqtt_clientid))
+            _tareas.add(tarea)
+            tarea.add_done_callback(_tareas.discard)
+
+
+async def consumir():
+    """Mantiene la conexión al broker y reconecta con backoff."""
+    cola = asyncio.Queue(maxsize=MQTT_QUEUE_MAX)
+    procesador = asyncio.create_task(_procesar(cola))
+    espera = 1
+
+    try:
+        while True:
+            try:
+                async with nuevo_cliente("sub") as client:
+                    for filtro in _suscripciones():
+                        await client.subscribe(filtro, qos=1)
+                    print(f"[MQTT] suscrito en {MQTT_HOST}:{MQTT_PORT} ({MQTT_SHARE_GROUP})")
+                    espera = 1
+
+                    async for message in client.messages:
+                        await cola.put((str(message.topic), message.payload))
+
+            except aiomqtt.MqttError as error:
+                print(f"[MQTT] conexión perdida: {error}; reintento en {espera}s")
+                await asyncio.sleep(espera)
+                espera = min(espera * 2, 60)
+    finally:
+        procesador.cancel()
@@ -0,0 +1,111 @@
+import asyncio
+import collections
+import os
+
+import aiomqtt
+
+from utils import profiling
+from utils.mqtt import MQTT_HOST, nuevo_cliente
+
+# Publicación por una conexión MQTT persistente en vez de la API REST de
+# EMQX. Se activa con MQTT_PUBLISHER=1 (requiere MQTT_HOST).
+MQTT_PUBLISHER = os.getenv("MQTT_PUBLISHER", "0") == "1" and bool(MQTT_HOST)
+# Publicaciones QoS 1 esperando PUBACK al mismo tiempo
+MQTT_PUB_INFLIGHT = int(os.getenv("MQTT_PUB_INFLIGHT", "20"))
+# Mensajes en espera mientras no hay conexión o la ventana está llena
+MQTT_PUB_QUEUE_MAX = int(os.getenv("MQTT_PUB_QUEUE_MAX", "1000"))
+MQTT_PUB_TIMEOUT = float(os.getenv("MQTT_PUB_TIMEOUT", "5"))
+
+
+class ColaLlena(RuntimeError):
+    pass
+
+
+_cola = None
+# Mensajes que fallaron al caerse la conexión; van antes que la cola
+_reintentos = collections.deque()
+_conectado = None
+# Envíos en curso (el loop solo guarda referencias débiles a las tareas)
+_tareas = set()
+
+
+def activo() -> bool:
+    return MQTT_PUBLISHER and _cola is not None
+
+
+@profiling.trazar("mqtt.publicar")
+async def publicar(topic: str, payload: str, retain: bool = False, qos: int = 1):
+    """
+    Encola la publicación y espera el PUBACK (o la entrega, con QoS 0).
+    Lanza ColaLlena si la cola está llena y TimeoutError si no se
+    confirma en MQTT_PUB_TIMEOUT segundos.
+    """
+    futuro = asyncio.get_running_loop().create_future()
+    try:
+        _cola.put_nowait((topic, payload, retain, qos, futuro))
+    except asyncio.QueueFull:
+        raise ColaLlena("Cola de publicación MQTT llena")
+
+    # Sin shield: al vencer, wait_for cancela el futuro y el ciclo descarta
+    # el mensaje si todavía no salió (no se publica un comando tardío)
+    return await asyncio.wait_for(futuro, MQTT_PUB_TIMEOUT)
+
+
+async def _siguiente():
+    if _reintentos:
+        return _reintentos.popleft()
+    return await _cola.get()
+
+
+async def _enviar(client, ventana, item):
+    topic, payload, retain, qos, futuro = item
+    try:
+        await client.publish(topic, payload, qos=qos, retain=retain)
+        if not futuro.done():
+            futuro.set_result(True)
+    except aiomqtt.MqttError:
+        # Se reintenta al reconectar, salvo que quien publicó ya desistió
+        if not futuro.done():
+            _reintentos.append(item)
+        _conectado.clear()
+    finally:
+        ventana.release()
+
+
+async def _ciclo():
+    """Mantiene la conexión y vacía la cola respetando la ventana in-flight."""
+    espera = 1
+    while True:
+        try:
+            async with nuevo_cliente("pub", max_inflight_messages=MQTT_PUB_INFLIGHT) as client:
+                print("[MQTT] publicador conectado")
+                _conectado.set()
+                espera = 1
+                ventana = asyncio.Semaphore(MQTT_PUB_INFLIGHT)
+
+                while _conectado.is_set():
+                    item = await _siguiente()
+                    if item[4].done():
+                        continue  # timeout del lado de quien publicó
+                    await ventana.acquire()
+                    if not _conectado.is_set():
+                        ventana.release()
+                        _reintentos.appendleft(item)
+                        break
+                    tarea = asyncio.create_task(_enviar(client, ventana, item))
+                    _tareas.add(tarea)
+                    tarea.add_done_callback(_tareas.discard)
+
+        except aiomqtt.MqttError as error:
+            print(f"[MQTT] publicador desconectado: {error}; reintento en {espera}s")
+
+        _conectado.clear()
+        await asyncio.sleep(espera)
+        espera = min(espera * 2, 60)
+
+
+async def iniciar():
+    global _cola, _conectado
+    _cola = asyncio.Queue(maxsize=MQTT_PUB_QUEUE_MAX)
+    _conectado = asyncio.Event()
+    return asyncio.create_task(_ciclo())
@@ -0,0 +1,236 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from functools import reduce
+from operator import xor
+
+import numpy as np
+
+from utils import deadband, positions, profiling, registry
+from utils.resilience import escribir
+
+NUDOS_A_KMH = 1.852
+
+_lock = threading.Lock()
+
+
+def nmea_a_grados(valor, direccion):
+    """Convierte NMEA (ddmm.mmmm) a grados decimales para Google Maps."""
+    if not valor:
+        return None
+    try:
+        punto = valor.find(".")
+        grados = int(valor[:punto - 2])      # dd o ddd
+        minutos = float(valor[punto - 2:])   # mm.mmmm
+        decimal = grados + minutos / 60
+        if direccion in ("S", "W"):
+            decimal = -decimal
+        return round(decimal, 6)
+    except (ValueError, IndexError):
+        return None
+
+
+def nmea_a_grados_vec(valores, direcciones):
+    """
+    Versión vectorizada de nmea_a_grados para un lote completo.
+    Los valores vacíos o inválidos quedan como NaN.
+    """
+    crudo = np.array([_a_float(v) for v in valores], dtype=np.float64)
+    grados = np.trunc(crudo / 100)
+    decimal = grados + (crudo - grados * 100) / 60
+    signo = np.where(np.isin(np.asarray(direcciones, dtype=object), ("S", "W")), -1.0, 1.0)
+    return np.round(decimal * signo, 6)
+
+
+def _a_float(valor):
+    try:
+        return float(valor) if valor else np.nan
+    except ValueError:
+        return np.nan
+
+
+def checksum_valido(linea: str) -> bool:
+    """Verifica el XOR de la trama ($...*HH)."""
+    if not linea.startswith("$") or "*" not in linea:
+        return False
+    cuerpo, _, suma = linea[1:].partition("*")
+    try:
+        return reduce(xor, cuerpo.encode("ascii"), 0) == int(suma[:2], 16)
+    except (ValueError, UnicodeEncodeError):
+        return False
+
+
+def _hora(hhmmss, ddmmyy, ref):
+    """
+    Hora del equipo. GGA no trae fecha: se usa la del último RMC (o la
+    hora de recepción) y, si queda a más de 12 h de esa referencia, la
+    hora cruzó la medianoche y se corrige un día.
+    """
+    try:
+        h, m, s = int(hhmmss[0:2]), int(hhmmss[2:4]), float(hhmmss[4:])
+        fecha = datetime.strptime(ddmmyy, "%d%m%y").date() if ddmmyy else ref.date()
+        hora = datetime(fecha.year, fecha.month, fecha.day, h, m, int(s),
+                        int(round((s % 1) * 1e6)), tzinfo=timezone.utc)
+    except (ValueError, IndexError, TypeError, AttributeError):
+        return None
+    if not ddmmyy:
+        if hora - ref > timedelta(hours=12):
+            hora -= timedelta(days=1)
+        elif ref - hora > timedelta(hours=12):
+            hora += timedelta(days=1)
+    return hora
+
+
+@profiling.trazar("nmea.decode")
+def parsear_lote(lineas, ahora_utc):
+    """
+    Parsea un lote de tramas $xxRMC / $xxGGA. RMC y GGA con la misma hora
+    se combinan en un solo fix. Devuelve (fixes ordenados por hora, descartadas).
+    """
+    fixes = {}
+    ref = ahora_utc
+    descartadas = 0
+
+    for linea in lineas:
+        linea = linea.strip()
+        if not linea:
+            continue
+        if not checksum_valido(linea):
+            descartadas += 1
+            continue
+
+        campos = linea[1:linea.index("*")].split(",")
+        tipo = campos[0][2:]
+
+        if tipo == "RMC" and len(campos) >= 10:
+            hora = _hora(campos[1], campos[9], ref)
+            if hora is None:
+                descartadas += 1
+                continue
+            ref = hora
+            fix = fixes.setdefault(hora, {"observed": hora})
+            fix.update({
+                "lat": campos[3], "lat_d": campos[4],
+                "lon": campos[5], "lon_d": campos[6],
+                "valido": campos[2] == "A",
+                "vel_nudos": campos[7],
+            })
+
+        elif tipo == "GGA" and len(campos) >= 10:
+            hora = _hora(campos[1], None, ref)
+            if hora is None:
+                descartadas += 1
+                continue
+            fix = fixes.setdefault(hora, {"observed": hora})
+            fix.setdefault("lat", campos[2])
+            fix.setdefault("lat_d", campos[3])
+            fix.setdefault("lon", campos[4])
+            fix.setdefault("lon_d", campos[5])
+            fix.setdefault("valido", campos[6] not in ("", "0"))
+            fix["satelites"] = int(campos[7]) if campos[7].isdigit() else None
+            fix["altitud"] = _a_float(campos[9]) if campos[9] else None
+
+        else:
+            descartadas += 1
+
+    lista = [f for _, f in sorted(fixes.items()) if f.get("valido")]
+    descartadas += len(fixes) - len(lista)
+    if not lista:
+        return [], descartadas
+
+    # Conversión vectorizada de todo el lote
+    lats = nmea_a_grados_vec([f["lat"] for f in lista], [f["lat_d"] for f in lista])
+    lons = nmea_a_grados_vec([f["lon"] for f in lista], [f["lon_d"] for f in lista])
+    nudos = np.array([_a_float(f.get("vel_nudos")) for f in lista], dtype=np.float64)
+    vel_kmh = np.round(np.nan_to_num(nudos) * NUDOS_A_KMH, 1)
+
+    validos = ~(np.isnan(lats) | np.isnan(lons))
+    resultado = []
+    for i in np.flatnonzero(validos):
+        f = lista[i]
+        resultado.append({
+            "observed": f["observed"],
+            "lat": float(lats[i]),
+            "lon": float(lons[i]),
+            "vel_kmh": float(vel_kmh[i]),
+            "satelites": f.get("satelites"),
+            "altitud": f.get("altitud"),
+        })
+    return resultado, descartadas + int((~validos).sum())
+
+
+def decodificar_trama(data):
+    """
+    Trama ya parseada por el router (/rut956-nmea). Devuelve
+    (device_id, lat, lon, extra) o None si no hay fix utilizable.
+    """
+    if data.get("estado") != "A":            # sin fix, no procesar
+        return None
+
+    lat = nmea_a_grados(data.get("lat"), data.get("lat_d"))
+    lon = nmea_a_grados(data.get("lon"), data.get("lon_d"))
+    if lat is None or lon is None:
+        return None
+
+    try:
+        vel_kmh = round(float(data.get("vel_nudos") or 0) * NUDOS_A_KMH, 1)
+    except (ValueError, TypeError):
+        return None                          # velocidad inválida, ignorar trama
+
+    extra = {
+        "vel_kmh": vel_kmh,                          # km/h
+        "ignicion": data.get("ignicion") == "1",     # True = prendida, False = apagada
+        "motivo": data.get("motivo", "periodico"),
+    }
+    return data.get("device_id"), lat, lon, extra
+
+
+@profiling.trazar("nmea.lote")
+def procesar_lote(device_id, lineas):
+    """Parsea las tramas del router y las escribe en bulk."""
+    ahora_utc = datetime.now(timezone.utc)
+    fixes, descartadas = parsear_lote(lineas, ahora_utc)
+    if not fixes:
+        return {"received": 0, "history": 0, "discarded": descartadas}
+
+    return {**guardar_fixes(device_id, fixes), "discarded": descartadas}
+
+
+def guardar_fixes(device_id, fixes):
+    """Aplica el deadband a fixes ya parseados y los escribe en bulk."""
+    history_rows = []
+    with _lock:
+        for f in fixes:
+            extra = {
+                "vel_kmh": f["vel_kmh"],
+                "motivo": "periodico",
+                "satelites": f["satelites"],
+                "altitud": f["altitud"],
+            }
+            f["extra"] = extra
+            if deadband.debe_guardar(device_id, f["lat"], f["lon"], f["observed"]):
+                history_rows.append({
+                    "device_id": device_id,
+                    "trip_id": None,
+                    "lat": f["lat"],
+                    "lon": f["lon"],
+                    "observed_at": f["observed"].isoformat(),
+                    "ignition": False,
+                    "extra": extra,
+                })
+
+    if history_rows:
+        escribir("vehicle_position_history", "insert", history_rows)
+
+    ultimo = fixes[-1]
+    registro = registry.fila_posicion(device_id, {
+        "lat": ultimo["lat"],
+        "lon": ultimo["lon"],
+        "last_seen": ultimo["observed"].isoformat(),
+        "extra": ultimo["extra"],
+    }, "Train")
+    # Un lote atrasado no pisa la posición actual
+    if positions.mas_nuevas([registro]):
+        escribir("device_position", "upsert", registro, on_conflict="device_id")
+        positions.actualizar(device_id, registro)
+
+    return {"received": len(fixes), "history": len(history_rows)}
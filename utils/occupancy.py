@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from utils import registry
+
+# Índice en memoria de ocupación por baliza BLE: qué equipos están junto a
+# cada baliza y desde cuándo. Se actualiza en cada fix BLE de los webhooks
+# TTN/Abeeway; un fix GNSS o pasar OCUPACION_EXPIRA_SEGUNDOS sin verlo
+# saca al equipo de su baliza. Las balizas no son de nadie: las consultas
+# solo muestran (y cuentan) los equipos de la empresa que pregunta.
+OCUPACION_EXPIRA_SEGUNDOS = float(os.getenv("OCUPACION_EXPIRA_SEGUNDOS", "900"))
+
+# mac -> {device_id: desde}
+por_beacon = {}
+# device_id -> (mac, desde, visto), ordenado por visto (el más antiguo primero)
+por_device = OrderedDict()
+_lock = threading.Lock()
+
+
+def _mac(mac):
+    return str(mac).upper()
+
+
+def _quitar(device_id):
+    mac, _, _ = por_device.pop(device_id)
+    ocupantes = por_beacon.get(mac)
+    if ocupantes is not None:
+        ocupantes.pop(device_id, None)
+        if not ocupantes:
+            del por_beacon[mac]
+
+
+def _purgar(ahora):
+    # Los vencidos están al principio: se corta en el primero vigente
+    limite = ahora - OCUPACION_EXPIRA_SEGUNDOS
+    while por_device:
+        device_id, (_, _, visto) = next(iter(por_device.items()))
+        if visto >= limite:
+            return
+        _quitar(device_id)
+
+
+def registrar(device_id, mac, ts):
+    """Fix BLE: el equipo está junto a mac. La permanencia cuenta desde que llegó."""
+    mac = _mac(mac)
+    with _lock:
+        actual = por_device.get(device_id)
+        if actual is not None and actual[0] == mac:
+            desde = actual[1]
+            por_device.move_to_end(device_id)
+        else:
+            if actual is not None:
+                _quitar(device_id)
+            desde = ts
+            por_beacon.setdefault(mac, {})[device_id] = desde
+        por_device[device_id] = (mac, desde, ts)
+        _purgar(time.time())
+
+
+def salir(device_id):
+    """Fix GNSS: el equipo ya no se ubica por baliza."""
+    with _lock:
+        if device_id in por_device:
+            _quitar(device_id)
+
+
+def _fila(device_id, mac, desde, visto, ahora):
+    return {
+        "device_id": device_id,
+        "beacon_mac": mac,
+        "desde": datetime.fromtimestamp(desde, timezone.utc).isoformat(),
+        "visto": datetime.fromtimestamp(visto, timezone.utc).isoformat(),
+        "permanencia_s": round(ahora - desde, 1),
+    }
+
+
+def ocupantes(mac, empresa):
+    ahora = time.time()
+    mac = _mac(mac)
+    with _lock:
+        _purgar(ahora)
+        return [
+            _fila(device_id, mac, desde, por_device[device_id][2], ahora)
+            for device_id, desde in por_beacon.get(mac, {}).items()
+            if registry.pertenece(device_id, empresa)
+        ]
+
+
+def ubicacion(device_id, empresa):
+    if not registry.pertenece(device_id, empresa):
+        return None
+    ahora = time.time()
+    with _lock:
+        _purgar(ahora)
+        actual = por_device.get(device_id)
+        if actual is None:
+            return None
+        return _fila(device_id, *actual, ahora)
+
+
+def resumen(empresa):
+    """Cantidad de equipos de la empresa por baliza ocupada."""
+    with _lock:
+        _purgar(time.time())
+        conteo = {
+            mac: sum(1 for device_id in ocupantes if registry.pertenece(device_id, empresa))
+            for mac, ocupantes in por_beacon.items()
+        }
+    return {mac: n for mac, n in conteo.items() if n}
@@ -0,0 +1,132 @@
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from utils import device_state, hub, spatial
+from utils.database import iter_keyset
+
+# Última posición por device_id, en el orden en que cambiaron (la más
+# reciente al final). Cada cambio sube `version`, que sirve de cursor
+# para que el mapa pida solo lo que cambió. La tabla es de este proceso:
+# con varios workers de uvicorn cada uno tiene la suya, por eso el cursor
+# lleva la instancia y uno de otro proceso pide la tabla completa (sirve
+# igual, pero el delta solo ahorra algo si el cliente vuelve al mismo
+# worker; lo normal es correr la API con un solo worker).
+POSITION_COLUMNS = "device_id, type, lat, lon, last_seen, battery, rssi, snr, extra"
+
+posiciones = OrderedDict()
+INSTANCIA = secrets.token_hex(4)
+version = 0
+_lock = threading.Lock()
+# En un worker de ingesta (utils.shards) los cambios se reenvían a la API
+reenvio = None
+
+# last_seen (epoch) de lo último escrito en device_position por este
+# proceso. Un fix atrasado (reenvío, buffer del equipo) va a history pero
+# no pisa la posición actual.
+guardadas = device_state.tabla("posicion_guardada", last_seen="float")
+_lock_guardadas = threading.Lock()
+
+
+def _epoch(valor):
+    if valor is None:
+        return None
+    return datetime.fromisoformat(valor).timestamp()
+
+
+def _guardar_ultimas(filas):
+    with _lock_guardadas:
+        guardadas.limpiar()
+        for fila in filas:
+            guardadas.poner(fila["device_id"], last_seen=_epoch(fila.get("last_seen")))
+
+
+def cargar():
+    """Llena la tabla desde device_position (se llama al iniciar)."""
+    global version
+    filas = list(iter_keyset("device_position", POSITION_COLUMNS, key="device_id"))
+    with _lock:
+        posiciones.clear()
+        for fila in filas:
+            version += 1
+            fila["version"] = version
+            posiciones[fila["device_id"]] = fila
+    _guardar_ultimas(filas)
+    print(f"[POS] posiciones cargadas: {len(filas)} dispositivos")
+
+
+def cargar_ultimas():
+    """Solo los last_seen de device_position (workers de ingesta)."""
+    filas = list(iter_keyset("device_position", "device_id, last_seen", key="device_id"))
+    _guardar_ultimas(filas)
+    print(f"[POS] last_seen cargados: {len(filas)} dispositivos")
+
+
+def mas_nuevas(filas):
+    """
+    Filas de device_position (con last_seen ISO) más nuevas que lo último
+    guardado para su equipo; las devueltas quedan como lo último guardado.
+    """
+    nuevas = []
+    with _lock_guardadas:
+        for fila in filas:
+            ts = _epoch(fila.get("last_seen"))
+            anterior = guardadas.valor(fila["device_id"], "last_seen")
+            if ts is not None and anterior is not None and ts <= anterior:
+                continue
+            if ts is not None:
+                guardadas.poner(fila["device_id"], last_seen=ts)
+            nuevas.append(fila)
+    return nuevas
+
+
+def actualizar(device_id, datos: dict):
+    """Aplica un cambio (parcial o completo) a la posición del dispositivo."""
+    global version
+    if reenvio is not None:
+        reenvio(("posicion", device_id, datos))
+        return
+    with _lock:
+        fila = posiciones.pop(device_id, None) or {"device_id": device_id}
+        fila.update(datos)
+        version += 1
+        fila["version"] = version
+        posiciones[device_id] = fila
+        evento = dict(fila)
+
+    spatial.mover_dispositivo(device_id, evento)
+    hub.publicar_posicion(device_id, evento)
+
+
+def actualizar_torre(device_id, datos: dict, lat, lon):
+    """Cambio de una torre con GPS (device_id de tower_value)."""
+    if reenvio is not None:
+        reenvio(("torre", device_id, datos, lat, lon))
+        return
+    hub.publicar_torre(device_id, datos, columna="device_id")
+    spatial.mover_torre(device_id, lat, lon)
+
+
+def cambios_desde(cursor: str):
+    """
+    Posiciones con version posterior al cursor ("<instancia>.<version>").
+    Recorre desde el final, así que el costo es proporcional a lo que
+    cambió y no al tamaño de la flota. Un cursor vacío, inválido o de otro
+    proceso devuelve la tabla completa.
+    Devuelve (cursor actual, completo, filas).
+    """
+    instancia, _, numero = (cursor or "").partition(".")
+    desde = int(numero) if numero.isdigit() else None
+
+    with _lock:
+        actual = f"{INSTANCIA}.{version}"
+        if instancia != INSTANCIA or desde is None or desde > version:
+            return actual, True, [dict(fila) for fila in posiciones.values()]
+
+        cambios = []
+        for fila in reversed(posiciones.values()):
+            if fila["version"] <= desde:
+                break
+            cambios.append(dict(fila))
+        return actual, False, cambios[::-1]
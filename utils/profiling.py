@@ -0,0 +1,253 @@
+import contextvars
+import functools
+import inspect
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+
+# Perfilado bajo demanda: una request con X-Profile igual a PROFILING_SECRET,
+# o una fracción PROFILING_SAMPLE_RATE de ellas, se muestrea con un perfilador
+# estadístico (stacks cada PROFILING_INTERVALO_MS) y guarda un árbol de spans
+# de sus fases. Sin secreto ni muestreo el middleware no se registra.
+PROFILING_SECRET = os.getenv("PROFILING_SECRET", "")
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_INTERVALO_MS = float(os.getenv("PROFILING_INTERVALO_MS", "5"))
+PROFILING_RETENER = int(os.getenv("PROFILING_RETENER", "50"))
+PROFILING_PROFUNDIDAD = 64
+
+HEADER = "x-profile"
+
+_span_actual = contextvars.ContextVar("span_actual", default=None)
+_ids = itertools.count(1)
+
+# id -> Perfil, los más nuevos al final
+perfiles = OrderedDict()
+_activos = set()
+_lock = threading.Lock()
+_muestreador = None
+
+
+def habilitado() -> bool:
+    return bool(PROFILING_SECRET) or PROFILING_SAMPLE_RATE > 0
+
+
+def solicitado(headers) -> bool:
+    """Secreto en el header o sorteo según la tasa de muestreo."""
+    if PROFILING_SECRET and headers.get(HEADER) == PROFILING_SECRET:
+        return True
+    return PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE
+
+
+class Nodo:
+    __slots__ = ("perfil", "nombre", "inicio", "duracion", "error", "hijos")
+
+    def __init__(self, perfil, nombre):
+        self.perfil = perfil
+        self.nombre = nombre
+        self.inicio = time.perf_counter()
+        self.duracion = None
+        self.error = None
+        self.hijos = []
+
+    def a_dict(self, t0):
+        fila = {
+            "nombre": self.nombre,
+            "inicio_ms": round((self.inicio - t0) * 1000, 3),
+            "duracion_ms": None if self.duracion is None else round(self.duracion * 1000, 3),
+            "hijos": [hijo.a_dict(t0) for hijo in self.hijos],
+        }
+        if self.error:
+            fila["error"] = self.error
+        return fila
+
+
+class Perfil:
+    def __init__(self, metodo, ruta):
+        self.id = next(_ids)
+        self.metodo = metodo
+        self.ruta = ruta
+        self.creado = datetime.now(timezone.utc).isoformat()
+        self.status = None
+        self.raiz = Nodo(self, f"{metodo} {ruta}")
+        # thread id -> spans abiertos en ese thread; solo esos se muestrean
+        self.hilos = Counter()
+        self.muestras = Counter()
+
+    def resumen(self):
+        return {
+            "id": self.id,
+            "metodo": self.metodo,
+            "ruta": self.ruta,
+            "creado": self.creado,
+            "status": self.status,
+            "duracion_ms": None if self.raiz.duracion is None else round(self.raiz.duracion * 1000, 3),
+            "muestras": sum(self.muestras.values()),
+        }
+
+    def detalle(self):
+        return {
+            **self.resumen(),
+            "intervalo_ms": PROFILING_INTERVALO_MS,
+            "spans": self.raiz.a_dict(self.raiz.inicio),
+            "stacks": [
+                {"stack": stack, "muestras": n}
+                for stack, n in self.muestras.most_common()
+            ],
+        }
+
+    def collapsed(self):
+        """Formato de flamegraph.pl / speedscope: 'a;b;c N' por línea."""
+        return "".join(f"{stack} {n}\n" for stack, n in self.muestras.most_common())
+
+
+class _Span:
+    __slots__ = ("padre", "nodo", "token", "hilo")
+
+    def __init__(self, padre, nombre):
+        self.padre = padre
+        self.nodo = Nodo(padre.perfil, nombre)
+
+    def __enter__(self):
+        self.padre.hijos.append(self.nodo)
+        self.token = _span_actual.set(self.nodo)
+        self.hilo = threading.get_ident()
+        with _lock:
+            self.nodo.perfil.hilos[self.hilo] += 1
+        return self.nodo
+
+    def __exit__(self, tipo, error, tb):
+        self.nodo.duracion = time.perf_counter() - self.nodo.inicio
+        if tipo is not None:
+            self.nodo.error = tipo.__name__
+        _span_actual.reset(self.token)
+        with _lock:
+            hilos = self.nodo.perfil.hilos
+            hilos[self.hilo] -= 1
+            if hilos[self.hilo] <= 0:
+                del hilos[self.hilo]
+        return False
+
+
+class _SinSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, tipo, error, tb):
+        return False
+
+
+_NULO = _SinSpan()
+
+
+def span(nombre):
+    """Fase medida dentro de la request perfilada; sin perfil no hace nada."""
+    padre = _span_actual.get()
+    if padre is None:
+        return _NULO
+    return _Span(padre, nombre)
+
+
+def trazar(nombre):
+    """Decorador: envuelve cada llamada a la función en un span."""
+    def decorador(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def envuelta_async(*args, **kwargs):
+                if _span_actual.get() is None:
+                    return await fn(*args, **kwargs)
+                with span(nombre):
+                    return await fn(*args, **kwargs)
+            return envuelta_async
+
+        @functools.wraps(fn)
+        def envuelta(*args, **kwargs):
+            if _span_actual.get() is None:
+                return fn(*args, **kwargs)
+            with span(nombre):
+                return fn(*args, **kwargs)
+        return envuelta
+    return decorador
+
+
+# ================== MUESTREADOR ==================
+
+def _stack(frame):
+    partes = []
+    while frame is not None and len(partes) < PROFILING_PROFUNDIDAD:
+        code = frame.f_code
+        partes.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    partes.reverse()
+    return ";".join(partes)
+
+
+def _muestrear():
+    global _muestreador
+    intervalo = PROFILING_INTERVALO_MS / 1000
+    while True:
+        with _lock:
+            if not _activos:
+                _muestreador = None
+                return
+            objetivo = [(perfil, list(perfil.hilos)) for perfil in _activos]
+
+        frames = sys._current_frames()
+        tomadas = [
+            (perfil, _stack(frames[hilo]))
+            for perfil, hilos in objetivo
+            for hilo in hilos
+            if hilo in frames
+        ]
+        del frames
+        with _lock:
+            # Un perfil ya terminado no cambia mientras se lee
+            for perfil, stack in tomadas:
+                if perfil in _activos:
+                    perfil.muestras[stack] += 1
+        time.sleep(intervalo)
+
+
+def iniciar(metodo, ruta):
+    """
+    Abre el perfil de una request en el thread actual (el event loop). Las
+    muestras de ese thread incluyen lo que otras requests hagan en paralelo;
+    los spans son los que separan el tiempo propio.
+    """
+    global _muestreador
+    perfil = Perfil(metodo, ruta)
+    with _lock:
+        perfil.hilos[threading.get_ident()] += 1
+        _activos.add(perfil)
+        if _muestreador is None:
+            _muestreador = threading.Thread(target=_muestrear, name="profiling", daemon=True)
+            _muestreador.start()
+    return perfil, _span_actual.set(perfil.raiz)
+
+
+def terminar(perfil, token, status):
+    perfil.raiz.duracion = time.perf_counter() - perfil.raiz.inicio
+    perfil.status = status
+    _span_actual.reset(token)
+    with _lock:
+        _activos.discard(perfil)
+        perfil.hilos.clear()
+        perfiles[perfil.id] = perfil
+        while len(perfiles) > PROFILING_RETENER:
+            perfiles.popitem(last=False)
+
+
+def listar():
+    with _lock:
+        return [perfil.resumen() for perfil in reversed(perfiles.values())]
+
+
+def obtener(perfil_id):
+    with _lock:
+        return perfiles.get(perfil_id)
@@ -0,0 +1,115 @@
+import os
+import threading
+
+from utils.database import iter_keyset
+
+# Registro en memoria de los dispositivos: tipo, dev_eui, empresa y a
+# dónde se enrutan sus posiciones. Reemplaza las consultas de existencia
+# por mensaje y los IMEI fijos en los handlers. Se recarga completo cada
+# REGISTRY_REFRESH_SEGUNDOS y los equipos nuevos se agregan al verlos.
+REGISTRY_REFRESH_SEGUNDOS = float(os.getenv("REGISTRY_REFRESH_SEGUNDOS", "300"))
+# GPS instalados en torres: "imei:device_id de tower_value,..."
+TORRES_GPS = os.getenv("TORRES_GPS", "864292048971244:Primera Torre")
+
+
+def _torres(valor):
+    destinos = {}
+    for par in valor.split(","):
+        if ":" in par:
+            imei, torre = par.split(":", 1)
+            destinos[imei.strip()] = torre.strip()
+    return destinos
+
+
+class Dispositivo:
+    __slots__ = ("device_id", "tipo", "dev_eui", "empresa", "torre")
+
+    def __init__(self, device_id, tipo=None, dev_eui=None, empresa=None, torre=None):
+        self.device_id = device_id
+        self.tipo = tipo
+        self.dev_eui = dev_eui
+        self.empresa = empresa
+        # device_id de tower_value si el equipo es el GPS de una torre
+        self.torre = torre
+
+
+dispositivos = {}
+_torres_gps = _torres(TORRES_GPS)
+_lock = threading.Lock()
+
+
+def cargar():
+    """Recarga completa desde device_position y device (se llama al iniciar y periódicamente)."""
+    nuevos = {}
+    for fila in iter_keyset("device_position", "device_id, type, dev_eui", key="device_id"):
+        nuevos[fila["device_id"]] = Dispositivo(fila["device_id"], fila.get("type"), fila.get("dev_eui"))
+    for fila in iter_keyset("device", "device_id, empresas(id)", key="device_id"):
+        disp = nuevos.get(fila["device_id"]) or Dispositivo(fila["device_id"])
+        disp.empresa = (fila.get("empresas") or {}).get("id")
+        nuevos[fila["device_id"]] = disp
+    for imei, torre in _torres_gps.items():
+        disp = nuevos.get(imei) or Dispositivo(imei)
+        disp.torre = torre
+        nuevos[imei] = disp
+
+    global dispositivos
+    with _lock:
+        # Lo registrado mientras se cargaba no se pierde
+        for device_id, disp in dispositivos.items():
+            nuevos.setdefault(device_id, disp)
+        dispositivos = nuevos
+    print(f"[REG] registro cargado: {len(nuevos)} dispositivos")
+
+
+def obtener(device_id):
+    return dispositivos.get(device_id)
+
+
+def torre_de(device_id):
+    """device_id de tower_value al que va la posición, o None."""
+    disp = dispositivos.get(device_id)
+    if disp is not None:
+        return disp.torre
+    return _torres_gps.get(device_id)
+
+
+def empresa_de(device_id):
+    disp = dispositivos.get(device_id)
+    return disp.empresa if disp is not None else None
+
+
+def pertenece(device_id, empresa) -> bool:
+    """Si el equipo es de la empresa (uno sin empresa conocida no es de nadie)."""
+    duena = empresa_de(device_id)
+    return duena is not None and str(duena) == str(empresa)
+
+
+def de_empresa(empresa):
+    """device_id de los equipos de una empresa, ordenados."""
+    empresa = str(empresa)
+    return sorted(d.device_id for d in list(dispositivos.values()) if str(d.empresa) == empresa)
+
+
+def identidad(device_id, tipo: str, dev_eui=None):
+    """
+    (tipo, dev_eui, nuevo) del equipo. Uno conocido conserva los suyos;
+    uno nuevo toma los de la ruta por la que llegó y queda registrado.
+    """
+    disp = dispositivos.get(device_id)
+    if disp is not None and disp.tipo is not None:
+        return disp.tipo, disp.dev_eui, False
+
+    with _lock:
+        disp = dispositivos.get(device_id) or Dispositivo(device_id, torre=_torres_gps.get(device_id))
+        disp.tipo = tipo
+        disp.dev_eui = (dev_eui or device_id).upper()
+        dispositivos[device_id] = disp
+    return disp.tipo, disp.dev_eui, True
+
+
+def fila_posicion(device_id, datos: dict, tipo: str, dev_eui=None) -> dict:
+    """Fila de device_position para upsert; a un equipo conocido no se le toca tipo ni dev_eui."""
+    tipo, dev_eui, nuevo = identidad(device_id, tipo, dev_eui)
+    if not nuevo:
+        return {**datos, "device_id": device_id}
+    return {**datos, "device_id": device_id, "type": tipo, "dev_eui": dev_eui}
@@ -0,0 +1,352 @@
+import asyncio
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import httpx
+import requests
+from postgrest.exceptions import APIError
+
+from utils import profiling
+from utils.database import supabase
+
+# Reintentos con backoff, circuit breakers por servicio externo y un spool
+# local para las escrituras que no se pueden hacer mientras Supabase no
+# responde. El spool se vacía solo cuando el circuito vuelve a cerrarse.
+# Es un archivo compartido por todos los procesos (API y workers de
+# ingesta): las escrituras y el drenado se coordinan con flock.
+CIRCUITO_UMBRAL = int(os.getenv("CIRCUITO_UMBRAL", "5"))
+CIRCUITO_REAPERTURA_SEGUNDOS = float(os.getenv("CIRCUITO_REAPERTURA_SEGUNDOS", "30"))
+REINTENTO_BASE_SEGUNDOS = float(os.getenv("REINTENTO_BASE_SEGUNDOS", "0.2"))
+REINTENTO_MAX_SEGUNDOS = float(os.getenv("REINTENTO_MAX_SEGUNDOS", "3"))
+SPOOL_PATH = os.path.abspath(os.getenv(
+    "SPOOL_PATH", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "spool.jsonl")
+))
+SPOOL_DRENAR_SEGUNDOS = float(os.getenv("SPOOL_DRENAR_SEGUNDOS", "15"))
+
+
+class CircuitoAbierto(RuntimeError):
+    def __init__(self, nombre, reintentar_en):
+        super().__init__(f"{nombre} no disponible (circuito abierto)")
+        self.nombre = nombre
+        self.reintentar_en = max(1, int(reintentar_en))
+
+
+# SQLSTATE por clase: conexión (08), recursos (53), cancelación o caída
+# del servidor (57, incluye 57014 statement timeout)
+_CLASES_TRANSITORIAS = ("08", "53", "57")
+# Serialización/deadlock y los PGRST de conexión o pool (PostgREST responde 503/504)
+_CODIGOS_TRANSITORIOS = {"40001", "40P01", "PGRST000", "PGRST001", "PGRST002", "PGRST003"}
+
+
+def es_transitorio(error) -> bool:
+    """Errores de red, timeouts y 5xx; los errores de datos no abren el circuito."""
+    if isinstance(error, APIError):
+        codigo = str(error.code or "")
+        # Sin cuerpo JSON postgrest deja en code el status HTTP
+        if len(codigo) == 3 and codigo.isdigit():
+            return int(codigo) >= 500
+        return codigo in _CODIGOS_TRANSITORIOS or codigo[:2] in _CLASES_TRANSITORIAS
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (
+        httpx.TransportError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        ConnectionError,
+        TimeoutError,
+    ))
+
+
+class Circuito:
+    """Cerrado -> abierto tras CIRCUITO_UMBRAL fallos seguidos; semiabierto deja pasar una prueba."""
+
+    def __init__(self, nombre, umbral=CIRCUITO_UMBRAL, reapertura=CIRCUITO_REAPERTURA_SEGUNDOS):
+        self.nombre = nombre
+        self.umbral = umbral
+        self.reapertura = reapertura
+        self.fallos = 0
+        self.abierto_hasta = 0.0
+        self.probando = False
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self):
+        if self.fallos < self.umbral:
+            return "cerrado"
+        return "semiabierto" if time.monotonic() >= self.abierto_hasta else "abierto"
+
+    def permitir(self):
+        with self._lock:
+            if self.fallos < self.umbral:
+                return
+            restante = self.abierto_hasta - time.monotonic()
+            if restante > 0 or self.probando:
+                raise CircuitoAbierto(self.nombre, max(restante, 1))
+            # Semiabierto: una sola llamada de prueba
+            self.probando = True
+
+    def exito(self):
+        with self._lock:
+            if self.fallos >= self.umbral:
+                print(f"[CIRCUITO] {self.nombre} cerrado")
+            self.fallos = 0
+            self.probando = False
+
+    def liberar(self):
+        """La llamada se interrumpió sin resultado (p. ej. cancelada): no cuenta."""
+        with self._lock:
+            self.probando = False
+
+    def fallo(self):
+        with self._lock:
+            self.fallos += 1
+            self.probando = False
+            if self.fallos >= self.umbral:
+                self.abierto_hasta = time.monotonic() + self.reapertura
+                print(f"[CIRCUITO] {self.nombre} abierto por {self.reapertura}s")
+
+
+circuitos = {
+    "supabase": Circuito("supabase"),
+    "emqx": Circuito("emqx"),
+    "solis": Circuito("solis"),
+}
+
+
+def _espera(intento):
+    # Backoff exponencial con jitter completo
+    return random.uniform(0, min(REINTENTO_MAX_SEGUNDOS, REINTENTO_BASE_SEGUNDOS * 2 ** intento))
+
+
+def llamar(servicio, fn, *args, reintentos=0, **kwargs):
+    """
+    Ejecuta fn bajo el circuito del servicio. Solo las operaciones
+    idempotentes deben pedir reintentos. Bloquea: usar fuera del event loop
+    si hay reintentos.
+    """
+    circuito = circuitos[servicio]
+    for intento in range(reintentos + 1):
+        circuito.permitir()
+        try:
+            with profiling.span(f"{servicio} intento {intento + 1}"):
+                resultado = fn(*args, **kwargs)
+        except Exception as error:
+            if not es_transitorio(error):
+                circuito.exito()
+                raise
+            circuito.fallo()
+            if intento == reintentos:
+                raise
+            time.sleep(_espera(intento))
+        except BaseException:
+            # Cancelación o interrupción: sin esto una prueba en
+            # semiabierto dejaría el circuito abierto para siempre
+            circuito.liberar()
+            raise
+        else:
+            circuito.exito()
+            return resultado
+
+
+async def llamar_async(servicio, fn, *args, reintentos=0, **kwargs):
+    """Igual que llamar, pero fn (síncrona) corre en un thread y las esperas no bloquean."""
+    circuito = circuitos[servicio]
+    for intento in range(reintentos + 1):
+        circuito.permitir()
+        try:
+            with profiling.span(f"{servicio} intento {intento + 1}"):
+                resultado = await asyncio.to_thread(fn, *args, **kwargs)
+        except Exception as error:
+            if not es_transitorio(error):
+                circuito.exito()
+                raise
+            circuito.fallo()
+            if intento == reintentos:
+                raise
+            await asyncio.sleep(_espera(intento))
+        except BaseException:
+            # Cancelación o interrupción: sin esto una prueba en
+            # semiabierto dejaría el circuito abierto para siempre
+            circuito.liberar()
+            raise
+        else:
+            circuito.exito()
+            return resultado
+
+
+def ejecutar(query, reintentos=0):
+    """Ejecuta una consulta de Supabase bajo su circuito."""
+    with profiling.span(f"supabase {query.http_method} {query.path}"):
+        return llamar("supabase", query.execute, reintentos=reintentos)
+
+
+# ================== SPOOL ==================
+
+_spool_lock = threading.Lock()
+
+
+@contextmanager
+def _bloqueo(sufijo, esperar=True):
+    """flock sobre SPOOL_PATH + sufijo; con esperar=False entrega False si está tomado."""
+    with open(SPOOL_PATH + sufijo, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if esperar else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _al_spool(operacion):
+    with _spool_lock, _bloqueo(".lock"), open(SPOOL_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(operacion, default=str) + "\n")
+
+
+def _rpc(funcion, filas):
+    return supabase.rpc(funcion, {"filas": filas})
+
+
+def escribir(tabla, op, filas, on_conflict=None):
+    """
+    Insert/upsert resiliente. Los upserts se reintentan (son idempotentes);
+    si Supabase no está disponible la escritura queda en el spool y se
+    aplica al recuperarse. Los errores de datos se propagan. Con op "rpc"
+    `tabla` es una función que recibe {"filas": filas} (merges que suman:
+    no se reintentan, como los inserts).
+    """
+    def hacer():
+        if op == "rpc":
+            return _rpc(tabla, filas).execute()
+        tabla_ref = supabase.table(tabla)
+        if op == "upsert":
+            query = tabla_ref.upsert(filas, on_conflict=on_conflict) if on_conflict else tabla_ref.upsert(filas)
+        else:
+            query = tabla_ref.insert(filas)
+        return query.execute()
+
+    with profiling.span(f"supabase {op} /{tabla}"):
+        try:
+            return llamar("supabase", hacer, reintentos=2 if op == "upsert" else 0)
+        except Exception as error:
+            if not isinstance(error, CircuitoAbierto) and not es_transitorio(error):
+                raise
+            _al_spool({"tabla": tabla, "op": op, "filas": filas, "on_conflict": on_conflict})
+            print(f"[SPOOL] {op} en {tabla} guardado para reintento ({error})")
+            return None
+
+
+def _hora(valor):
+    return datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+
+
+def _mas_nuevas(operacion):
+    """
+    Filas de un upsert que siguen siendo más nuevas que lo guardado. Solo
+    aplica a upserts con last_seen y clave simple (device_position,
+    vehicle_state): mientras estuvo en el spool pudo llegar un punto posterior.
+    """
+    filas = operacion["filas"] if isinstance(operacion["filas"], list) else [operacion["filas"]]
+    clave = operacion["on_conflict"]
+    if not clave or "," in clave or not all(f.get("last_seen") and clave in f for f in filas):
+        return filas
+    res = ejecutar(
+        supabase.table(operacion["tabla"]).select(f"{clave}, last_seen").in_(clave, [f[clave] for f in filas])
+    )
+    guardadas = {f[clave]: _hora(f["last_seen"]) for f in res.data or [] if f.get("last_seen")}
+    return [
+        f for f in filas
+        if f[clave] not in guardadas or _hora(f["last_seen"]) > guardadas[f[clave]]
+    ]
+
+
+def drenar():
+    """
+    Aplica en orden lo acumulado en el spool; se detiene al primer fallo.
+    Un solo proceso drena a la vez; los demás salen sin hacer nada.
+    """
+    if circuitos["supabase"].estado == "abierto":
+        return 0
+
+    with _bloqueo(".drenar.lock", esperar=False) as propio:
+        if not propio:
+            return 0
+        return _drenar()
+
+
+def _drenar():
+    en_proceso = SPOOL_PATH + ".drenando"
+    with _spool_lock, _bloqueo(".lock"):
+        # Un .drenando que quedó de un proceso caído va antes que lo nuevo
+        if os.path.exists(SPOOL_PATH):
+            if os.path.exists(en_proceso):
+                with open(en_proceso, "a", encoding="utf-8") as destino, open(SPOOL_PATH, encoding="utf-8") as origen:
+                    destino.write(origen.read())
+                os.remove(SPOOL_PATH)
+            else:
+                os.replace(SPOOL_PATH, en_proceso)
+        if not os.path.exists(en_proceso):
+            return 0
+
+    with open(en_proceso, encoding="utf-8") as f:
+        lineas = f.readlines()
+
+    aplicadas = 0
+    try:
+        for linea in lineas:
+            operacion = json.loads(linea)
+            tabla_ref = supabase.table(operacion["tabla"])
+            try:
+                if operacion["op"] == "upsert":
+                    filas = _mas_nuevas(operacion)
+                    kwargs = {"on_conflict": operacion["on_conflict"]} if operacion["on_conflict"] else {}
+                    if filas:
+                        ejecutar(tabla_ref.upsert(filas, **kwargs))
+                elif operacion["op"] == "rpc":
+                    ejecutar(_rpc(operacion["tabla"], operacion["filas"]))
+                else:
+                    ejecutar(tabla_ref.insert(operacion["filas"]))
+            except Exception as error:
+                if isinstance(error, CircuitoAbierto) or es_transitorio(error):
+                    raise
+                # Un error de datos no se arregla reintentando
+                print(f"[SPOOL] descartada operación en {operacion['tabla']}: {error}")
+            aplicadas += 1
+    except Exception as error:
+        print(f"[SPOOL] drenado detenido tras {aplicadas} operaciones: {error}")
+    finally:
+        # Lo no aplicado vuelve al inicio del spool, antes de lo nuevo
+        with _spool_lock, _bloqueo(".lock"):
+            restantes = lineas[aplicadas:]
+            if os.path.exists(SPOOL_PATH):
+                with open(SPOOL_PATH, encoding="utf-8") as f:
+                    restantes += f.readlines()
+            if restantes:
+                with open(SPOOL_PATH + ".tmp", "w", encoding="utf-8") as f:
+                    f.writelines(restantes)
+                os.replace(SPOOL_PATH + ".tmp", SPOOL_PATH)
+            elif os.path.exists(SPOOL_PATH):
+                os.remove(SPOOL_PATH)
+            os.remove(en_proceso)
+
+    return aplicadas
+
+
+def estado():
+    pendientes = 0
+    for ruta in (SPOOL_PATH, SPOOL_PATH + ".drenando"):
+        if os.path.exists(ruta):
+            with open(ruta, encoding="utf-8") as f:
+                pendientes += sum(1 for _ in f)
+    return {
+        "circuitos": {nombre: c.estado for nombre, c in circuitos.items()},
+        "spool_pendientes": pendientes,
+    }
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from utils.resilience import escribir
+
+# Agregados por torre y métrica en ventanas de 1 minuto y 1 hora.
+# Las ventanas cerradas se escriben en bloque en tower_metric_rollup.
+# Una misma ventana puede llegar en partes (flush al apagar, lecturas
+# atrasadas, el spool), así que no se pisa: se combina en la base con
+#
+#   create function merge_tower_metric_rollup(filas jsonb) returns void language sql as $$
+#     insert into tower_metric_rollup as t (client_id, metric, ventana, bucket_start,
+#         min_value, max_value, sum_value, count, mean_value, last_value)
+#     select client_id, metric, ventana, bucket_start, min_value, max_value,
+#         sum_value, count, sum_value / count, last_value
+#     from jsonb_to_recordset(filas) as f(client_id text, metric text, ventana text,
+#         bucket_start timestamptz, min_value float8, max_value float8,
+#         sum_value float8, count int, last_value float8)
+#     on conflict (client_id, metric, ventana, bucket_start) do update set
+#       min_value = least(t.min_value, excluded.min_value),
+#       max_value = greatest(t.max_value, excluded.max_value),
+#       sum_value = t.sum_value + excluded.sum_value,
+#       count = t.count + excluded.count,
+#       mean_value = (t.sum_value + excluded.sum_value) / (t.count + excluded.count),
+#       last_value = excluded.last_value
+#   $$;
+VENTANAS = {"1m": 60, "1h": 3600}
+# Campo del payload MQTT -> métrica
+METRICAS = {"temperature": "temperature", "humidity": "humidity", "illuminance": "sensor_luz"}
+ROLLUP_FLUSH_SEGUNDOS = float(os.getenv("ROLLUP_FLUSH_SEGUNDOS", "30"))
+# Margen para lecturas que llegan un poco atrasadas
+ROLLUP_GRACIA_SEGUNDOS = float(os.getenv("ROLLUP_GRACIA_SEGUNDOS", "10"))
+
+ROLLUP_TABLE = "tower_metric_rollup"
+ROLLUP_MERGE = "merge_tower_metric_rollup"
+
+# key: (client_id, metrica, ventana, inicio), value: [min, max, suma, count, last]
+ventanas = {}
+_lock = threading.Lock()
+
+
+def registrar(client_id, datos: dict, ts=None):
+    """Suma las lecturas de sensores de un mensaje a sus ventanas abiertas."""
+    ts = ts or time.time()
+    for campo, metrica in METRICAS.items():
+        try:
+            valor = float(datos[campo])
+        except (KeyError, TypeError, ValueError):
+            continue
+
+        with _lock:
+            for ventana, segundos in VENTANAS.items():
+                inicio = int(ts // segundos * segundos)
+                acc = ventanas.get((client_id, metrica, ventana, inicio))
+                if acc is None:
+                    ventanas[(client_id, metrica, ventana, inicio)] = [valor, valor, valor, 1, valor]
+                else:
+                    acc[0] = min(acc[0], valor)
+                    acc[1] = max(acc[1], valor)
+                    acc[2] += valor
+                    acc[3] += 1
+                    acc[4] = valor
+
+
+def _fila(key, acc):
+    client_id, metrica, ventana, inicio = key
+    return {
+        "client_id": client_id,
+        "metric": metrica,
+        "ventana": ventana,
+        "bucket_start": datetime.fromtimestamp(inicio, timezone.utc).isoformat(),
+        "min_value": acc[0],
+        "max_value": acc[1],
+        "sum_value": acc[2],
+        "mean_value": acc[2] / acc[3],
+        "count": acc[3],
+        "last_value": acc[4],
+    }
+
+
+def flush(todo=False):
+    """Suma a la base, en una sola llamada, las ventanas ya cerradas (o todas, al apagar)."""
+    ahora = time.time() - ROLLUP_GRACIA_SEGUNDOS
+    with _lock:
+        cerradas = {
+            key: acc for key, acc in ventanas.items()
+            if todo or key[3] + VENTANAS[key[2]] <= ahora
+        }
+        for key in cerradas:
+            del ventanas[key]
+
+    if not cerradas:
+        return 0
+
+    try:
+        escribir(ROLLUP_MERGE, "rpc", [_fila(key, acc) for key, acc in cerradas.items()])
+    except Exception:
+        # Se devuelven a memoria para el próximo intento
+        with _lock:
+            for key, acc in cerradas.items():
+                actual = ventanas.get(key)
+                if actual is None:
+                    ventanas[key] = acc
+                else:
+                    actual[0] = min(actual[0], acc[0])
+                    actual[1] = max(actual[1], acc[1])
+                    actual[2] += acc[2]
+                    actual[3] += acc[3]
+        raise
+
+    return len(cerradas)
+
+
+def abiertas(client_id, metrica, ventana, desde=None, hasta=None):
+    """Ventanas aún en memoria (datetimes como filtro), con el formato de la tabla."""
+    desde_ts = desde.timestamp() if desde else float("-inf")
+    hasta_ts = hasta.timestamp() if hasta else float("inf")
+    with _lock:
+        items = [
+            (key, list(acc)) for key, acc in ventanas.items()
+            if key[:3] == (client_id, metrica, ventana) and desde_ts <= key[3] <= hasta_ts
+        ]
+    return [_fila(key, acc) for key, acc in sorted(items)]
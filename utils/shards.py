@@ -0,0 +1,280 @@
+import asyncio
+import hashlib
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from bisect import bisect
+from concurrent.futures import Future
+from datetime import datetime, timezone
+
+from utils import positions, registry, teltonika, vehicle_state
+
+# Ingesta en varios procesos con afinidad por dispositivo. El proceso de
+# la API (un solo worker de uvicorn) responde y parsea; cada fix se
+# enruta por hash consistente del device_id a un proceso fijo, así los
+# fixes de un equipo se aplican en orden y su estado (vehicle_state,
+# deadband, viajes) vive en un solo proceso. Los cambios de posición
+# vuelven a la API para el mapa en vivo y los índices espaciales.
+# Cada lote encolado se confirma desde el worker al aplicarlo; la API
+# responde (ACK TCP o 200) recién con la confirmación, así un fallo hace
+# que el equipo o el forwarder reenvíe, igual que sin workers.
+# Con INGEST_WORKERS=0 todo se procesa en el proceso de la API.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0"))
+INGEST_VNODES = int(os.getenv("INGEST_VNODES", "64"))
+# Lotes pendientes por worker antes de responder 503
+INGEST_COLA_MAX = int(os.getenv("INGEST_COLA_MAX", "1000"))
+# Fixes que un worker junta de su cola para aplicarlos en un solo lote
+INGEST_LOTE = int(os.getenv("INGEST_LOTE", "500"))
+INGEST_RETRY_AFTER = int(os.getenv("INGEST_RETRY_AFTER", "5"))
+# Espera máxima por la confirmación de un lote
+INGEST_CONFIRMACION_TIMEOUT = float(os.getenv("INGEST_CONFIRMACION_TIMEOUT", "30"))
+# Cada cuánto se revisa que los workers sigan vivos
+INGEST_VIDA_SEGUNDOS = float(os.getenv("INGEST_VIDA_SEGUNDOS", "1"))
+
+
+class ColaLlena(RuntimeError):
+    pass
+
+
+class LoteFallido(RuntimeError):
+    pass
+
+
+def _hash(clave) -> int:
+    # hash() de Python cambia entre procesos; este no
+    return int.from_bytes(hashlib.blake2b(str(clave).encode(), digest_size=8).digest(), "big")
+
+
+class Anillo:
+    """Hash consistente con nodos virtuales: agregar un nodo mueve ~1/n de las claves."""
+
+    def __init__(self, nodos, vnodes=INGEST_VNODES):
+        puntos = sorted((_hash(f"{nodo}#{v}"), nodo) for nodo in nodos for v in range(vnodes))
+        self.hashes = [h for h, _ in puntos]
+        self.nodos = [nodo for _, nodo in puntos]
+
+    def nodo(self, clave):
+        i = bisect(self.hashes, _hash(clave))
+        return self.nodos[i % len(self.nodos)]
+
+
+# ================== WORKER ==================
+
+def _aplicar(lote):
+    fixes = [fix for _, tipo, grupo in lote if tipo == "teltonika" for fix in grupo]
+    if fixes:
+        teltonika.aplicar_fixes(fixes)
+
+
+def _trabajar(indice, cola, salida):
+    # Las posiciones no se sirven desde aquí: vuelven a la API
+    positions.reenvio = salida.put
+    try:
+        registry.cargar()
+        vehicle_state.cargar()
+        positions.cargar_ultimas()
+    except Exception as e:
+        # Como en la API: sin carga inicial se consulta por dispositivo
+        print(f"[ERR] carga inicial del worker {indice}: {e}")
+    print(f"[SHARD] worker {indice} listo (pid {os.getpid()})")
+
+    while True:
+        item = cola.get()
+        if item is None:
+            return
+        lote = [item]
+        n = len(item[2])
+        fin = False
+        while n < INGEST_LOTE:
+            try:
+                item = cola.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                fin = True
+                break
+            lote.append(item)
+            n += len(item[2])
+        error = None
+        try:
+            _aplicar(lote)
+        except Exception as e:
+            print(f"[ERR] worker {indice}: {e}")
+            error = str(e)
+        # Sin confirmación positiva la API no responde OK y el emisor reenvía
+        for lote_id, _, _ in lote:
+            salida.put(("hecho", lote_id, error))
+        if fin:
+            return
+
+
+# ================== API ==================
+
+_ctx = multiprocessing.get_context("spawn")
+workers = []
+colas = []
+enviados = []
+# lote_id -> (worker, Future que se resuelve con la confirmación del worker)
+_pendientes = {}
+_ids = itertools.count(1)
+_salida = None
+_anillo = None
+_activo = False
+
+
+def _lanzar(indice):
+    proceso = _ctx.Process(target=_trabajar, args=(indice, colas[indice], _salida), daemon=True)
+    proceso.start()
+    workers[indice] = proceso
+
+
+def _fallar(lote_id, error):
+    _, futuro = _pendientes.pop(lote_id, (None, None))
+    if futuro is not None and not futuro.done():
+        futuro.set_exception(LoteFallido(error))
+
+
+def _revisar_workers():
+    for indice, proceso in enumerate(workers):
+        if _activo and not proceso.is_alive():
+            print(f"[ERR] worker {indice} terminó (exit {proceso.exitcode}), se relanza")
+            # Cola nueva: si murió dentro de get() la anterior queda bloqueada.
+            # Sus lotes no se confirmaron, así que el emisor los reenvía.
+            colas[indice] = _ctx.Queue(INGEST_COLA_MAX)
+            for lote_id, (worker, _) in list(_pendientes.items()):
+                if worker == indice:
+                    _fallar(lote_id, f"worker {indice} reiniciado")
+            _lanzar(indice)
+
+
+def _recibir():
+    """
+    Aplica en la API los cambios de posición y las confirmaciones de los
+    workers; cada INGEST_VIDA_SEGUNDOS (haya tráfico o no) relanza los caídos.
+    """
+    proxima_revision = time.monotonic() + INGEST_VIDA_SEGUNDOS
+    while _activo:
+        if time.monotonic() >= proxima_revision:
+            _revisar_workers()
+            proxima_revision = time.monotonic() + INGEST_VIDA_SEGUNDOS
+        try:
+            evento = _salida.get(timeout=max(proxima_revision - time.monotonic(), 0.01))
+        except queue.Empty:
+            continue
+        try:
+            tipo, *args = evento
+            if tipo == "hecho":
+                lote_id, error = args
+                if error is not None:
+                    _fallar(lote_id, error)
+                else:
+                    _, futuro = _pendientes.pop(lote_id, (None, None))
+                    if futuro is not None and not futuro.done():
+                        futuro.set_result(None)
+            elif tipo == "posicion":
+                positions.actualizar(*args)
+            elif tipo == "torre":
+                positions.actualizar_torre(*args)
+        except Exception as e:
+            print(f"[ERR] evento de worker: {e}")
+
+
+def iniciar(n=INGEST_WORKERS):
+    global _salida, _anillo, _activo
+    _salida = _ctx.Queue()
+    _anillo = Anillo(range(n))
+    _activo = True
+    for indice in range(n):
+        colas.append(_ctx.Queue(INGEST_COLA_MAX))
+        workers.append(None)
+        enviados.append(0)
+        _lanzar(indice)
+    threading.Thread(target=_recibir, name="shards", daemon=True).start()
+
+
+def activo() -> bool:
+    return _activo
+
+
+def _encolar(messages):
+    """Parsea y reparte los fixes por IMEI; devuelve ([(lote_id, Future)], fixes, descartados)."""
+    ahora_utc = datetime.now(timezone.utc)
+    fixes = [f for f in (teltonika.parsear(m, ahora_utc) for m in messages) if f is not None]
+
+    por_worker = {}
+    for fix in fixes:
+        por_worker.setdefault(_anillo.nodo(fix["imei"]), []).append(fix)
+    for indice in por_worker:
+        if colas[indice].qsize() >= INGEST_COLA_MAX:
+            raise ColaLlena(f"worker {indice} saturado")
+
+    # Un put por worker: el grupo viaja en orden y se serializa una vez
+    futuros = []
+    for indice, grupo in por_worker.items():
+        lote_id = next(_ids)
+        futuro = Future()
+        _pendientes[lote_id] = (indice, futuro)
+        try:
+            colas[indice].put_nowait((lote_id, "teltonika", grupo))
+        except queue.Full:
+            # Lo ya encolado se aplica igual; sin ACK el emisor reenvía todo
+            for lote in [lote_id, *(lote for lote, _ in futuros)]:
+                _pendientes.pop(lote, None)
+            raise ColaLlena(f"worker {indice} saturado")
+        futuros.append((lote_id, futuro))
+        enviados[indice] += len(grupo)
+    return futuros, len(fixes), len(messages) - len(fixes)
+
+
+async def enviar_teltonika(messages):
+    """
+    Encola los fixes en sus workers y espera a que los apliquen. Levanta
+    ColaLlena si algún worker está saturado y LoteFallido si un worker
+    falla o no confirma en INGEST_CONFIRMACION_TIMEOUT: en ambos casos no
+    se debe confirmar al emisor.
+    """
+    futuros, recibidos, descartados = await asyncio.to_thread(_encolar, messages)
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(asyncio.wrap_future(f) for _, f in futuros)),
+            INGEST_CONFIRMACION_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        raise LoteFallido("sin confirmación del worker")
+    finally:
+        for lote_id, _ in futuros:
+            _pendientes.pop(lote_id, None)
+    return {"received": recibidos, "discarded": descartados}
+
+
+def detener(timeout=10):
+    global _activo
+    _activo = False
+    for indice, cola in enumerate(colas):
+        try:
+            cola.put(None, timeout=timeout)
+        except queue.Full:
+            print(f"[ERR] worker {indice} con la cola llena al detener")
+    for proceso in workers:
+        proceso.join(timeout)
+    for lote_id in list(_pendientes):
+        _fallar(lote_id, "ingesta detenida")
+
+
+def estado():
+    return {
+        "workers": [
+            {
+                "worker": indice,
+                "pid": proceso.pid,
+                "vivo": proceso.is_alive(),
+                "pendientes": colas[indice].qsize(),
+                "enviados": enviados[indice],
+            }
+            for indice, proceso in enumerate(workers)
+        ],
+        "sin_confirmar": len(_pendientes),
+    }
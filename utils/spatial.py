@@ -0,0 +1,250 @@
+import math
+import os
+import threading
+
+import numpy as np
+import shapely
+
+from utils import registry
+from utils.database import iter_keyset
+from utils.geo import haversine_m_vec
+
+# Índices espaciales en memoria (STRtree) sobre balizas, torres y
+# dispositivos para consultas de vecinos y radio sin ir a la base.
+# Torres y dispositivos tienen un índice por empresa, así cada consulta
+# solo ve lo suyo; las balizas no tienen dueño y son un solo índice.
+# Los cambios se acumulan en un delta que se recorre a fuerza bruta y el
+# árbol se reconstruye cuando el delta pasa de SPATIAL_DELTA_MAX.
+SPATIAL_DELTA_MAX = int(os.getenv("SPATIAL_DELTA_MAX", "256"))
+# Radio inicial de la búsqueda de k vecinos; se duplica hasta juntar k
+SPATIAL_KNN_RADIO_M = float(os.getenv("SPATIAL_KNN_RADIO_M", "500"))
+
+METROS_POR_GRADO = 111_320
+MEDIA_VUELTA_M = math.pi * 6371008.8
+
+
+def _caja(lat, lon, radio_m):
+    dlat = radio_m / METROS_POR_GRADO
+    dlon = radio_m / (METROS_POR_GRADO * max(math.cos(math.radians(lat)), 0.01))
+    return shapely.box(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+
+
+class Capa:
+    def __init__(self, nombre):
+        self.nombre = nombre
+        # id -> (lat, lon, datos): el estado vigente
+        self.puntos = {}
+        # Foto con la que se armó el árbol
+        self.ids = np.empty(0, dtype=object)
+        self.lats = np.empty(0)
+        self.lons = np.empty(0)
+        self.arbol = None
+        # ids que cambiaron o se borraron desde la foto
+        self.cambiados = set()
+        self._lock = threading.Lock()
+
+    def _reconstruir(self):
+        ids = list(self.puntos)
+        self.ids = np.array(ids, dtype=object)
+        self.lats = np.array([self.puntos[i][0] for i in ids], dtype=np.float64)
+        self.lons = np.array([self.puntos[i][1] for i in ids], dtype=np.float64)
+        self.arbol = shapely.STRtree(shapely.points(self.lons, self.lats)) if ids else None
+        self.cambiados = set()
+
+    def poner(self, id_, lat, lon, datos=None):
+        if lat is None or lon is None:
+            return
+        with self._lock:
+            self.puntos[id_] = (float(lat), float(lon), datos or {})
+            self.cambiados.add(id_)
+            if len(self.cambiados) > SPATIAL_DELTA_MAX:
+                self._reconstruir()
+
+    def quitar(self, id_):
+        with self._lock:
+            if self.puntos.pop(id_, None) is not None:
+                self.cambiados.add(id_)
+
+    def reemplazar(self, puntos):
+        """Carga completa {id: (lat, lon, datos)}; reconstruye el árbol."""
+        with self._lock:
+            self.puntos = {i: (float(p[0]), float(p[1]), p[2]) for i, p in puntos.items()}
+            self._reconstruir()
+
+    def obtener(self, id_):
+        return self.puntos.get(id_)
+
+    def _candidatos(self, lat, lon, radio_m):
+        """(ids, distancias) de todo lo que cae en la caja que envuelve el radio."""
+        ids = []
+        dists = []
+        if self.arbol is not None:
+            idx = self.arbol.query(_caja(lat, lon, radio_m))
+            if self.cambiados:
+                idx = np.array([i for i in idx if self.ids[i] not in self.cambiados], dtype=np.intp)
+            if len(idx):
+                ids.extend(self.ids[idx])
+                dists.extend(haversine_m_vec(lat, lon, self.lats[idx], self.lons[idx]))
+
+        delta = [(i, self.puntos[i]) for i in self.cambiados if i in self.puntos]
+        if delta:
+            ids.extend(i for i, _ in delta)
+            dists.extend(haversine_m_vec(
+                lat, lon,
+                np.array([p[0] for _, p in delta]),
+                np.array([p[1] for _, p in delta]),
+            ))
+        return ids, np.asarray(dists, dtype=np.float64)
+
+    def _filas(self, ids, dists, orden):
+        return [
+            {
+                "id": ids[i],
+                "lat": self.puntos[ids[i]][0],
+                "lon": self.puntos[ids[i]][1],
+                "distancia_m": round(float(dists[i]), 2),
+                **self.puntos[ids[i]][2],
+            }
+            for i in orden
+        ]
+
+    def en_radio(self, lat, lon, radio_m, limite=None):
+        with self._lock:
+            ids, dists = self._candidatos(lat, lon, radio_m)
+            orden = np.flatnonzero(dists <= radio_m)
+            orden = orden[np.argsort(dists[orden], kind="stable")][:limite]
+            return self._filas(ids, dists, orden)
+
+    def vecinos(self, lat, lon, k=1, excluir=None):
+        with self._lock:
+            total = len(self.puntos) - (1 if excluir in self.puntos else 0)
+            k = min(k, total)
+            if k <= 0:
+                return []
+
+            radio = SPATIAL_KNN_RADIO_M
+            while True:
+                ids, dists = self._candidatos(lat, lon, radio)
+                if excluir is not None:
+                    dists = np.where(np.array(ids, dtype=object) == excluir, np.inf, dists)
+                dentro = np.flatnonzero(dists <= radio)
+                # Con k puntos dentro del círculo, ninguno de fuera puede estar más cerca
+                if len(dentro) >= k or radio >= MEDIA_VUELTA_M:
+                    orden = dentro[np.argsort(dists[dentro], kind="stable")][:k]
+                    return self._filas(ids, dists, orden)
+                radio *= 2
+
+    def estado(self):
+        return {"puntos": len(self.puntos), "delta": len(self.cambiados)}
+
+
+class PorEmpresa:
+    """Una Capa por empresa; los puntos sin empresa conocida no se indexan."""
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.empresas = {}
+        # id -> empresa en la que está indexado
+        self.duenos = {}
+        self._lock = threading.Lock()
+
+    def de(self, empresa):
+        with self._lock:
+            capa = self.empresas.get(str(empresa))
+            if capa is None:
+                capa = self.empresas[str(empresa)] = Capa(self.nombre)
+            return capa
+
+    def poner(self, id_, empresa, lat, lon, datos=None):
+        if empresa is None:
+            return self.quitar(id_)
+        empresa = str(empresa)
+        anterior = self.duenos.get(id_)
+        if anterior is not None and anterior != empresa:
+            self.empresas[anterior].quitar(id_)
+        self.duenos[id_] = empresa
+        self.de(empresa).poner(id_, lat, lon, datos)
+
+    def quitar(self, id_):
+        anterior = self.duenos.pop(id_, None)
+        if anterior is not None:
+            self.empresas[anterior].quitar(id_)
+
+    def reemplazar(self, puntos):
+        """Carga completa {id: (lat, lon, datos, empresa)}."""
+        grupos = {}
+        for id_, (lat, lon, datos, empresa) in puntos.items():
+            if empresa is not None:
+                grupos.setdefault(str(empresa), {})[id_] = (lat, lon, datos)
+        for empresa in set(self.empresas) - set(grupos):
+            self.de(empresa).reemplazar({})
+        for empresa, grupo in grupos.items():
+            self.de(empresa).reemplazar(grupo)
+        self.duenos = {id_: empresa for empresa, grupo in grupos.items() for id_ in grupo}
+
+    def estado(self):
+        capas_ = list(self.empresas.values())
+        return {
+            "empresas": len(capas_),
+            "puntos": sum(len(c.puntos) for c in capas_),
+            "delta": sum(len(c.cambiados) for c in capas_),
+        }
+
+
+capas = {
+    "beacons": Capa("beacons"),
+    "towers": PorEmpresa("towers"),
+    "devices": PorEmpresa("devices"),
+}
+
+
+def capa(nombre, empresa) -> Capa:
+    """Índice que puede consultar la empresa."""
+    if nombre == "beacons":
+        return capas["beacons"]
+    return capas[nombre].de(empresa)
+
+
+# device_id de tower_value -> client_id (la torre con GPS Teltonika se actualiza por device_id)
+_torre_por_device = {}
+
+
+def cargar_beacons():
+    capas["beacons"].reemplazar({
+        fila["mac"]: (fila["lat"], fila["lon"], {})
+        for fila in iter_keyset("beacons", "mac, lat, lon", key="mac")
+        if fila.get("lat") is not None and fila.get("lon") is not None
+    })
+
+
+def cargar_torres():
+    puntos = {}
+    for fila in iter_keyset("tower_value", "client_id, device_id, lat, lon, empresas(id)", key="client_id"):
+        if fila.get("device_id"):
+            _torre_por_device[fila["device_id"]] = fila["client_id"]
+        if fila.get("lat") is not None and fila.get("lon") is not None:
+            empresa = (fila.get("empresas") or {}).get("id")
+            puntos[fila["client_id"]] = (fila["lat"], fila["lon"], {"device_id": fila.get("device_id")}, empresa)
+    capas["towers"].reemplazar(puntos)
+
+
+def cargar_dispositivos(posiciones):
+    capas["devices"].reemplazar({
+        device_id: (fila["lat"], fila["lon"], {"type": fila.get("type")}, registry.empresa_de(device_id))
+        for device_id, fila in list(posiciones.items())
+        if fila.get("lat") is not None and fila.get("lon") is not None
+    })
+
+
+def mover_dispositivo(device_id, fila: dict):
+    if fila.get("lat") is not None and fila.get("lon") is not None:
+        capas["devices"].poner(
+            device_id, registry.empresa_de(device_id), fila["lat"], fila["lon"], {"type": fila.get("type")}
+        )
+
+
+def mover_torre(device_id, lat, lon):
+    client_id = _torre_por_device.get(device_id)
+    dueno = capas["towers"].duenos.get(client_id)
+    if client_id is not None and dueno is not None:
+        capas["towers"].poner(client_id, dueno, lat, lon, {"device_id": device_id})
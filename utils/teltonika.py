@@ -0,0 +1,190 @@
+from datetime import datetime, timezone
+from itertools import groupby
+from typing import Any, Dict, List, Optional
+
+from utils import deadband, positions, profiling, registry, vehicle_state
+from utils.database import supabase
+from utils.resilience import ejecutar, escribir
+
+
+
+def normalize_ignition(raw: Any) -> Optional[bool]:
+    """Normaliza ignition a True/False/None."""
+    if raw in (True, "true", "TRUE", 1, "1", "on", "ON"):
+        return True
+    if raw in (False, "false", "FALSE", 0, "0", "off", "OFF"):
+        return False
+    return None
+
+
+def parsear(msg: Dict, ahora_utc: datetime) -> Optional[Dict]:
+    """Valida un mensaje del forwarder y lo deja como fix normalizado (o None)."""
+    if not isinstance(msg, dict):
+        return None
+
+    imei = msg.get("ident")
+    lat = msg.get("position.latitude")
+    lon = msg.get("position.longitude")
+
+    if imei is None or lat is None or lon is None:
+        return None
+
+    # Normaliza coordenadas
+    try:
+        lat_f = float(lat)
+        lon_f = float(lon)
+    except (TypeError, ValueError):
+        return None
+
+    # Hora del equipo; si no viene o es inválida, la de recepción
+    try:
+        ts = float(msg.get("timestamp"))
+        observed = datetime.fromtimestamp(ts, timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        observed = ahora_utc
+        ts = ahora_utc.timestamp()
+
+    speed = msg.get("position.speed")
+
+    return {
+        "imei": str(imei),
+        "lat": lat_f,
+        "lon": lon_f,
+        "ts": ts,
+        "observed": observed,
+        "ignition": normalize_ignition(msg.get("engine.ignition.status")),
+        "extra": {
+            "battery_voltage": msg.get("external.powersource.voltage"),
+            "mileage": msg.get("vehicle.mileage"),
+            "speed": speed,
+            "raw_ignition": msg.get("engine.ignition.status"),
+        },
+    }
+
+
+@profiling.trazar("teltonika.lote")
+def procesar_lote(messages: List[Dict]) -> Dict:
+    """
+    Procesa un lote completo de mensajes Teltonika:
+    1) parsea y valida todo, 2) agrupa por IMEI en orden de hora del equipo,
+    3) aplica las transiciones de estado y 4) escribe con un insert de
+    history, un upsert de device_position y uno de vehicle_state.
+    """
+    ahora_utc = datetime.now(timezone.utc)
+
+    # 1) Parseo y validación
+    with profiling.span("teltonika.decode"):
+        fixes = [f for f in (parsear(m, ahora_utc) for m in messages) if f is not None]
+
+    return {**aplicar_fixes(fixes), "discarded": len(messages) - len(fixes)}
+
+
+def aplicar_fixes(fixes: List[Dict]) -> Dict:
+    """
+    Pasos 2 a 4 de procesar_lote sobre fixes ya parseados (también los usa
+    el replay). Lo que puede levantar (torres, trips) va antes de los
+    inserts: si el lote falla y el emisor lo reenvía, history no se duplica.
+    """
+    # 2) Agrupado por IMEI y orden por hora del equipo
+    fixes.sort(key=lambda f: (f["imei"], f["ts"]))
+    grupos = [(imei, list(grupo)) for imei, grupo in groupby(fixes, key=lambda f: f["imei"])]
+
+    history_rows: List[Dict] = []
+    tower_rows: Dict[str, List[Dict]] = {}
+    position_rows: Dict[str, Dict] = {}
+    state_rows: Dict[str, Dict] = {}
+
+    # GPS instalados en torres: su posición va a tower_value
+    vehiculos = []
+    for imei, grupo in grupos:
+        torre = registry.torre_de(imei)
+        if torre is None:
+            vehiculos.append((imei, grupo))
+            continue
+        tower_rows.setdefault(torre, []).extend(
+            {"lat": f["lat"], "lon": f["lon"], "imei": imei, "extra": f["extra"]}
+            for f in grupo
+        )
+
+    for torre, filas in tower_rows.items():
+        ultimo = filas[-1]
+        tower_update = {"lat": ultimo["lat"], "lon": ultimo["lon"], "extra": ultimo["extra"]}
+        ejecutar(supabase.table("tower_value").update(tower_update).eq("device_id", torre), reintentos=2)
+        positions.actualizar_torre(torre, tower_update, ultimo["lat"], ultimo["lon"])
+
+    # 3) Transiciones de estado. Las de un mismo IMEI no pueden
+    # intercalarse entre lotes: cada grupo va con el lock de su IMEI
+    try:
+        with profiling.span("teltonika.estado"):
+            for imei, grupo in vehiculos:
+                tipo, dev_eui, _ = registry.identidad(imei, "Vehicle")
+
+                for f in grupo:
+                    observed_at = f["observed"].isoformat()
+                    ignition = f["ignition"]
+
+                    history_trip_id = vehicle_state.aplicar(
+                        imei, ignition, observed_at, f["ts"], f["lat"], f["lon"],
+                        speed=f["extra"]["speed"], mileage=f["extra"]["mileage"], pendientes=state_rows,
+                    )
+
+                    # El cambio de ignition siempre se guarda (abre/cierra viaje).
+                    if deadband.debe_guardar(imei, f["lat"], f["lon"], f["observed"], estado=ignition):
+                        history_rows.append(
+                            {
+                                "device_id": imei,
+                                "trip_id": history_trip_id,  # puede ser NULL si no hay viaje
+                                "lat": f["lat"],
+                                "lon": f["lon"],
+                                "observed_at": observed_at,
+                                "ignition": ignition,
+                                "extra": f["extra"],
+                            }
+                        )
+
+                    # Solo el último punto del lote queda como posición actual
+                    position_rows[imei] = {
+                        "device_id": imei,
+                        "lat": f["lat"],
+                        "lon": f["lon"],
+                        "last_seen": observed_at,
+                        "extra": {**f["extra"], "ignition": ignition, "trip_id": history_trip_id},
+                        "type": tipo,
+                        "dev_eui": dev_eui,
+                    }
+    except Exception:
+        # El estado en memoria ya avanzó: se persiste lo aplicado y el
+        # deadband olvida los puntos no escritos, así el reenvío los guarda
+        vehicle_state.persistir(state_rows)
+        _olvidar(history_rows)
+        raise
+
+    # 4) Escrituras agrupadas (si Supabase no responde quedan en el spool)
+    if history_rows:
+        try:
+            escribir("vehicle_position_history", "insert", history_rows)
+        except Exception:
+            _olvidar(history_rows)
+            raise
+    # Solo pisan la posición actual los fixes más nuevos que la guardada
+    nuevas = positions.mas_nuevas(list(position_rows.values()))
+    if nuevas:
+        escribir("device_position", "upsert", nuevas, on_conflict="device_id")
+        for fila in nuevas:
+            positions.actualizar(fila["device_id"], fila)
+    vehicle_state.persistir(state_rows)
+
+    if tower_rows:
+        escribir("tower_position_history", "insert", [f for filas in tower_rows.values() for f in filas])
+
+    en_torres = sum(len(filas) for filas in tower_rows.values())
+    return {
+        "received": len(fixes) - en_torres,
+        "tower": en_torres,
+        "history": len(history_rows),
+    }
+
+
+def _olvidar(history_rows):
+    for imei in {fila["device_id"] for fila in history_rows}:
+        deadband.invalidar(imei)
@@ -0,0 +1,189 @@
+import asyncio
+import os
+import struct
+
+from utils import shards, teltonika
+
+# Servidor TCP para equipos Teltonika (Codec 8 / 8 Extended).
+# Se activa definiendo TELTONIKA_TCP_PORT.
+TELTONIKA_TCP_HOST = os.getenv("TELTONIKA_TCP_HOST", "0.0.0.0")
+TELTONIKA_TCP_PORT = os.getenv("TELTONIKA_TCP_PORT")
+TELTONIKA_TCP_TIMEOUT = float(os.getenv("TELTONIKA_TCP_TIMEOUT", "300"))
+
+CODEC_8 = 0x08
+CODEC_8E = 0x8E
+
+# Máximo razonable para un paquete AVL (los equipos mandan < 1300 bytes)
+MAX_AVL_BYTES = 64 * 1024
+
+# IO element id -> (campo plano del forwarder, factor)
+IO_CAMPOS = {
+    239: ("engine.ignition.status", None),
+    66: ("external.powersource.voltage", 0.001),  # mV -> V
+    16: ("vehicle.mileage", 0.001),                # m -> km
+}
+
+
+class AvlError(ValueError):
+    pass
+
+
+def crc16_ibm(data) -> int:
+    """CRC-16/IBM (polinomio 0xA001 reflejado) usado por Teltonika."""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+
+def _leer_io(buf: memoryview, off: int, extendido: bool):
+    """Lee el bloque IO de un registro. Devuelve ({id: valor}, nuevo offset)."""
+    # En 8E los ids y contadores son de 2 bytes
+    fmt_n = ">H" if extendido else ">B"
+    tam_n = 2 if extendido else 1
+    io = {}
+
+    off += tam_n * 2  # event IO id + total de elementos
+
+    for tam, fmt in ((1, "B"), (2, "H"), (4, "I"), (8, "Q")):
+        (n,) = struct.unpack_from(fmt_n, buf, off)
+        off += tam_n
+        for _ in range(n):
+            (io_id,) = struct.unpack_from(fmt_n, buf, off)
+            off += tam_n
+            (io[io_id],) = struct.unpack_from(">" + fmt, buf, off)
+            off += tam
+
+    if extendido:
+        # Elementos de largo variable (NX)
+        (n,) = struct.unpack_from(">H", buf, off)
+        off += 2
+        for _ in range(n):
+            io_id, largo = struct.unpack_from(">HH", buf, off)
+            off += 4
+            io[io_id] = bytes(buf[off:off + largo])
+            off += largo
+
+    return io, off
+
+
+def decodificar_avl(imei: str, data: memoryview):
+    """
+    Decodifica el campo de datos de un paquete AVL (codec .. N2) a
+    mensajes con las mismas claves planas que manda el forwarder.
+    """
+    codec = data[0]
+    if codec not in (CODEC_8, CODEC_8E):
+        raise AvlError(f"codec no soportado: {codec:#x}")
+    extendido = codec == CODEC_8E
+
+    cantidad = data[1]
+    if data[-1] != cantidad:
+        raise AvlError("cantidad de registros inconsistente")
+
+    mensajes = []
+    off = 2
+    for _ in range(cantidad):
+        ts_ms, prioridad, lon, lat, alt, angulo, sats, velocidad = struct.unpack_from(
+            ">QBiihHBH", data, off
+        )
+        off += 24
+        io, off = _leer_io(data, off, extendido)
+
+        msg = {
+            "ident": imei,
+            "timestamp": ts_ms / 1000,
+            "position.latitude": lat / 1e7,
+            "position.longitude": lon / 1e7,
+            "position.altitude": alt,
+            "position.direction": angulo,
+            "position.satellites": sats,
+            "position.speed": velocidad,
+            "priority": prioridad,
+        }
+        for io_id, valor in io.items():
+            campo = IO_CAMPOS.get(io_id)
+            if campo is None:
+                continue
+            nombre, factor = campo
+            msg[nombre] = round(valor * factor, 3) if factor else valor
+
+        # Sin fix GPS el equipo manda 0,0: no es una posición válida
+        if sats == 0 and lat == 0 and lon == 0:
+            del msg["position.latitude"], msg["position.longitude"]
+
+        mensajes.append(msg)
+
+    if off != len(data) - 1:
+        raise AvlError("largo del paquete no coincide con los registros")
+
+    return mensajes
+
+
+async def _atender(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    peer = writer.get_extra_info("peername")
+    imei = None
+    try:
+        # Handshake: 2 bytes de largo + IMEI en ASCII, respondemos 0x01
+        (largo,) = struct.unpack(">H", await asyncio.wait_for(reader.readexactly(2), TELTONIKA_TCP_TIMEOUT))
+        imei = (await reader.readexactly(largo)).decode("ascii", "replace")
+        if not imei.isdigit():
+            writer.write(b"\x00")
+            await writer.drain()
+            return
+        writer.write(b"\x01")
+        await writer.drain()
+        print(f"[TCP] {imei} conectado desde {peer}")
+
+        while True:
+            cabecera = await asyncio.wait_for(reader.readexactly(8), TELTONIKA_TCP_TIMEOUT)
+            preambulo, largo = struct.unpack(">II", cabecera)
+            if preambulo != 0 or largo > MAX_AVL_BYTES:
+                raise AvlError("cabecera AVL inválida")
+
+            paquete = memoryview(await reader.readexactly(largo + 4))
+            data = paquete[:largo]
+            (crc,) = struct.unpack_from(">I", paquete, largo)
+
+            if crc16_ibm(data) != crc:
+                # Responder 0 registros hace que el equipo reenvíe el paquete
+                print(f"[TCP] {imei} CRC inválido, se pide reenvío")
+                writer.write(struct.pack(">I", 0))
+                await writer.drain()
+                continue
+
+            mensajes = decodificar_avl(imei, data)
+            # Mismo pipeline que /teltonika-hook; el ACK va después de
+            # escribir (o de que el worker de ingesta confirme) para que el
+            # equipo reenvíe si algo falla.
+            if shards.activo():
+                try:
+                    await shards.enviar_teltonika(mensajes)
+                except (shards.ColaLlena, shards.LoteFallido):
+                    writer.write(struct.pack(">I", 0))
+                    await writer.drain()
+                    continue
+            else:
+                await asyncio.to_thread(teltonika.procesar_lote, mensajes)
+
+            writer.write(struct.pack(">I", len(mensajes)))
+            await writer.drain()
+
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception as e:
+        print(f"[ERR] TCP Teltonika {imei or peer}: {e}")
+    finally:
+        writer.close()
+
+
+async def iniciar_servidor(host=TELTONIKA_TCP_HOST, port=None):
+    port = int(port or TELTONIKA_TCP_PORT)
+    server = await asyncio.start_server(_atender, host, port)
+    print(f"[TCP] Teltonika escuchando en {host}:{port}")
+    return server
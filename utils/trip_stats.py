@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+
+from utils.database import supabase
+from utils.geo import haversine_m
+from utils.resilience import ejecutar
+
+# Estadísticas por viaje, acumuladas en memoria mientras está activo y
+# guardadas en trips (cada TRIP_STATS_FLUSH_SEGUNDOS y al cerrarlo):
+#
+#   alter table trips
+#     add column distance_m float8,
+#     add column moving_s float8,
+#     add column idle_s float8,
+#     add column max_speed_kmh float8,
+#     add column avg_speed_kmh float8,
+#     add column mileage_start float8,
+#     add column mileage_delta float8;
+#
+# Cada cuánto se persisten los acumulados de un viaje activo
+TRIP_STATS_FLUSH_SEGUNDOS = float(os.getenv("TRIP_STATS_FLUSH_SEGUNDOS", "60"))
+# Bajo esta velocidad el tramo cuenta como tiempo detenido (ralentí)
+VELOCIDAD_MOVIMIENTO_KMH = float(os.getenv("VELOCIDAD_MOVIMIENTO_KMH", "3"))
+
+STATS_COLUMNS = "distance_m, moving_s, idle_s, max_speed_kmh, mileage_start, mileage_delta"
+
+# key: trip_id, value: acumulados del viaje
+viajes = {}
+_lock = threading.Lock()
+
+
+def _nuevo(ts, lat, lon, mileage, previo=None):
+    previo = previo or {}
+    return {
+        "distance_m": float(previo.get("distance_m") or 0),
+        "moving_s": float(previo.get("moving_s") or 0),
+        "idle_s": float(previo.get("idle_s") or 0),
+        "max_speed_kmh": float(previo.get("max_speed_kmh") or 0),
+        "mileage_start": previo.get("mileage_start") if previo.get("mileage_start") is not None else mileage,
+        "mileage_last": mileage,
+        "last_lat": lat,
+        "last_lon": lon,
+        "last_ts": ts,
+        "last_flush": time.monotonic(),
+    }
+
+
+def _a_float(valor):
+    try:
+        return float(valor) if valor is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def resumen(acc):
+    """Columnas de trips a partir de los acumulados."""
+    avg = acc["distance_m"] / acc["moving_s"] * 3.6 if acc["moving_s"] > 0 else 0.0
+    mileage_delta = None
+    if acc["mileage_start"] is not None and acc["mileage_last"] is not None:
+        mileage_delta = acc["mileage_last"] - acc["mileage_start"]
+
+    return {
+        "distance_m": round(acc["distance_m"], 1),
+        "moving_s": round(acc["moving_s"]),
+        "idle_s": round(acc["idle_s"]),
+        "max_speed_kmh": acc["max_speed_kmh"],
+        "avg_speed_kmh": round(avg, 1),
+        "mileage_start": acc["mileage_start"],
+        "mileage_delta": mileage_delta,
+    }
+
+
+def iniciar(trip_id, ts, lat, lon, mileage=None):
+    """Registra un viaje recién creado."""
+    with _lock:
+        viajes[trip_id] = _nuevo(ts, lat, lon, _a_float(mileage))
+
+
+def acumular(trip_id, ts, lat, lon, speed=None, mileage=None):
+    """
+    Suma el tramo desde el último punto del viaje.
+    Devuelve el resumen si toca persistirlo, si no None.
+    """
+    speed = _a_float(speed)
+    mileage = _a_float(mileage)
+
+    with _lock:
+        acc = viajes.get(trip_id)
+
+    if acc is None:
+        # Viaje abierto antes de un reinicio: seguimos desde lo persistido
+        res = ejecutar(supabase.table("trips").select(STATS_COLUMNS).eq("id", trip_id), reintentos=2)
+        with _lock:
+            acc = viajes.setdefault(trip_id, _nuevo(ts, lat, lon, mileage, res.data[0] if res.data else None))
+
+    with _lock:
+        dt = ts - acc["last_ts"]
+        if dt > 0:
+            dist = haversine_m(acc["last_lat"], acc["last_lon"], lat, lon)
+            velocidad = speed if speed is not None else dist / dt * 3.6
+            acc["distance_m"] += dist
+            if velocidad >= VELOCIDAD_MOVIMIENTO_KMH:
+                acc["moving_s"] += dt
+            else:
+                acc["idle_s"] += dt
+            acc["last_lat"], acc["last_lon"], acc["last_ts"] = lat, lon, ts
+
+        if speed is not None and speed > acc["max_speed_kmh"]:
+            acc["max_speed_kmh"] = speed
+        if mileage is not None:
+            acc["mileage_last"] = mileage
+            if acc["mileage_start"] is None:
+                acc["mileage_start"] = mileage
+
+        if time.monotonic() - acc["last_flush"] >= TRIP_STATS_FLUSH_SEGUNDOS:
+            acc["last_flush"] = time.monotonic()
+            return resumen(acc)
+
+    return None
+
+
+def cerrar(trip_id):
+    """Saca el viaje de memoria y devuelve su resumen final (o {} si no se conocía)."""
+    with _lock:
+        acc = viajes.pop(trip_id, None)
+    return resumen(acc) if acc else {}
+
+
+def resumen_activo(trip_id):
+    """Resumen en vivo de un viaje abierto, o None si no está en memoria."""
+    with _lock:
+        acc = viajes.get(trip_id)
+        return resumen(acc) if acc else None
@@ -0,0 +1,74 @@
+import json
+
+from shapely.geometry import LineString
+
+from utils.database import iter_keyset
+
+TRACK_COLUMNS = "id, lat, lon, observed_at, ignition, extra"
+
+# Aproximación metros -> grados para la tolerancia de simplificación
+METROS_POR_GRADO = 111_320
+
+
+def filas_trip(trip_id, page_size=1000):
+    """
+    Puntos del viaje en orden de observed_at (id desempata): los fixes
+    bufereados llegan tarde y su id no sigue el orden del recorrido.
+    """
+    return iter_keyset(
+        "vehicle_position_history",
+        TRACK_COLUMNS,
+        filtros={"trip_id": trip_id},
+        key="observed_at",
+        desempate="id",
+        page_size=page_size,
+    )
+
+
+def simplificar(filas, tolerancia_m):
+    """
+    Douglas–Peucker sobre el recorrido (shapely simplify).
+    Devuelve las filas originales que sobreviven, conservando sus timestamps.
+    """
+    filas = [f for f in filas if f.get("lat") is not None and f.get("lon") is not None]
+    if len(filas) < 3:
+        return filas
+
+    linea = LineString([(float(f["lon"]), float(f["lat"])) for f in filas])
+    simplificada = linea.simplify(tolerancia_m / METROS_POR_GRADO, preserve_topology=False)
+    restantes = list(simplificada.coords)
+
+    # Los vértices de la línea simplificada son un subconjunto ordenado
+    # de los originales, así que basta con un recorrido en paralelo.
+    resultado = []
+    i = 0
+    for fila in filas:
+        if i < len(restantes) and (float(fila["lon"]), float(fila["lat"])) == restantes[i]:
+            resultado.append(fila)
+            i += 1
+    return resultado
+
+
+def stream_track(trip_id, formato="ndjson", tolerancia_m=None):
+    """Genera el recorrido como NDJSON (una fila por línea) o GeoJSON LineString."""
+    filas = filas_trip(trip_id)
+    if tolerancia_m:
+        filas = simplificar(filas, tolerancia_m)
+
+    if formato == "ndjson":
+        for fila in filas:
+            yield json.dumps(fila, default=str) + "\n"
+        return
+
+    yield (
+        '{"type":"Feature","properties":{"trip_id":%s},'
+        '"geometry":{"type":"LineString","coordinates":[' % json.dumps(trip_id)
+    )
+    primero = True
+    for fila in filas:
+        if fila.get("lat") is None or fila.get("lon") is None:
+            continue
+        punto = json.dumps([float(fila["lon"]), float(fila["lat"])])
+        yield punto if primero else "," + punto
+        primero = False
+    yield "]}}\n"
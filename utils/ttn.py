@@ -0,0 +1,156 @@
+import re
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Decodificación de los uplinks de TTN (/ttn-webhook y /abee-ttn) sin
+# tocar la base: la usan los handlers y el replay offline (scripts/replay.py).
+
+
+class PayloadInvalido(ValueError):
+    pass
+
+
+def _senal(uplink: Dict):
+    rx_metadata = uplink.get("rx_metadata") or []
+    rssi = rx_metadata[0].get("rssi") if rx_metadata else None
+    snr = rx_metadata[0].get("snr") if rx_metadata else None
+    return rssi, snr
+
+
+def _gateways(uplink: Dict) -> List[Dict]:
+    """Todos los gateways que recibieron el uplink (rx_metadata completo)."""
+    gateways = []
+    for rx in uplink.get("rx_metadata") or []:
+        gateway_id = (rx.get("gateway_ids") or {}).get("gateway_id")
+        if gateway_id:
+            rssi = rx.get("rssi", rx.get("channel_rssi"))
+            gateways.append({"gateway_id": gateway_id, "rssi": rssi, "snr": rx.get("snr")})
+    return gateways
+
+
+def _ordenar_ble(hits: List[Dict]) -> List[Dict]:
+    # Primero la baliza con mejor RSSI
+    hits.sort(key=lambda h: h["rssi"] if h["rssi"] is not None else -9999, reverse=True)
+    return hits
+
+
+def recibido_en(data: Dict) -> Optional[datetime]:
+    """received_at del uplink (hora del network server), si viene."""
+    uplink = data.get("uplink_message") or data.get("data", {}).get("uplink_message") or {}
+    valor = data.get("received_at") or uplink.get("received_at")
+    if not valor:
+        return None
+    try:
+        # TTN manda nanosegundos; fromisoformat acepta hasta microsegundos
+        return datetime.fromisoformat(re.sub(r"(\.\d{6})\d+", r"\1", valor.replace("Z", "+00:00")))
+    except ValueError:
+        return None
+
+
+def decodificar_ttn(data: Dict) -> Dict:
+    """
+    Uplink del tracker LoRaWAN de /ttn-webhook. gnss es (lat, lon) o None;
+    ble son las balizas vistas, ordenadas por RSSI.
+    """
+    device_id = (data.get("end_device_ids") or {}).get("device_id")
+    if not device_id:
+        raise PayloadInvalido("No se encontró device_id")
+
+    uplink = data.get("uplink_message", {}) or {}
+    decoded_payload = uplink.get("decoded_payload", {}) or {}
+
+    messages = decoded_payload.get("messages", [])
+    if messages and isinstance(messages[0], list):
+        messages = messages[0]
+
+    latitude = None
+    longitude = None
+    battery = None
+    ble_hits = []
+
+    for msg in messages:
+        tipo = msg.get("type") or ""
+        valor = msg.get("measurementValue")
+        if tipo == "Latitude":
+            latitude = valor
+        elif tipo == "Longitude":
+            longitude = valor
+        elif tipo == "Battery":
+            battery = valor
+        elif "BLE" in tipo.upper():
+            for v in valor or []:
+                mac = v.get("mac") or v.get("id")
+                if mac:
+                    try:
+                        rssi_ble = int(v.get("rssi")) if v.get("rssi") else None
+                    except (TypeError, ValueError):
+                        rssi_ble = None
+                    ble_hits.append({"mac": mac, "rssi": rssi_ble})
+
+    gnss = None
+    if latitude is not None and longitude is not None:
+        try:
+            gnss = (float(latitude), float(longitude))
+        except (TypeError, ValueError):
+            raise PayloadInvalido("Coordenadas inválidas")
+
+    rssi, snr = _senal(uplink)
+    return {
+        "device_id": device_id,
+        "dev_eui": device_id.upper(),
+        "battery": battery,
+        "rssi": rssi,
+        "snr": snr,
+        "gateways": _gateways(uplink),
+        "gnss": gnss,
+        "ble": _ordenar_ble(ble_hits),
+    }
+
+
+def decodificar_abee(data: Dict) -> Dict:
+    """
+    Uplink del tracker Abeeway de /abee-ttn. Si trae sección BLE, ble es la
+    lista de balizas (puede quedar vacía) y el GNSS se ignora; si no, ble es None.
+    """
+    end_ids = data.get("end_device_ids") or data.get("data", {}).get("end_device_ids") or {}
+    device_id = end_ids.get("device_id")
+    dev_eui = end_ids.get("dev_eui") or end_ids.get("devEui")
+    if not device_id:
+        raise PayloadInvalido("No se encontró device_id")
+
+    uplink = data.get("uplink_message") or data.get("data", {}).get("uplink_message") or {}
+    decoded = uplink.get("decoded_payload") or {}
+    ble_list = decoded.get("ble") or []
+
+    ble = None
+    gnss = None
+    if ble_list:
+        ble = []
+        for b in ble_list:
+            mac = b.get("id")
+            if mac:
+                try:
+                    rssi_val = int(b.get("rssi"))
+                except (TypeError, ValueError):
+                    rssi_val = None
+                ble.append({"mac": mac, "rssi": rssi_val})
+        _ordenar_ble(ble)
+    else:
+        loc = (uplink.get("locations") or {}).get("frm-payload") or {}
+        if loc.get("latitude") is not None and loc.get("longitude") is not None:
+            try:
+                gnss = (float(loc["latitude"]), float(loc["longitude"]))
+            except (TypeError, ValueError):
+                raise PayloadInvalido("Coordenadas inválidas")
+
+    rssi, snr = _senal(uplink)
+    return {
+        "device_id": device_id,
+        "dev_eui": (dev_eui or device_id).upper(),
+        "battery": decoded.get("battery_percent"),
+        "rssi": rssi,
+        "snr": snr,
+        "gateways": _gateways(uplink),
+        "gnss": gnss,
+        "ble": ble,
+    }
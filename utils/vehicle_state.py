@@ -0,0 +1,180 @@
+import os
+import threading
+import zlib
+from datetime import datetime, timezone
+
+from utils import device_state, trip_stats
+from utils.database import supabase, iter_keyset
+from utils.resilience import ejecutar, escribir
+
+STATE_COLUMNS = "device_id, ignition, current_trip_id, last_seen, last_lat, last_lon"
+
+# Estado de ignition/viaje por IMEI. Es la fuente de verdad; la tabla
+# vehicle_state se actualiza por escritura directa. last_seen va en epoch.
+estados = device_state.tabla(
+    "vehicle_state",
+    ignition="bool",
+    current_trip_id="obj",
+    last_seen="float",
+    last_lat="float",
+    last_lon="float",
+)
+_cargado = False
+_lock = threading.RLock()
+# Las transiciones de un IMEI se serializan con uno de estos locks (por
+# hash del IMEI); las escrituras de trips se hacen con ese lock tomado
+# pero sin el global, así un insert lento solo frena a los IMEI del grupo.
+VEHICLE_STATE_BLOQUEOS = int(os.getenv("VEHICLE_STATE_BLOQUEOS", "256"))
+_bloqueos = [threading.RLock() for _ in range(VEHICLE_STATE_BLOQUEOS)]
+
+
+def bloqueo(imei):
+    """Lock (reentrante) que serializa las transiciones del IMEI."""
+    return _bloqueos[zlib.crc32(str(imei).encode()) % VEHICLE_STATE_BLOQUEOS]
+
+
+def _epoch(valor):
+    if valor is None:
+        return None
+    return datetime.fromisoformat(valor).timestamp()
+
+
+def _poner(fila):
+    estados.poner(
+        fila["device_id"],
+        ignition=fila.get("ignition"),
+        current_trip_id=fila.get("current_trip_id"),
+        last_seen=_epoch(fila.get("last_seen")),
+        last_lat=fila.get("last_lat"),
+        last_lon=fila.get("last_lon"),
+    )
+
+
+def _fila(device_id):
+    est = estados.obtener(device_id)
+    if est is None:
+        return None
+    if est["last_seen"] is not None:
+        est["last_seen"] = datetime.fromtimestamp(est["last_seen"], timezone.utc).isoformat()
+    return {"device_id": device_id, **est}
+
+
+def cargar():
+    """Carga vehicle_state completa en memoria (se llama al iniciar)."""
+    global _cargado
+    filas = list(iter_keyset("vehicle_state", STATE_COLUMNS, key="device_id"))
+    with _lock:
+        estados.limpiar()
+        for fila in filas:
+            _poner(fila)
+        _cargado = True
+    print(f"[STATE] vehicle_state cargado: {len(filas)} vehículos")
+
+
+def obtener(device_id):
+    with _lock:
+        if device_id in estados or _cargado:
+            return _fila(device_id)
+
+    # Sin carga inicial (p. ej. falló al iniciar) consultamos una sola vez
+    res = ejecutar(supabase.table("vehicle_state").select(STATE_COLUMNS).eq("device_id", device_id), reintentos=2)
+    with _lock:
+        if res.data and device_id not in estados:
+            _poner(res.data[0])
+        return _fila(device_id)
+
+
+def aplicar(imei, ignition, observed_at, ts, lat, lon, speed=None, mileage=None, pendientes=None):
+    """
+    Máquina de estados ignition/viaje para un punto.
+
+    Abre un viaje al encender, lo cierra al apagar y acumula sus
+    estadísticas. Las filas de vehicle_state que cambian quedan en
+    `pendientes` (key: IMEI) para escribirlas en un solo upsert.
+    Devuelve el trip_id con el que se guarda el punto en history.
+    """
+    with bloqueo(imei):
+        estado = obtener(imei)
+        current_trip_id = estado["current_trip_id"] if estado else None
+
+        # Caso A: motor encendido
+        if ignition is True:
+            # Si no hay trip activo, crear uno
+            if current_trip_id is None:
+                # Sin reintentos: un insert repetido abriría dos viajes
+                trip_res = ejecutar(
+                    supabase.table("trips")
+                    .insert(
+                        {
+                            "device_id": imei,
+                            "started_at": observed_at,
+                            "status": "active",
+                        }
+                    )
+                )
+                current_trip_id = trip_res.data[0]["id"]
+                trip_stats.iniciar(current_trip_id, ts, lat, lon, mileage)
+
+            history_trip_id = current_trip_id
+
+        # Caso B: motor apagado
+        elif ignition is False:
+            # Si hay trip activo, cerrarlo (con sus estadísticas finales).
+            # El último punto queda asociado al viaje que se cerró.
+            if current_trip_id is not None:
+                trip_stats.acumular(current_trip_id, ts, lat, lon, speed, mileage)
+                ejecutar(
+                    supabase.table("trips").update(
+                        {
+                            "ended_at": observed_at,
+                            "status": "closed",
+                            "close_reason": "ignition_off",
+                            **trip_stats.cerrar(current_trip_id),
+                        }
+                    ).eq("id", current_trip_id),
+                    reintentos=2,
+                )
+
+            history_trip_id = current_trip_id
+            current_trip_id = None  # ya no hay viaje activo
+
+        # Caso C: ignition no viene (None), no cambiamos el estado
+        else:
+            history_trip_id = current_trip_id
+
+        if ignition is not None:
+            fila = {
+                "device_id": imei,
+                "ignition": ignition,
+                "current_trip_id": current_trip_id,
+                "last_seen": observed_at,
+                "last_lat": lat,
+                "last_lon": lon,
+            }
+            estados.poner(
+                imei,
+                ignition=ignition,
+                current_trip_id=current_trip_id,
+                last_seen=ts,
+                last_lat=lat,
+                last_lon=lon,
+            )
+            if pendientes is not None:
+                pendientes[imei] = fila
+            else:
+                escribir("vehicle_state", "upsert", fila, on_conflict="device_id")
+
+    # Acumulados del viaje activo; se persisten cada TRIP_STATS_FLUSH_SEGUNDOS
+    if ignition is not False and history_trip_id is not None:
+        parcial = trip_stats.acumular(history_trip_id, ts, lat, lon, speed, mileage)
+        if parcial:
+            ejecutar(supabase.table("trips").update(parcial).eq("id", history_trip_id), reintentos=2)
+
+    return history_trip_id
+
+
+def persistir(pendientes):
+    """Escribe en un solo upsert las filas de vehicle_state de un lote."""
+    if pendientes:
+        escribir("vehicle_state", "upsert", list(pendientes.values()), on_conflict="device_id")
+        pendientes.clear()